@@ -3,7 +3,7 @@
 .fmt: $(python_src)
 	isort $(src_dirs)
 	black -t py310 $(src_dirs)
-	flake8 --max-line-length 135 $(src_dirs)
+	flake8 --max-line-length 135 --extend-ignore E203 $(src_dirs)
 	touch $@
 
 ### format source and lint
@@ -2,8 +2,19 @@
 
 """functional clone of moralis streams service for a hardhat forked testnet"""
 
-from .cli import cli
-from .client import HardhatStreamsError, streams
+import importlib
+
 from .version import __version__
 
 __all__ = ["cli", "__version__", "streams", "HardhatStreamsError"]
+
+# imported on first access, so the cli and client do not load the server and database modules
+_lazy = dict(cli=".cli", streams=".client", HardhatStreamsError=".client")
+
+
+def __getattr__(name):
+    if name in _lazy:
+        value = getattr(importlib.import_module(_lazy[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,29 +1,46 @@
 # hardhat streams API server
 
 # import databases
+import asyncio
+import contextlib
+import hashlib
 import logging
-from typing import Dict, List
+from functools import partial
+from typing import Dict, List, Optional
 from uuid import UUID, uuid4
 
-from fastapi import Depends, FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from anyio import from_thread
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from . import json, settings
 from .apikey import get_api_key
 from .db import CRUD, get_db, init_db
+from .dispatch import Update
+from .eventstore import get_event_store
+from .feed import feed
+from .leader import Leader
+from .pipeline import Pipeline
+from .profiler import RequestProfiler
+from .router import StreamRoute
 from .schema import (
     Address,
     AddressMap,
     AddressRequest,
     AddressResponse,
     ContractEvent,
+    DeadLetter,
     EventResponse,
     EventStream,
+    HistoryItem,
     HistoryOptions,
     HistoryReplayOptions,
     Setting,
+    SpilledUpdate,
     StreamResponse,
     StreamStatus,
 )
+from .subscribe import Subscription
 from .version import __version__
 
 
@@ -42,6 +59,9 @@ app = FastAPI(
 
 log = logging.getLogger(__name__)
 
+profiler = RequestProfiler()
+app.middleware("http")(profiler)
+
 
 @app.exception_handler(Exception)
 async def system_exception_handler(request: Request, exc: Exception):
@@ -57,12 +77,63 @@ async def system_exception_handler(request: Request, exc: Exception):
 @app.on_event("startup")
 async def startup_event():
     log.debug("startup")
+    if settings.EVENT_STORE == "segment" and settings.WORKERS > 1:
+        # each worker would index the segments alone and miss the events the others append
+        raise RuntimeError("EVENT_STORE=segment keeps its index in one process and needs a single worker")
     init_db()
+    app.state.leader_task = None
+    if settings.RPC_URL:
+        # every worker serves the API; only the elected leader runs the pipeline
+        app.state.pipeline = Pipeline()
+        app.state.leader = Leader()
+        app.state.leader_task = asyncio.create_task(
+            app.state.leader.run(app.state.pipeline.start, app.state.pipeline.stop)
+        )
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     log.debug("shutdown")
+    if app.state.leader_task:
+        app.state.leader_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await app.state.leader_task
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in tags or "*" in tags
+
+
+def _not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def _stream_etag(stream_id, version, suffix=""):
+    return f'"{stream_id}.{version}{suffix}"'
+
+
+def _stream_version(db, stream_id):
+    rows = db.read_values([EventStream.version], EventStream.streamId == stream_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail=f"stream {stream_id} does not exist")
+    return rows[0]
+
+
+def _streams_etag(db):
+    digest = hashlib.sha1()
+    for stream_id, version in db.read_values([EventStream.streamId, EventStream.version]):
+        digest.update(f"{stream_id}.{version};".encode())
+    return f'"streams.{digest.hexdigest()}"'
+
+
+def _touch(db, stream):
+    """increment the stream version, invalidating its ETags"""
+    stream.version = (stream.version or 0) + 1
+    return db.update(stream)
 
 
 @app.post("/stream", response_model=StreamResponse)
@@ -71,6 +142,7 @@ async def create_stream(request: EventStream, db: CRUD = Depends(get_db)):
     request.statusMessage = "stream is created"
     request.streamId = uuid4()
     request.id = None
+    request.version = 1
     stream = db.create(request)
     response = StreamResponse(**stream.dict())
     logging.info(f"created {response}")
@@ -89,6 +161,7 @@ async def update_stream(request: EventStream, db: CRUD = Depends(get_db)):
     """modify a stream"""
     stream = _get_stream(db, request.streamId)
     request.id = stream.id
+    request.version = (stream.version or 0) + 1
     request.statusMessage = "stream is updated"
     updated = db.update(request)
     response = StreamResponse(**updated.dict())
@@ -122,6 +195,7 @@ async def add_address_to_stream(stream_id: UUID, request: AddressRequest, db: CR
         address = db.upsert(Address(address=address))
         db.upsert(AddressMap(stream_id=stream.id, address_id=address.id))
         addresses.append(address.address)
+    _touch(db, stream)
     response = AddressResponse(streamId=stream.streamId, address=addresses)
     return response
 
@@ -143,6 +217,7 @@ async def delete_address_from_stream(stream_id: UUID, request: AddressRequest, d
         db.delete(AddressMap, AddressMap.stream_id == stream.id, AddressMap.address_id == address.id, allow_none=True)
         delete_if_unmapped(db, [address.id])
         addresses.append(address.address)
+    _touch(db, stream)
     response = AddressResponse(streamId=stream.streamId, address=addresses)
     return response
 
@@ -154,15 +229,19 @@ async def update_stream_status(stream_id: UUID, request: StreamStatus, db: CRUD
     old_status = stream.status
     stream.status = request.status
     stream.statusMessage = f"status changed from {old_status} to {stream.status}"
-    stream = db.update(stream)
+    stream = _touch(db, stream)
     response = StreamResponse(**stream.dict())
     logging.info(f"updated {response} status to {stream.status}")
     return response
 
 
 @app.get("/streams", response_model=List[StreamResponse])
-async def get_streams(db: CRUD = Depends(get_db)):
+async def get_streams(request: Request, response: Response, db: CRUD = Depends(get_db)):
     """return a list of streams"""
+    etag = _streams_etag(db)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     streams = db.read(EventStream)
     response = [StreamResponse(**stream.dict()) for stream in streams]
     for stream in response:
@@ -171,7 +250,11 @@ async def get_streams(db: CRUD = Depends(get_db)):
 
 
 @app.get("/stream/{stream_id}", response_model=StreamResponse)
-async def get_stream(stream_id: UUID, db: CRUD = Depends(get_db)):
+async def get_stream(stream_id: UUID, request: Request, response: Response, db: CRUD = Depends(get_db)):
+    etag = _stream_etag(stream_id, _stream_version(db, stream_id))
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     stream = _get_stream(db, stream_id)
     response = StreamResponse(**stream.dict())
     logging.info(f"{response}")
@@ -179,7 +262,11 @@ async def get_stream(stream_id: UUID, db: CRUD = Depends(get_db)):
 
 
 @app.get("/stream/{stream_id}/addresses", response_model=AddressResponse)
-async def get_addresses(stream_id: UUID, db: CRUD = Depends(get_db)):
+async def get_addresses(stream_id: UUID, request: Request, response: Response, db: CRUD = Depends(get_db)):
+    etag = _stream_etag(stream_id, _stream_version(db, stream_id), ".addresses")
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    response.headers["ETag"] = etag
     stream = _get_stream(db, stream_id)
     maps = db.read_all(AddressMap, AddressMap.stream_id == stream.id, allow_none=True)
     addresses = [db.read_one(Address, Address.id == map.address_id) for map in maps]
@@ -187,16 +274,81 @@ async def get_addresses(stream_id: UUID, db: CRUD = Depends(get_db)):
     return response
 
 
-@app.get("/history", response_model=List[Dict])
-async def get_history(options: HistoryOptions, db: CRUD = Depends(get_db)):
-    """get stream history"""
-    return []
+@app.get("/stream/{stream_id}/subscribe")
+async def subscribe(stream_id: UUID, request: Request, cursor: Optional[int] = None, db: CRUD = Depends(get_db)):
+    """stream updates as server-sent events, resuming after cursor or the Last-Event-ID header"""
+    stream = _get_stream(db, stream_id)
+    if cursor is None and request.headers.get("last-event-id"):
+        try:
+            cursor = int(request.headers["last-event-id"])
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Last-Event-ID is not a subscription cursor")
+    subscription = Subscription(StreamRoute(stream, []), cursor)
+    await subscription.open()
+    logging.info(f"subscribed {subscription}")
+    headers = {"cache-control": "no-cache", "x-accel-buffering": "no"}
+    return StreamingResponse(subscription.events(), media_type="text/event-stream", headers=headers)
+
+
+def _history_item(letter, stream, exclude_payload):
+    payload = None
+    if not exclude_payload:
+        route = StreamRoute(stream, [])
+        update = Update(route, letter.shared, letter.block_number, letter.confirmed, letter.retries)
+        payload = json.loads(update.encode())
+    return HistoryItem(
+        id=letter.historyId,
+        date=letter.created,
+        streamId=stream.streamId,
+        tag=stream.tag,
+        webhookUrl=str(stream.webhookUrl),
+        blockNumber=letter.block_number,
+        retries=letter.retries,
+        errorMessage=letter.error,
+        payload=payload,
+    )
+
+
+@app.get("/history", response_model=List[HistoryItem])
+async def get_history(options: HistoryOptions = Depends(), db: CRUD = Depends(get_db)):
+    """get stream history: updates whose delivery was abandoned after exhausting retries"""
+    where = []
+    if options.id:
+        where.append(DeadLetter.historyId == options.id)
+    if options.streamId:
+        where.append(DeadLetter.stream_id == _get_stream(db, options.streamId).id)
+    letters = db.read_all(DeadLetter, *where, order_by=DeadLetter.id, limit=options.limit)
+    stream_ids = set(letter.stream_id for letter in letters)
+    streams = {stream.id: stream for stream in db.read_all(EventStream, EventStream.id.in_(stream_ids))}
+    return [
+        _history_item(letter, streams[letter.stream_id], options.excludePayload)
+        for letter in letters
+        if letter.stream_id in streams
+    ]
 
 
-@app.get("/history/replay", response_model=List[Dict])
+@app.post("/history/replay", response_model=HistoryItem)
 async def replay_history(ids: HistoryReplayOptions, db: CRUD = Depends(get_db)):
-    """request history replay"""
-    return []
+    """request history replay: queue a dead-lettered update for delivery again"""
+    stream = _get_stream(db, ids.streamId)
+    letter = db.read_one(DeadLetter, DeadLetter.historyId == ids.id, DeadLetter.stream_id == stream.id, allow_none=True)
+    if not letter:
+        raise HTTPException(status_code=404, detail=f"history {ids.id} does not exist for stream {ids.streamId}")
+    response = _history_item(letter, stream, True)
+    db.create(
+        SpilledUpdate(
+            stream_id=stream.id,
+            block_number=letter.block_number,
+            confirmed=letter.confirmed,
+            retries=0,
+            shared=letter.shared,
+        )
+    )
+    db.delete(letter)
+    # the version change reloads the pipeline routing table, which picks up the spilled update
+    _touch(db, stream)
+    logging.info(f"replaying history {ids.id} for {stream}")
+    return response
 
 
 @app.get("/settings", response_model=Dict)
@@ -229,29 +381,52 @@ async def get_stats_by_stream_id(stream_id: UUID, db: CRUD = Depends(get_db)):
     return dict(streamId=stream_id, stats=True, index=stream.id)
 
 
+@app.get("/admin/profiles", response_model=List[Dict])
+async def get_profiles(limit: Optional[int] = None):
+    """return the profiles of the slowest profiled requests, slowest first"""
+    return profiler.slowest(limit)
+
+
+@app.delete("/admin/profiles", response_model=Dict)
+async def delete_profiles():
+    """discard the kept request profiles"""
+    return dict(status="deleted", count=profiler.clear())
+
+
 @app.post("/event", response_model=EventResponse)
-def post_event(event: ContractEvent, db: CRUD = Depends(get_db)):
-    event = db.create(event)
-    return dict(status="received", count=1)
+def post_event(event: ContractEvent, events=Depends(get_event_store)):
+    count = events.ingest([event])
+    if count:
+        from_thread.run(feed.notify)
+    return dict(status="received", count=count)
 
 
 @app.get("/events", response_model=List[ContractEvent])
-def get_events(db: CRUD = Depends(get_db)):
-    return db.read_all(ContractEvent)
+async def get_events(
+    since: Optional[int] = None,
+    wait: float = 0,
+    limit: Optional[int] = None,
+    first_block: Optional[int] = None,
+    last_block: Optional[int] = None,
+    events=Depends(get_event_store),
+):
+    """return the events after the since cursor within a block range, waiting up to wait seconds for new events"""
+    read = partial(events.read, limit=limit, first_block=first_block, last_block=last_block)
+    if since is None or wait <= 0:
+        return await asyncio.to_thread(read, since)
+    return await feed.read(read, since, min(wait, settings.FEED_MAX_WAIT))
 
 
 @app.get("/event/<event_id>", response_model=ContractEvent)
-def get_event(event_id: int, db: CRUD = Depends(get_db)):
-    return db.read_one(ContractEvent, ContractEvent.id == event_id)
+def get_event(event_id: int, events=Depends(get_event_store)):
+    return events.read_one(event_id)
 
 
 @app.delete("/events", response_model=EventResponse)
-def delete_events(db: CRUD = Depends(get_db)):
-    deleted = db.delete(ContractEvent, ContractEvent.id >= 0)
-    return EventResponse(status="deleted", count=deleted)
+def delete_events(events=Depends(get_event_store)):
+    return EventResponse(status="deleted", count=events.delete())
 
 
 @app.delete("/event/<event_id>", response_model=EventResponse)
-def delete_event(event_id: int, db: CRUD = Depends(get_db)):
-    deleted = db.delete(ContractEvent, ContractEvent.id == event_id)
-    return EventResponse(status="deleted", count=deleted)
+def delete_event(event_id: int, events=Depends(get_event_store)):
+    return EventResponse(status="deleted", count=events.delete(event_id))
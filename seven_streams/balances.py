@@ -0,0 +1,122 @@
+# native balance lookups
+
+"""fill the nativeBalances payload field for streams with getNativeBalances
+
+Each getNativeBalances entry names a payload record type and selectors, as
+in {"type": "tx", "selectors": ["$fromAddress", "$toAddress"]}.  A "$name"
+selector takes the address in that field of each record of the type, and
+any other selector is a literal address.  The addresses wanted by every
+stream matching a block are looked up together in one eth_getBalance batch
+pinned to the block number, and cached by (block, address).
+"""
+
+import logging
+from collections import OrderedDict
+
+from . import json, settings
+from .poller import to_int
+
+logger = logging.getLogger(__name__)
+
+
+def _address(value):
+    if isinstance(value, str) and value.startswith("0x") and len(value) == 42:
+        return value.lower()
+    return None
+
+
+def selectors(entries):
+    """return the hashable (type, selectors) form of a getNativeBalances list"""
+    if isinstance(entries, str):
+        entries = json.loads(entries)
+    parsed = []
+    for entry in entries or []:
+        if isinstance(entry, dict) and entry.get("selectors"):
+            parsed.append((str(entry.get("type", "tx")).lower(), tuple(entry["selectors"])))
+    return tuple(parsed)
+
+
+def addresses(payload, native_balances):
+    """return the addresses selected from payload, in order of first appearance"""
+    selected = {}
+    for type, type_selectors in native_balances:
+        records = payload.records(type)
+        for selector in type_selectors:
+            if not selector.startswith("$"):
+                address = _address(selector)
+                if address:
+                    selected[address] = None
+                continue
+            field = selector[1:]
+            for record in records:
+                address = _address(record.get(field))
+                if address:
+                    selected[address] = None
+    return list(selected)
+
+
+class BalanceCache:
+    """native balances by (block number, address), fetched in one eth_getBalance batch per block"""
+
+    def __init__(self, rpc, size=None):
+        self.rpc = rpc
+        self.size = size or settings.BALANCE_CACHE_SIZE
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} size={len(self.entries)} hits={self.hits} misses={self.misses}>"
+
+    async def get(self, block_number, addresses):
+        """return a dict of address to balance in wei as a decimal string, omitting failed lookups"""
+        balances = {}
+        missing = []
+        for address in addresses:
+            key = (block_number, address)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                balances[address] = self.entries[key]
+                self.hits += 1
+            else:
+                missing.append(address)
+        if missing:
+            self.misses += len(missing)
+            tag = hex(block_number)
+            results = await self.rpc.batch(
+                [("eth_getBalance", [address, tag]) for address in missing], return_exceptions=True
+            )
+            for address, result in zip(missing, results):
+                if result is None or isinstance(result, Exception):
+                    logger.warning(f"balance of {address} at block {block_number} not available: {result}")
+                    continue
+                balance = str(to_int(result))
+                self.entries[(block_number, address)] = balance
+                balances[address] = balance
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return balances
+
+
+class BalanceStage:
+    """dispatcher stage filling nativeBalances; runs after the stages that fill the selected records"""
+
+    def __init__(self, rpc, cache=None):
+        self.cache = cache or BalanceCache(rpc)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.cache}>"
+
+    async def __call__(self, block, groups, payloads):
+        wanted = {}
+        for key, (logs, routes) in groups.items():
+            if routes[0].native_balances:
+                wanted[key] = addresses(payloads[key], routes[0].native_balances)
+        if not wanted:
+            return
+        unique = list(dict.fromkeys(address for selected in wanted.values() for address in selected))
+        balances = await self.cache.get(block.number, unique)
+        for key, selected in wanted.items():
+            payloads[key].native_balances = [
+                dict(address=address, balance=balances[address]) for address in selected if address in balances
+            ]
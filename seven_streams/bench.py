@@ -0,0 +1,325 @@
+# hardhat event streams benchmarks
+
+"""in-process benchmarks of the service hot paths against a temporary database"""
+
+import os
+import platform
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlmodel import Session, SQLModel, create_engine
+
+from . import db, json, settings
+from .client import HardhatEventStreams
+from .schema import ContractEvent, EventStream
+from .version import __version__
+
+TRANSPORTS = ["testclient", "uvicorn"]
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+def summarize(samples, elapsed=None):
+    """return latency statistics in milliseconds for a list of per-operation durations in seconds"""
+    samples = sorted(samples)
+    count = len(samples)
+    elapsed = elapsed if elapsed is not None else sum(samples)
+    ms = 1000.0
+    return dict(
+        count=count,
+        elapsed=round(elapsed, 6),
+        ops_per_sec=round(count / elapsed, 2) if elapsed else 0.0,
+        min_ms=round(samples[0] * ms, 4) if count else 0.0,
+        mean_ms=round(statistics.fmean(samples) * ms, 4) if count else 0.0,
+        p50_ms=round(_percentile(samples, 50) * ms, 4),
+        p90_ms=round(_percentile(samples, 90) * ms, 4),
+        p99_ms=round(_percentile(samples, 99) * ms, 4),
+        max_ms=round(samples[-1] * ms, 4) if count else 0.0,
+    )
+
+
+def timed(func, items):
+    """call func for each item, returning (results, per-call durations, total elapsed)"""
+    results = []
+    samples = []
+    clock = time.perf_counter
+    start = clock()
+    for item in items:
+        t0 = clock()
+        results.append(func(item))
+        samples.append(clock() - t0)
+    return results, samples, clock() - start
+
+
+def address(n):
+    return "0x" + n.to_bytes(20, "big").hex()
+
+
+def hash32(n):
+    return "0x" + n.to_bytes(32, "big").hex()
+
+
+def stream_body(tag, webhook_url="http://localhost:8081/contract/event"):
+    return dict(
+        webhookUrl=webhook_url,
+        description="benchmark stream",
+        tag=tag,
+        topic0=["Transfer(address,address,uint256)"],
+        chainIds=["0x7a69"],
+        abi=[
+            {
+                "anonymous": False,
+                "inputs": [
+                    {"indexed": True, "name": "from", "type": "address"},
+                    {"indexed": True, "name": "to", "type": "address"},
+                    {"indexed": False, "name": "value", "type": "uint256"},
+                ],
+                "name": "Transfer",
+                "type": "event",
+            }
+        ],
+    )
+
+
+def event_body(n):
+    return dict(
+        contract_address=address(n % 64 + 1),
+        event_hash=hash32(0xDDF252AD),
+        txn_hash=hash32(n + 1),
+        data=dict(blockNumber=n, logIndex=0, args=dict(value=n)),
+    )
+
+
+class _Server(threading.Thread):
+    """uvicorn server running in a background thread of this process"""
+
+    def __init__(self, app, host="127.0.0.1"):
+        import uvicorn
+
+        super().__init__(daemon=True)
+        with socket.socket() as sock:
+            sock.bind((host, 0))
+            self.port = sock.getsockname()[1]
+        self.url = f"http://{host}:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=self.port, log_level="warning"))
+
+    def run(self):
+        self.server.run()
+
+    def __enter__(self):
+        self.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, _, exc, tb):
+        self.server.should_exit = True
+        self.join()
+
+
+@contextmanager
+def bench_client(transport="testclient", database_file=None):
+    """yield a HardhatStreams client bound to the app running against a temporary database
+
+    The global db.engine, and the segment event store used when EVENT_STORE
+    is "segment", are swapped for temporary ones without a lock, so
+    benchmarks run one client at a time, in a single thread.
+    """
+    import httpx
+    from fastapi.testclient import TestClient
+
+    from . import eventstore
+    from .app import app
+
+    if transport not in TRANSPORTS:
+        raise ValueError(f"unknown transport: {transport}")
+
+    with tempfile.TemporaryDirectory(prefix="ses-bench-") as tempdir:
+        database_file = database_file or os.path.join(tempdir, "bench.db")
+        engine = create_engine(f"sqlite:///{database_file}", connect_args=dict(check_same_thread=False))
+        SQLModel.metadata.create_all(engine)
+        saved_engine = db.engine
+        saved_event_store = eventstore._segment_store
+        db.engine = engine
+        eventstore._segment_store = eventstore.SegmentEventStore(os.path.join(tempdir, "events"))
+        try:
+            if transport == "testclient":
+                with TestClient(app) as client:
+                    yield HardhatEventStreams(requests=client, url=str(client.base_url)).streams
+            else:
+                with _Server(app) as server, httpx.Client() as client:
+                    yield HardhatEventStreams(requests=client, url=server.url).streams
+        finally:
+            db.engine = saved_engine
+            eventstore._segment_store = saved_event_store
+            engine.dispose()
+
+
+def store_event(block, index):
+    return ContractEvent(
+        contract_address=address(index % 64 + 1),
+        event_hash=hash32(0xDDF252AD),
+        txn_hash=hash32(block * 1000 + index + 1),
+        chain_id=31337,
+        log_index=index,
+        block_number=block,
+        data=dict(blockNumber=block, logIndex=index, args=dict(value=index)),
+    )
+
+
+def bench_stream_crud(streams, api_key, count):
+    """create, read, status-update and delete streams"""
+    evm = streams.evm_streams
+    created, create, create_elapsed = timed(
+        lambda n: evm.create_stream(api_key, stream_body(f"bench-{n}")), range(count)
+    )
+    ids = [stream["id"] for stream in created]
+    _, read, read_elapsed = timed(lambda id: evm.get_stream(api_key, dict(id=id)), ids)
+    _, status, status_elapsed = timed(
+        lambda id: evm.update_stream_status(api_key, dict(id=id), dict(status="paused")), ids
+    )
+    _, listing, listing_elapsed = timed(lambda _: evm.get_streams(api_key, {}), range(max(1, count // 10)))
+    _, delete, delete_elapsed = timed(lambda id: evm.delete_stream(api_key, dict(id=id)), ids)
+    return dict(
+        create=summarize(create, create_elapsed),
+        read=summarize(read, read_elapsed),
+        status=summarize(status, status_elapsed),
+        list=summarize(listing, listing_elapsed),
+        delete=summarize(delete, delete_elapsed),
+    )
+
+
+def bench_event_ingest(streams, api_key, count):
+    """POST /event throughput"""
+    base = streams.evm_streams
+    bodies = [json.dumps(event_body(n)) for n in range(count)]
+    _, samples, elapsed = timed(lambda body: base.post(api_key, "/event", content=body), bodies)
+    base.delete(api_key, "/events")
+    return dict(ingest=summarize(samples, elapsed))
+
+
+def bench_addresses(streams, api_key, count, chunk=100):
+    """add and remove many addresses on a single stream"""
+    evm = streams.evm_streams
+    stream_id = evm.create_stream(api_key, stream_body("bench-addresses"))["id"]
+    path = f"/stream/{stream_id}"
+    chunks = [[address(n) for n in range(i, min(i + chunk, count))] for i in range(0, count, chunk)]
+    _, add, add_elapsed = timed(
+        lambda addresses: evm.post(api_key, f"{path}/add_address", json=dict(address=addresses)), chunks
+    )
+    _, get, get_elapsed = timed(lambda _: evm.get_addresses(api_key, dict(id=stream_id)), range(10))
+    _, remove, remove_elapsed = timed(
+        lambda addresses: evm.post(api_key, f"{path}/delete_address", json=dict(address=addresses)), chunks
+    )
+    evm.delete_stream(api_key, dict(id=stream_id))
+    return dict(
+        addresses=count,
+        chunk=chunk,
+        add=summarize(add, add_elapsed),
+        get=summarize(get, get_elapsed),
+        remove=summarize(remove, remove_elapsed),
+    )
+
+
+def bench_events_list(streams, api_key, count, repeat=20):
+    """GET /events with a populated event table"""
+    base = streams.evm_streams
+    for n in range(count):
+        base.post(api_key, "/event", content=json.dumps(event_body(n)))
+    _, samples, elapsed = timed(lambda _: base.get(api_key, "/events"), range(repeat))
+    base.delete(api_key, "/events")
+    return dict(events=count, list=summarize(samples, elapsed))
+
+
+def bench_encode(count):
+    """JSON encode and schema validation cost, without the HTTP stack"""
+    stream = stream_body("bench-encode")
+    event = event_body(1)
+    stream_json = json.dumps(stream)
+    event_json = json.dumps(event)
+    _, stream_parse, stream_parse_elapsed = timed(lambda _: EventStream.parse_raw(stream_json), range(count))
+    parsed = EventStream.parse_raw(stream_json)
+    _, stream_dump, stream_dump_elapsed = timed(lambda _: parsed.json(), range(count))
+    _, event_parse, event_parse_elapsed = timed(lambda _: ContractEvent.parse_raw(event_json), range(count))
+    _, dumps, dumps_elapsed = timed(lambda _: json.dumps(event), range(count))
+    return dict(
+        stream_validate=summarize(stream_parse, stream_parse_elapsed),
+        stream_encode=summarize(stream_dump, stream_dump_elapsed),
+        event_validate=summarize(event_parse, event_parse_elapsed),
+        json_dumps=summarize(dumps, dumps_elapsed),
+    )
+
+
+def bench_event_store(count, per_block=10, span=10, repeat=20):
+    """database and segment log event store ingest and block range reads, without the HTTP stack"""
+    from .eventstore import DatabaseEventStore, SegmentEventStore
+
+    blocks = max(1, count // per_block)
+    batches = [[store_event(block, index) for index in range(per_block)] for block in range(blocks)]
+    ranges = [(n * blocks // repeat, n * blocks // repeat + span - 1) for n in range(repeat)]
+    results = dict(events=blocks * per_block, per_block=per_block, span=span)
+    with tempfile.TemporaryDirectory(prefix="ses-bench-") as tempdir:
+        engine = create_engine(f"sqlite:///{os.path.join(tempdir, 'bench.db')}")
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            stores = dict(
+                database=DatabaseEventStore(session), segment=SegmentEventStore(os.path.join(tempdir, "events"))
+            )
+            for name, store in stores.items():
+                _, ingest, ingest_elapsed = timed(store.ingest, batches)
+                _, scan, scan_elapsed = timed(lambda r: store.read(first_block=r[0], last_block=r[1]), ranges)
+                _, page, page_elapsed = timed(lambda n: store.read(since=n * per_block, limit=100), range(repeat))
+                _, replay, replay_elapsed = timed(store.ingest, batches[-repeat:])
+                results[name] = dict(
+                    ingest=summarize(ingest, ingest_elapsed),
+                    range_scan=summarize(scan, scan_elapsed),
+                    page=summarize(page, page_elapsed),
+                    replay=summarize(replay, replay_elapsed),
+                )
+                store.delete()
+        engine.dispose()
+    return results
+
+
+SUITES = {
+    "stream_crud": lambda streams, api_key, n: bench_stream_crud(streams, api_key, n),
+    "event_ingest": lambda streams, api_key, n: bench_event_ingest(streams, api_key, n * 10),
+    "addresses": lambda streams, api_key, n: bench_addresses(streams, api_key, n * 10),
+    "events_list": lambda streams, api_key, n: bench_events_list(streams, api_key, n * 10),
+    "encode": lambda streams, api_key, n: bench_encode(n * 10),
+    "event_store": lambda streams, api_key, n: bench_event_store(n * 10),
+}
+
+
+def run(suites=None, count=100, transport="testclient", api_key=None):
+    """run the selected benchmark suites, returning a json-serializable result dict"""
+    suites = suites or list(SUITES.keys())
+    unknown = set(suites) - set(SUITES.keys())
+    if unknown:
+        raise ValueError(f"unknown benchmark suite: {', '.join(sorted(unknown))}")
+    api_key = str(api_key or settings.API_KEY)
+    results = {}
+    with bench_client(transport) as streams:
+        for name in suites:
+            start = time.perf_counter()
+            results[name] = SUITES[name](streams, api_key, count)
+            results[name]["wall"] = round(time.perf_counter() - start, 6)
+    return dict(
+        version=__version__,
+        timestamp=datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        transport=transport,
+        count=count,
+        results=results,
+    )
@@ -0,0 +1,96 @@
+# block logsBloom prefilter
+
+"""skip routing the logs of blocks that cannot match any stream
+
+A block header's logsBloom has the 3 bloom bits of every log address and
+topic set.  StreamBloom keeps the bits of every routed stream address and
+topic0; a block can only match a stream if the bits of one of its topic0
+values, and for streams that are not allAddresses one of its addresses, are
+all set in the block bloom.  Blooms have false positives, never false
+negatives, so a block that fails the test is certain to match nothing; the
+dispatcher neither routes its logs nor runs the stages fetching its
+receipts and traces.  The poller still fetches the header and logs of every
+block in one batch, so every log is ingested for /events.
+
+The bits are kept per value across routing table reloads, so adding or
+removing stream addresses hashes only the values that are new.
+"""
+
+from eth_utils import keccak
+
+
+def bloom_bits(value):
+    """return the bloom bits of a hex address or topic, as an int mask of the 2048 bit bloom"""
+    digest = keccak(hexstr=value)
+    mask = 0
+    for i in (0, 2, 4):
+        mask |= 1 << (((digest[i] << 8) | digest[i + 1]) & 2047)
+    return mask
+
+
+def logs_bloom(logs):
+    """return the 256 byte bloom filter of a list of rpc-shaped logs"""
+    bloom = 0
+    for log in logs:
+        for value in [log["address"]] + log["topics"]:
+            bloom |= bloom_bits(value)
+    return bloom.to_bytes(256, "big")
+
+
+def _present(masks, bloom):
+    return any(mask & bloom == mask for mask in masks)
+
+
+class StreamBloom:
+    def __init__(self):
+        # bloom bits by address or topic0 value
+        self.bits = {}
+        self.address_bits = frozenset()
+        self.topic_bits = frozenset()
+        self.any_address_bits = frozenset()
+        self.hashed = 0
+        self.tested = 0
+        self.skipped = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} values={len(self.bits)} hashed={self.hashed}"
+            f" tested={self.tested} skipped={self.skipped}>"
+        )
+
+    def reload(self, routes):
+        """update the bits for a reloaded routing table"""
+        addresses = set()
+        topics = set()
+        any_address_topics = set()
+        for route in routes.values():
+            if not (route.routed and route.include_contract_logs):
+                continue
+            if route.all_addresses:
+                any_address_topics |= route.topic0
+            elif route.addresses:
+                addresses |= route.addresses
+                topics |= route.topic0
+        values = addresses | topics | any_address_topics
+        for value in self.bits.keys() - values:
+            del self.bits[value]
+        for value in values - self.bits.keys():
+            self.bits[value] = bloom_bits(value)
+            self.hashed += 1
+        self.address_bits = frozenset(self.bits[value] for value in addresses)
+        self.topic_bits = frozenset(self.bits[value] for value in topics)
+        self.any_address_bits = frozenset(self.bits[value] for value in any_address_topics)
+
+    def may_match(self, header):
+        """return False if the block of header has no log any stream can match"""
+        value = header.get("logsBloom")
+        if not value:
+            return True
+        bloom = int(value, 16)
+        self.tested += 1
+        if _present(self.any_address_bits, bloom) or (
+            _present(self.topic_bits, bloom) and _present(self.address_bits, bloom)
+        ):
+            return True
+        self.skipped += 1
+        return False
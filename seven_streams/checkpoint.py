@@ -0,0 +1,169 @@
+# stream delivery checkpoints
+
+"""resume each stream after a restart from the last block delivered to it
+
+A stream's checkpoint on a chain is the last block whose updates for the
+stream have all been delivered, or written to durable storage (spilled,
+spooled or dead-lettered) from which delivery continues after a restart.
+All the logs of a block matching a stream are delivered as one update, so
+the block number alone tells where the stream resumes.  DeliveryQueue
+counts the updates it holds in memory per stream and block, so the
+checkpoint is the block before a stream's oldest held update, or the last
+dispatched block when it holds none; a retry delivering blocks out of order
+never moves it past an undelivered block.
+
+The Checkpointer saves the checkpoints every CHECKPOINT_INTERVAL seconds,
+and once more when the pipeline stops, writing only those that moved since
+the last save, in one transaction.
+
+On startup the poller resumes from the block after the oldest checkpoint,
+and the dispatcher passes each stream only the blocks after its own, so
+every stream catches up in a single pass over the chain, the lagging ones
+alongside those that were current.  Streams without a checkpoint start at
+START_BLOCK, or the chain head, as before.  Checkpoints beyond the chain
+head, left by a hardhat node that was restarted, are ignored.
+"""
+
+import asyncio
+import logging
+import time
+
+from sqlalchemy import bindparam, delete, insert, update
+from sqlmodel import Session, select
+
+from . import db, settings
+from .router import chain_id
+from .schema import StreamCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore:
+    """stream checkpoints in the StreamCheckpoint table"""
+
+    def load(self, chain):
+        """return a dict of stream id to block number for the checkpoints on a chain"""
+        with Session(db.engine) as session:
+            rows = session.exec(select(StreamCheckpoint).where(StreamCheckpoint.chain_id == chain)).all()
+        return {row.stream_id: row.block_number for row in rows}
+
+    def save(self, chain, checkpoints, deleted, now):
+        """write the checkpoints of a chain and remove those of deleted streams, in one transaction"""
+        table = StreamCheckpoint.__table__
+        rows = [
+            dict(stream_id=stream_id, chain_id=chain, block_number=block_number, updated=now)
+            for stream_id, block_number in checkpoints.items()
+        ]
+        with Session(db.engine) as session:
+            if deleted:
+                session.execute(delete(StreamCheckpoint).where(StreamCheckpoint.stream_id.in_(deleted)))
+            if rows:
+                statement = select(StreamCheckpoint.stream_id).where(
+                    StreamCheckpoint.chain_id == chain, StreamCheckpoint.stream_id.in_(checkpoints)
+                )
+                existing = set(session.exec(statement).all())
+                updates = [dict(row, key=row["stream_id"]) for row in rows if row["stream_id"] in existing]
+                inserts = [row for row in rows if row["stream_id"] not in existing]
+                if updates:
+                    statement = (
+                        update(table)
+                        .where(table.c.stream_id == bindparam("key"), table.c.chain_id == chain)
+                        .values(block_number=bindparam("block_number"), updated=bindparam("updated"))
+                    )
+                    session.execute(statement, updates)
+                if inserts:
+                    session.execute(insert(table), inserts)
+            session.commit()
+
+
+class Checkpointer:
+    """dispatcher consumer tracking each stream's checkpoint and saving those that moved"""
+
+    def __init__(self, delivery, store=None, interval=None):
+        self.delivery = delivery
+        self.store = store or CheckpointStore()
+        self.interval = interval or settings.CHECKPOINT_INTERVAL
+        self.chain = None
+        # the last block passed to the dispatcher
+        self.head = None
+        # stream id to the last block delivered before this run, and the default for other streams
+        self.floors = {}
+        self.floor = None
+        self.saved = {}
+        self.streams = set()
+        self.deleted = set()
+        self.saves = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} chain={self.chain} head={self.head} streams={len(self.streams)}"
+            f" saves={self.saves}>"
+        )
+
+    async def resume(self, chain, head, start):
+        """poller resume hook: load the checkpoints of chain, returning the block to poll from"""
+        self.chain = chain_id(chain)
+        checkpoints = await asyncio.to_thread(self.store.load, self.chain)
+        stale = [stream_id for stream_id, block_number in checkpoints.items() if block_number > head]
+        if stale:
+            logger.warning(f"ignoring {len(stale)} checkpoints beyond the chain head {head}")
+        self.saved = {stream_id: checkpoint for stream_id, checkpoint in checkpoints.items() if stream_id not in stale}
+        self.floors = dict(self.saved)
+        self.floor = start - 1
+        self.head = None
+        block_number = min([floor + 1 for floor in self.floors.values()] + [start])
+        logger.info(f"resuming from block {block_number} with {len(self.floors)} stream checkpoints")
+        return block_number
+
+    def delivered(self, route, block_number):
+        """return True if block_number was delivered to the stream of route before this run"""
+        floor = self.floors.get(route.id, self.floor)
+        return floor is not None and block_number <= floor
+
+    def advance(self, block_number):
+        self.head = block_number
+
+    def reload(self, routes):
+        for stream_id in self.streams - routes.keys():
+            self.deleted.add(stream_id)
+            self.saved.pop(stream_id, None)
+            self.floors.pop(stream_id, None)
+        self.streams = set(routes.keys())
+
+    def moved(self):
+        """return the checkpoints that moved since they were last saved"""
+        if self.head is None:
+            return {}
+        checkpoints = {}
+        for stream_id in self.streams:
+            checkpoint = self.delivery.settled(stream_id, self.head)
+            if checkpoint != self.saved.get(stream_id):
+                checkpoints[stream_id] = checkpoint
+        return checkpoints
+
+    async def save(self):
+        """write the checkpoints that moved, returning the number written"""
+        if self.chain is None:
+            return 0
+        checkpoints = self.moved()
+        deleted, self.deleted = self.deleted, set()
+        if not checkpoints and not deleted:
+            return 0
+        try:
+            await asyncio.to_thread(self.store.save, self.chain, checkpoints, deleted, time.time())
+        except Exception:
+            self.deleted |= deleted
+            raise
+        self.saved.update(checkpoints)
+        self.saves += 1
+        return len(checkpoints)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"checkpoint save failed: {exc.__class__.__name__}: {exc}")
@@ -3,9 +3,6 @@ import sys
 from pathlib import Path
 
 import click
-import uvicorn
-
-from . import db, settings
 
 
 class Context:
@@ -24,6 +21,8 @@ class Context:
 @click.option("-g", "--gateway-url", envvar="GATEWAY_URL", show_envvar=True, help="gateway URL")
 @click.pass_context
 def cli(ctx, debug, log_level, bind_address, port, api_key, workers, gateway_url):
+    from . import settings
+
     ctx.obj = Context(
         debug=debug or settings.DEBUG,
         log_level=log_level or settings.LOG_LEVEL,
@@ -39,9 +38,15 @@ def cli(ctx, debug, log_level, bind_address, port, api_key, workers, gateway_url
 @click.pass_obj
 def run(ctx):
     """run server"""
+    import uvicorn
+
+    from . import settings
+
+    if settings.EVENT_STORE == "segment" and ctx.workers > 1:
+        raise click.UsageError("EVENT_STORE=segment keeps its index in one process and needs a single worker")
     sys.exit(
         uvicorn.run(
-            "hardhat_event_streams.app:app",
+            "seven_streams.app:app",
             host=ctx.bind_address,
             port=ctx.port,
             log_level=ctx.log_level.lower(),
@@ -51,6 +56,28 @@ def run(ctx):
     )
 
 
+@cli.command
+@click.option("-n", "--limit", type=int, help="number of profiles (default: all kept)")
+@click.option("-s", "--stats", is_flag=True, help="include the profile statistics")
+@click.option("-c", "--clear", is_flag=True, help="discard the kept profiles after output")
+@click.pass_obj
+def profiles(ctx, limit, stats, clear):
+    """output the slowest profiled requests of the server"""
+    from .client import HardhatEventStreams
+
+    with HardhatEventStreams(url=ctx.gateway_url) as client:
+        admin = client.streams.admin
+        for profile in admin.get_profiles(str(ctx.api_key), limit):
+            click.echo(
+                f"{profile['elapsed'] * 1000:10.3f}ms {profile['status']} {profile['method']} {profile['path']}"
+                f"{'?' + profile['query'] if profile['query'] else ''} {profile['started']}"
+            )
+            if stats:
+                click.echo(profile["stats"])
+        if clear:
+            admin.clear_profiles(str(ctx.api_key))
+
+
 @cli.group(name="db")
 @click.pass_context
 def db_group(ctx):
@@ -62,6 +89,8 @@ def db_group(ctx):
 @click.pass_context
 def init(ctx):
     """create database"""
+    from . import db
+
     db.init_db()
 
 
@@ -83,8 +112,109 @@ def load(ctx):
 @click.pass_context
 def destroy(ctx):
     """destroy database"""
+    from . import settings
+
     Path(settings.DATABASE_FILE).unlink(missing_ok=True)
 
 
+@cli.group(name="bench")
+@click.pass_context
+def bench_group(ctx):
+    """benchmark commands"""
+    pass
+
+
+@bench_group.command(name="list")
+def bench_list():
+    """list benchmark suites"""
+    from . import bench
+
+    for name, func in bench.SUITES.items():
+        click.echo(name)
+
+
+@bench_group.command(name="run")
+@click.option("-s", "--suite", "suites", multiple=True, help="suite to run (default: all)")
+@click.option("-n", "--count", type=int, default=100, show_default=True, help="base operation count")
+@click.option(
+    "-t",
+    "--transport",
+    type=click.Choice(["testclient", "uvicorn"]),
+    default="testclient",
+    show_default=True,
+    help="in-process TestClient or a uvicorn server on a local port",
+)
+@click.option("-o", "--output", type=click.File("w"), default="-", help="output file")
+@click.pass_obj
+def bench_run(ctx, suites, count, transport, output):
+    """run benchmarks against a temporary database, writing JSON results"""
+    from . import bench, json
+
+    results = bench.run(suites=list(suites), count=count, transport=transport, api_key=ctx.api_key)
+    output.write(json.dumps(results, indent=2) + "\n")
+
+
+def _generator_options(func):
+    options = [
+        click.option("-a", "--address", "addresses", multiple=True, help="contract address (default: generated)"),
+        click.option("-A", "--address-count", type=int, default=8, show_default=True, help="generated addresses"),
+        click.option("-T", "--topic0", multiple=True, help="event signature or topic0 hash"),
+        click.option("-L", "--logs-per-block", type=int, default=10, show_default=True, help="logs per block"),
+        click.option("-X", "--txs-per-block", type=int, default=5, show_default=True, help="transactions per block"),
+        click.option("--block-time", type=float, default=1.0, show_default=True, help="seconds per block"),
+        click.option("--seed", type=int, default=0, show_default=True, help="random seed"),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def _generator(addresses, address_count, topic0, logs_per_block, txs_per_block, block_time, seed):
+    from .loadgen import BlockGenerator
+
+    return BlockGenerator(
+        addresses=list(addresses),
+        topic0=list(topic0),
+        logs_per_block=logs_per_block,
+        txs_per_block=txs_per_block,
+        block_time=block_time,
+        seed=seed,
+        address_count=address_count,
+    )
+
+
+@bench_group.command(name="rpc")
+@_generator_options
+@click.option("-P", "--rpc-port", type=int, default=8545, show_default=True, help="json-rpc listen port")
+@click.pass_obj
+def bench_rpc(ctx, rpc_port, **kwargs):
+    """serve synthetic blocks from a fake hardhat json-rpc endpoint"""
+    import uvicorn
+
+    from .loadgen import rpc_app
+
+    app = rpc_app(_generator(**kwargs))
+    uvicorn.run(app, host=ctx.bind_address, port=rpc_port, log_level=ctx.log_level.lower())
+
+
+@bench_group.command(name="load")
+@_generator_options
+@click.option("-u", "--url", help="server URL (default: http://localhost:PORT)")
+@click.option("-r", "--rate", type=float, default=100.0, show_default=True, help="target requests per second")
+@click.option("-D", "--duration", type=float, default=10.0, show_default=True, help="seconds to run")
+@click.option("-o", "--output", type=click.File("w"), default="-", help="output file")
+@click.pass_obj
+def bench_load(ctx, url, rate, duration, output, **kwargs):
+    """post synthetic events to /event at a target rate on an open-loop schedule"""
+    import asyncio
+
+    from . import json
+    from .loadgen import post_events
+
+    url = url or f"http://localhost:{ctx.port}"
+    result = asyncio.run(post_events(_generator(**kwargs), url, str(ctx.api_key), rate, duration))
+    output.write(json.dumps(dict(url=url, rate=rate, duration=duration, **result.summary()), indent=2) + "\n")
+
+
 if __name__ == "__main__":
     sys.exit(cli())
@@ -1,13 +1,22 @@
 # hardhat streams API client
 
+import asyncio
+import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 
 import httpx
 
-from . import schema
-
 DEFAULT_GATEWAY = "http://localhost:8892"
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_RECONNECT_DELAY = 1.0
+DEFAULT_FEED_WAIT = 30.0
 
 logger = logging.getLogger(__name__)
 
@@ -16,14 +25,192 @@ class HardhatStreamsError(Exception):
     pass
 
 
+class ResponseCache:
+    """LRU of GET response bodies keyed by request, revalidated by ETag"""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self.entries)}/{self.maxsize} hits={self.hits} misses={self.misses}>"
+
+    def entry(self, key):
+        """return the (etag, content) of key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            return entry
+
+    def revalidated(self, key, entry):
+        """return the content of entry, revalidated for key by a 304; it is cached again if evicted meanwhile"""
+        with self.lock:
+            self.entries.setdefault(key, entry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, etag, content):
+        with self.lock:
+            self.entries[key] = (etag, content)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class EventSourceParser:
+    """assemble server-sent event lines into (id, data) events"""
+
+    def __init__(self):
+        self.id = None
+        self.data = []
+
+    def feed(self, line):
+        """return (id, data) when line completes an event, otherwise None"""
+        if not line:
+            if not self.data:
+                return None
+            event = (self.id, "\n".join(self.data))
+            self.data = []
+            return event
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "id":
+            self.id = value
+        elif field == "data":
+            self.data.append(value)
+        return None
+
+
+class HardhatStreamsSession:
+    """a pooled keep-alive httpx.Client, opened on first use and shared by the API groups"""
+
+    def __init__(self, timeout=None, pool_size=None, keepalive_expiry=None, http2=None):
+        env = os.environ.get
+        if timeout is None:
+            timeout = float(env("HARDHAT_EVENTS_TIMEOUT", DEFAULT_TIMEOUT))
+        if pool_size is None:
+            pool_size = int(env("HARDHAT_EVENTS_POOL_SIZE", DEFAULT_POOL_SIZE))
+        if keepalive_expiry is None:
+            keepalive_expiry = float(env("HARDHAT_EVENTS_KEEPALIVE", DEFAULT_KEEPALIVE_EXPIRY))
+        if http2 is None:
+            http2 = env("HARDHAT_EVENTS_HTTP2", "").lower() in ("1", "true", "yes")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.lock = threading.Lock()
+        self.client = None
+
+    def __repr__(self):
+        state = "open" if self.client else "closed"
+        return f"<{self.__class__.__name__} {state} pool={self.pool_size} http2={self.http2}>"
+
+    def __getattr__(self, name):
+        # only reached for names the session lacks; before __init__ has run
+        # (copy, pickle) there is no client to open, so fail rather than recurse
+        if name.startswith("_") or "lock" not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.open(), name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, exc, tb):
+        self.close()
+
+    def limits(self):
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _client(self):
+        return httpx.Client(timeout=self.timeout, limits=self.limits(), http2=self.http2)
+
+    def open(self):
+        client = self.client
+        if client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self._client()
+                client = self.client
+        return client
+
+    def close(self):
+        with self.lock:
+            client, self.client = self.client, None
+        if client is not None:
+            client.close()
+
+
+class AsyncHardhatStreamsSession(HardhatStreamsSession):
+    """a pooled keep-alive httpx.AsyncClient, opened on first use"""
+
+    def _client(self):
+        return httpx.AsyncClient(timeout=self.timeout, limits=self.limits(), http2=self.http2)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        with self.lock:
+            client, self.client = self.client, None
+        if client is not None:
+            await client.aclose()
+
+
 class HardhatStreamsBase:
-    def __init__(self, url=None, requests=None):
+    session_class = HardhatStreamsSession
+
+    def __init__(self, url=None, requests=None, cache_size=None, **options):
         self.url = url or os.environ.get("HARDHAT_EVENTS_GATEWAY", DEFAULT_GATEWAY)
-        self.requests = requests or httpx
+        self.owned = requests is None
+        self.requests = requests or self.session_class(**options)
+        self.headers = {}
+        if cache_size is None:
+            cache_size = int(os.environ.get("HARDHAT_EVENTS_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+        self.cache = ResponseCache(cache_size) if cache_size else None
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {hex(id(self))}>"
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.owned:
+            self.requests.close()
+
+    def _headers(self, api_key):
+        headers = self.headers.get(api_key)
+        if headers is None:
+            headers = self.headers[api_key] = {"x-api-key": api_key, "content-type": "application/json"}
+        return headers
+
     def post(self, api_key, path, **kwargs):
         return self.request(api_key, self.requests.post, path, **kwargs)
 
@@ -34,22 +221,62 @@ class HardhatStreamsBase:
         return self.request(api_key, self.requests.delete, path, **kwargs)
 
     def get(self, api_key, path, **kwargs):
-        return self.request(api_key, self.requests.get, path, **kwargs)
+        return self.request(api_key, self.requests.get, path, cache=True, **kwargs)
 
     def request(self, api_key, func, path, **kwargs):
         paged = kwargs.pop("paged", False)
-        kwargs["headers"] = {"x-api-key": api_key, "content-type": "application/json"}
+        key, entry = self._prepare(api_key, path, kwargs)
         response = func(self.url + path, **kwargs)
-        return self.check(response, paged)
-
-    def check(self, response, paged):
-        try:
-            response.raise_for_status()
-        except httpx.HTTPStatusError:
+        return self.check(response, paged, key, entry)
+
+    def _prepare(self, api_key, path, kwargs):
+        """set request headers, adding If-None-Match for a cached GET; return the cache key and entry or None
+
+        The entry is the (etag, content) sent for revalidation, kept by the caller
+        so a 304 is answered from it even if the cache evicts the key meanwhile.
+        """
+        cache = kwargs.pop("cache", False)
+        kwargs["headers"] = self._headers(api_key)
+        if not (cache and self.cache):
+            return None, None
+        key = (api_key, path, repr(kwargs.get("params")), repr(kwargs.get("json")))
+        entry = self.cache.entry(key)
+        if entry:
+            kwargs["headers"] = dict(kwargs["headers"], **{"if-none-match": entry[0]})
+        return key, entry
+
+    def _subscribe_headers(self, api_key, cursor):
+        headers = dict(self._headers(api_key), accept="text/event-stream")
+        if cursor is not None:
+            headers["last-event-id"] = str(cursor)
+        return headers
+
+    def check_stream(self, response):
+        """raise HardhatStreamsError for a failed streaming response, whose body has been read"""
+        if response.is_error:
             msg = f"{response} {response.text}"
-            logger.exception(msg)
+            logger.error(msg)
             raise HardhatStreamsError(msg)
-        result = response.json()
+
+    def check(self, response, paged, key=None, entry=None):
+        content = None
+        if key is not None:
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                if entry is not None:
+                    content = self.cache.revalidated(key, entry)
+            elif response.headers.get("etag"):
+                self.cache.put(key, response.headers["etag"], response.content)
+            else:
+                self.cache.discard(key)
+        if content is None:
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError:
+                msg = f"{response} {response.text}"
+                logger.exception(msg)
+                raise HardhatStreamsError(msg)
+            content = response.content
+        result = json.loads(content)
         if paged:
             result = dict(result=result, cursor="", total=len(result))
         return result
@@ -58,11 +285,15 @@ class HardhatStreamsBase:
 class HardhatEventsStreams(HardhatStreamsBase):
     def create_stream(self, api_key, body):
         """create a stream"""
+        from . import schema
+
         stream = schema.EventStream(**body)
         return self.post(api_key, "/stream", content=stream.json())
 
     def update_stream(self, api_key, params, body):
         """modify a stream"""
+        from . import schema
+
         stream_id = params["id"]
         stream = schema.EventStream(**body)
         stream.streamId = stream_id
@@ -74,6 +305,8 @@ class HardhatEventsStreams(HardhatStreamsBase):
         return self.post(api_key, f"/stream/{stream_id}/delete")
 
     def _addresses(self, body):
+        from . import schema
+
         address = body["address"]
         if not isinstance(address, list):
             address = [address]
@@ -93,6 +326,8 @@ class HardhatEventsStreams(HardhatStreamsBase):
 
     def update_stream_status(self, api_key, params, body):
         """change a stream status"""
+        from . import schema
+
         stream_id = params["id"]
         request = schema.StreamStatus(status=body["status"])
         return self.post(api_key, f"/stream/{stream_id}/status", content=request.json())
@@ -111,17 +346,38 @@ class HardhatEventsStreams(HardhatStreamsBase):
         stream_id = params["id"]
         return self.get(api_key, f"/stream/{stream_id}/addresses")
 
+    def subscribe(self, api_key, params, cursor=None, reconnect_delay=DEFAULT_RECONNECT_DELAY):
+        """yield (cursor, update) for each stream update as it is dispatched, reconnecting after cursor if dropped"""
+        url = self.url + f"/stream/{params['id']}/subscribe"
+        while True:
+            try:
+                with self.requests.stream("GET", url, headers=self._subscribe_headers(api_key, cursor)) as response:
+                    if response.is_error:
+                        response.read()
+                        self.check_stream(response)
+                    parser = EventSourceParser()
+                    for line in response.iter_lines():
+                        event = parser.feed(line)
+                        if event:
+                            cursor = int(event[0])
+                            yield cursor, json.loads(event[1])
+            except httpx.TransportError as exc:
+                logger.warning(f"subscription to {params['id']} dropped: {exc.__class__.__name__}: {exc}")
+            time.sleep(reconnect_delay)
+
 
 class HardhatEventsHistory(HardhatStreamsBase):
     def get_history(self, api_key, params):
         """get stream history"""
-        options = dict(exclude_payload=params["excludePayload"])
-        return self.get(api_key, "/history", paged=True, json=options)
+        options = {
+            k: str(params[k]) for k in ("excludePayload", "id", "streamId", "limit") if params.get(k) is not None
+        }
+        return self.get(api_key, "/history", paged=True, params=options)
 
     def replay_history(self, api_key, params):
         """request history replay"""
-        ids = dict(stream=params["streamId"], history=params["id"])
-        return self.post(api_key, "/history/replay", paged=True, json=ids)
+        ids = dict(streamId=str(params["streamId"]), id=str(params["id"]))
+        return self.post(api_key, "/history/replay", json=ids)
 
 
 class HardhatEventsProject(HardhatStreamsBase):
@@ -142,20 +398,218 @@ class HardhatEventsStats(HardhatStreamsBase):
     def get_stats_by_stream_id(self, api_key, params):
         """return stream stats"""
         stream_id = params["id"]
-        return self.get(api_key, f"stats/{stream_id}")
+        return self.get(api_key, f"/stats/{stream_id}")
+
+
+class HardhatEventsFeed(HardhatStreamsBase):
+    def get_events(self, api_key, since=None, wait=None, limit=None, first_block=None, last_block=None):
+        """return the events after the since cursor within a block range, waiting up to wait seconds for new events"""
+        params = dict(since=since, wait=wait, limit=limit, first_block=first_block, last_block=last_block)
+        params = {k: v for k, v in params.items() if v is not None}
+        kwargs = {}
+        if wait:
+            # the server holds the request open for up to wait seconds
+            kwargs["timeout"] = httpx.Timeout(DEFAULT_TIMEOUT, read=DEFAULT_TIMEOUT + wait)
+        return self.request(api_key, self.requests.get, "/events", params=params, **kwargs)
+
+    def tail_events(self, api_key, since=0, wait=DEFAULT_FEED_WAIT, limit=None):
+        """yield events as they are stored, starting after the since cursor"""
+        while True:
+            for event in self.get_events(api_key, since, wait, limit):
+                since = event["id"]
+                yield event
+
+
+class HardhatEventsAdmin(HardhatStreamsBase):
+    def get_profiles(self, api_key, limit=None):
+        """return the slowest profiled request profiles"""
+        params = dict(limit=limit) if limit else {}
+        return self.get(api_key, "/admin/profiles", params=params)
+
+    def clear_profiles(self, api_key):
+        """discard the kept request profiles"""
+        return self.delete(api_key, "/admin/profiles")
 
 
 class HardhatStreams:
-    def __init__(self, url, requests):
-        self.evm_streams = HardhatEventsStreams(url, requests)
-        self.history = HardhatEventsHistory(url, requests)
-        self.project = HardhatEventsProject(url, requests)
-        self.stats = HardhatEventsStats(url, requests)
+    session_class = HardhatStreamsSession
+    evm_streams_class = HardhatEventsStreams
+    history_class = HardhatEventsHistory
+    project_class = HardhatEventsProject
+    stats_class = HardhatEventsStats
+    feed_class = HardhatEventsFeed
+    admin_class = HardhatEventsAdmin
+
+    def __init__(self, url, requests, cache_size=None, **options):
+        self.owned = requests is None
+        self.requests = requests or self.session_class(**options)
+        self.evm_streams = self.evm_streams_class(url, self.requests, cache_size=cache_size)
+        self.history = self.history_class(url, self.requests, cache_size=cache_size)
+        self.project = self.project_class(url, self.requests, cache_size=cache_size)
+        self.stats = self.stats_class(url, self.requests, cache_size=cache_size)
+        self.feed = self.feed_class(url, self.requests, cache_size=cache_size)
+        self.admin = self.admin_class(url, self.requests, cache_size=cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.owned:
+            self.requests.close()
 
 
 class HardhatEventStreams:
-    def __init__(self, url=None, requests=None):
-        self.streams = HardhatStreams(url, requests)
+    def __init__(self, url=None, requests=None, **options):
+        self.streams = HardhatStreams(url, requests, **options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _, exc, tb):
+        self.close()
+
+    def close(self):
+        self.streams.close()
+
+
+class AsyncHardhatStreamsBase(HardhatStreamsBase):
+    """asyncio variant of HardhatStreamsBase; API methods return coroutines"""
+
+    session_class = AsyncHardhatStreamsSession
+
+    def __init__(self, url=None, requests=None, concurrency=None, **options):
+        super().__init__(url, requests, **options)
+        self.concurrency = concurrency or getattr(self.requests, "pool_size", DEFAULT_POOL_SIZE)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        if self.owned:
+            await self.requests.aclose()
+
+    async def request(self, api_key, func, path, **kwargs):
+        paged = kwargs.pop("paged", False)
+        key, entry = self._prepare(api_key, path, kwargs)
+        response = await func(self.url + path, **kwargs)
+        return self.check(response, paged, key, entry)
+
+    async def gather(self, calls, concurrency=None, return_exceptions=False):
+        """await the coroutines in calls with at most concurrency in flight, returning results in order"""
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def _call(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(*[_call(coro) for coro in calls], return_exceptions=return_exceptions)
+
+
+class AsyncHardhatEventsStreams(AsyncHardhatStreamsBase, HardhatEventsStreams):
+    async def subscribe(self, api_key, params, cursor=None, reconnect_delay=DEFAULT_RECONNECT_DELAY):
+        """async iterator variant of HardhatEventsStreams.subscribe"""
+        url = self.url + f"/stream/{params['id']}/subscribe"
+        while True:
+            try:
+                async with self.requests.stream(
+                    "GET", url, headers=self._subscribe_headers(api_key, cursor)
+                ) as response:
+                    if response.is_error:
+                        await response.aread()
+                        self.check_stream(response)
+                    parser = EventSourceParser()
+                    async for line in response.aiter_lines():
+                        event = parser.feed(line)
+                        if event:
+                            cursor = int(event[0])
+                            yield cursor, json.loads(event[1])
+            except httpx.TransportError as exc:
+                logger.warning(f"subscription to {params['id']} dropped: {exc.__class__.__name__}: {exc}")
+            await asyncio.sleep(reconnect_delay)
+
+    async def create_streams(self, api_key, bodies, concurrency=None):
+        """create a stream for each body concurrently"""
+        return await self.gather([self.create_stream(api_key, body) for body in bodies], concurrency)
+
+    async def delete_streams(self, api_key, stream_ids, concurrency=None):
+        """delete each stream in stream_ids concurrently"""
+        return await self.gather([self.delete_stream(api_key, dict(id=id)) for id in stream_ids], concurrency)
+
+    async def get_all_addresses(self, api_key, stream_ids=None, concurrency=None):
+        """return a dict of stream id to address list, for stream_ids or every stream"""
+        if stream_ids is None:
+            stream_ids = [stream["id"] for stream in (await self.get_streams(api_key, {}))["result"]]
+        calls = [self.get_addresses(api_key, dict(id=id)) for id in stream_ids]
+        results = await self.gather(calls, concurrency)
+        return {id: result["address"] for id, result in zip(stream_ids, results)}
+
+
+class AsyncHardhatEventsHistory(AsyncHardhatStreamsBase, HardhatEventsHistory):
+    pass
+
+
+class AsyncHardhatEventsProject(AsyncHardhatStreamsBase, HardhatEventsProject):
+    pass
+
+
+class AsyncHardhatEventsStats(AsyncHardhatStreamsBase, HardhatEventsStats):
+    async def get_all_stats(self, api_key, stream_ids, concurrency=None):
+        """return a dict of stream id to stats for each of stream_ids"""
+        calls = [self.get_stats_by_stream_id(api_key, dict(id=id)) for id in stream_ids]
+        return dict(zip(stream_ids, await self.gather(calls, concurrency)))
+
+
+class AsyncHardhatEventsFeed(AsyncHardhatStreamsBase, HardhatEventsFeed):
+    async def tail_events(self, api_key, since=0, wait=DEFAULT_FEED_WAIT, limit=None):
+        """async iterator variant of HardhatEventsFeed.tail_events"""
+        while True:
+            for event in await self.get_events(api_key, since, wait, limit):
+                since = event["id"]
+                yield event
+
+
+class AsyncHardhatEventsAdmin(AsyncHardhatStreamsBase, HardhatEventsAdmin):
+    pass
+
+
+class AsyncHardhatStreams(HardhatStreams):
+    session_class = AsyncHardhatStreamsSession
+    evm_streams_class = AsyncHardhatEventsStreams
+    history_class = AsyncHardhatEventsHistory
+    project_class = AsyncHardhatEventsProject
+    stats_class = AsyncHardhatEventsStats
+    feed_class = AsyncHardhatEventsFeed
+    admin_class = AsyncHardhatEventsAdmin
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        if self.owned:
+            await self.requests.aclose()
+
+
+class AsyncHardhatEventStreams:
+    def __init__(self, url=None, requests=None, **options):
+        self.streams = AsyncHardhatStreams(url, requests, **options)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.streams.aclose()
 
 
 streams = HardhatEventStreams()
@@ -1,19 +1,94 @@
 # db functions
 
+from sqlalchemy import inspect, literal
 from sqlalchemy.exc import NoResultFound
 from sqlmodel import Session, SQLModel, create_engine, select
 
-from .settings import DATABASE_URL, SQL_ECHO
 
-engine = create_engine(DATABASE_URL, echo=SQL_ECHO, connect_args=dict(check_same_thread=False))
+def get_engine():
+    """return the database engine, created on first use rather than at import"""
+    global engine
+    if "engine" not in globals():
+        from .settings import DATABASE_URL, SQL_ECHO
+
+        engine = create_engine(DATABASE_URL, echo=SQL_ECHO, connect_args=dict(check_same_thread=False))
+    return engine
+
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def init_db():
+    engine = get_engine()
     SQLModel.metadata.create_all(engine)
+    migrate(engine)
+
+
+def _column_ddl(column, dialect):
+    ddl = f"{dialect.identifier_preparer.format_column(column)} {column.type.compile(dialect=dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is not None:
+        value = literal(default, column.type).compile(dialect=dialect, compile_kwargs=dict(literal_binds=True))
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def _missing_autoincrement(connection, table):
+    """return True if table is a sqlite table created without the AUTOINCREMENT its model asks for"""
+    if connection.dialect.name != "sqlite" or not table.dialect_options["sqlite"]["autoincrement"]:
+        return False
+    sql = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+    ).scalar()
+    return "AUTOINCREMENT" not in sql.upper()
+
+
+def _rebuild(connection, table):
+    """recreate a table from its model, copying its rows"""
+    preparer = connection.dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    old_name = preparer.quote(f"_{table.name}_old")
+    connection.exec_driver_sql(f"ALTER TABLE {table_name} RENAME TO {old_name}")
+    for index in table.indexes:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {preparer.quote(index.name)}")
+    table.create(connection)
+    columns = ", ".join(preparer.format_column(column) for column in table.columns)
+    connection.exec_driver_sql(f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {old_name}")
+    connection.exec_driver_sql(f"DROP TABLE {old_name}")
+
+
+def migrate(engine):
+    """add the columns and indexes of existing tables that create_all does not, safe to repeat
+
+    Columns are added nullable unless they have a scalar default to fill
+    existing rows with.  A sqlite table whose model gained sqlite_autoincrement
+    is rebuilt with it, keeping its rows.
+    """
+    dialect = engine.dialect
+    with engine.begin() as connection:
+        # reflect through the migrating connection; a pooled one may share its DBAPI connection and roll it back
+        inspector = inspect(connection)
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = set(column["name"] for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in columns:
+                    table_name = dialect.identifier_preparer.format_table(table)
+                    connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {_column_ddl(column, dialect)}")
+            if _missing_autoincrement(connection, table):
+                _rebuild(connection, table)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
 
 
 def get_db():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         with CRUD(session) as db:
             yield db
 
@@ -34,18 +109,27 @@ class CRUD:
         self.session.refresh(record)
         return record
 
+    def create_all(self, records):
+        """add records in a single transaction"""
+        self.session.add_all(records)
+        self.session.commit()
+        return len(records)
+
     def read_one(self, table, *where, allow_none=False):
         return self.read(table, *where, one=True, allow_none=allow_none)
 
-    def read_all(self, table, *where, allow_none=False):
-        return self.read(table, *where, one=False, allow_none=allow_none)
+    def read_all(self, table, *where, allow_none=False, order_by=None, limit=None):
+        return self.read(table, *where, one=False, allow_none=allow_none, order_by=order_by, limit=limit)
 
-    def read(self, table, *where, one=None, allow_none=False):
+    def read(self, table, *where, one=None, allow_none=False, order_by=None, limit=None):
+        statement = select(table)
         if len(where):
-            statement = select(table).where(*where)
-            results = self.session.exec(statement)
-        else:
-            results = self.session.exec(select(table))
+            statement = statement.where(*where)
+        if order_by is not None:
+            statement = statement.order_by(order_by)
+        if limit is not None:
+            statement = statement.limit(limit)
+        results = self.session.exec(statement)
         try:
             if one:
                 return results.one()
@@ -59,6 +143,13 @@ class CRUD:
                     return []
             raise exc from exc
 
+    def read_values(self, columns, *where):
+        """return rows of the selected columns, without loading full records"""
+        statement = select(*columns)
+        if len(where):
+            statement = statement.where(*where)
+        return self.session.exec(statement).all()
+
     def upsert(self, record):
         return self.update(record, allow_none=True)
 
@@ -0,0 +1,204 @@
+# event log decoder
+
+"""decode matched logs with the event ABIs of their streams
+
+Each event ABI entry is compiled once into an EventDecoder, registered under
+(abi hash, topic0) where the abi hash identifies a stream's complete ABI
+list, so streams with identical ABIs share decoders.  Decoders are evicted
+when the last stream using an ABI is deleted.  The DecodeStage dispatcher
+stage decodes every matched log of a block in one batch, once per distinct
+ABI, and adds the result to the shared payload of each group.
+"""
+
+import asyncio
+import hashlib
+import logging
+
+from eth_abi import decode
+from eth_utils import (
+    event_abi_to_log_topic,
+    event_signature_to_log_topic,
+    to_bytes,
+    to_checksum_address,
+    to_hex,
+)
+
+from . import json
+
+logger = logging.getLogger(__name__)
+
+
+def _hashed(abi_type):
+    """indexed parameters of dynamic and tuple types are logged as the keccak hash of the value"""
+    return abi_type in ("string", "bytes") or abi_type.startswith("(") or abi_type.endswith("]")
+
+
+def topic_hash(value):
+    """return the lowercase hex topic0 hash of an event signature or topic0 hex string"""
+    value = value.strip()
+    if value.startswith("0x") and len(value) == 66:
+        return value.lower()
+    return to_hex(event_signature_to_log_topic(value.replace(" ", "")))
+
+
+def abi_hash(abi):
+    """return a stable hash of a list of ABI entries"""
+    if not abi:
+        return None
+    encoded = json.dumps(abi, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def canonical_type(input):
+    """return the canonical type string of an ABI input, with tuple components expanded"""
+    if input["type"].startswith("tuple"):
+        components = ",".join(canonical_type(component) for component in input.get("components", []))
+        return f"({components}){input['type'][5:]}"
+    return input["type"]
+
+
+def payload_value(abi_type, value):
+    """return a decoded ABI value in its JSON payload form"""
+    if isinstance(value, (list, tuple)):
+        return [payload_value(None, v) for v in value]
+    if isinstance(value, bytes):
+        return to_hex(value)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        # large integers are strings, as in the rest of the payload
+        return str(value)
+    if abi_type == "address":
+        return to_checksum_address(value)
+    return value
+
+
+class EventDecoder:
+    """an event ABI entry compiled for decoding its logs"""
+
+    def __init__(self, entry):
+        inputs = entry.get("inputs", [])
+        self.name = entry.get("name", "")
+        self.topic0 = to_hex(event_abi_to_log_topic(dict(entry, inputs=inputs)))
+        self.names = [input.get("name") or f"arg{i}" for i, input in enumerate(inputs)]
+        self.indexed = [(i, canonical_type(input)) for i, input in enumerate(inputs) if input.get("indexed")]
+        self.unindexed = [(i, canonical_type(input)) for i, input in enumerate(inputs) if not input.get("indexed")]
+        self.data_types = [abi_type for _, abi_type in self.unindexed]
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name} {self.topic0}>"
+
+    def decode(self, log):
+        """return dict(name, args) for log, or None if the log does not fit this event"""
+        topics = log["topics"][1:]
+        if len(topics) != len(self.indexed):
+            return None
+        values = [None] * len(self.names)
+        for (i, abi_type), topic in zip(self.indexed, topics):
+            if _hashed(abi_type):
+                values[i] = topic
+            else:
+                values[i] = payload_value(abi_type, decode([abi_type], to_bytes(hexstr=topic))[0])
+        data = decode(self.data_types, to_bytes(hexstr=log["data"] or "0x"))
+        for (i, abi_type), value in zip(self.unindexed, data):
+            values[i] = payload_value(abi_type, value)
+        return dict(name=self.name, args=dict(zip(self.names, values)))
+
+
+class DecoderRegistry:
+    """EventDecoders keyed by (abi hash, topic0), shared by the streams using each ABI"""
+
+    def __init__(self):
+        self.decoders = {}
+        self.streams = {}
+        self.compiled = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} abis={len(self.streams)} decoders={len(self.decoders)}>"
+
+    def register(self, route):
+        if route.abi_hash is None:
+            return
+        streams = self.streams.setdefault(route.abi_hash, set())
+        if not streams:
+            for entry in route.abi:
+                if entry.get("type") != "event" or entry.get("anonymous"):
+                    continue
+                try:
+                    decoder = EventDecoder(entry)
+                except Exception as exc:
+                    logger.warning(f"{route} invalid event abi {entry.get('name')}: {exc}")
+                    continue
+                self.decoders[(route.abi_hash, decoder.topic0)] = decoder
+                self.compiled += 1
+        streams.add(route.id)
+
+    def evict(self, stream_id):
+        """remove stream_id, dropping the decoders of any ABI no longer in use"""
+        for hash, streams in list(self.streams.items()):
+            streams.discard(stream_id)
+            if not streams:
+                del self.streams[hash]
+                for key in [key for key in self.decoders if key[0] == hash]:
+                    del self.decoders[key]
+
+    def reload(self, routes):
+        """register the ABIs of the current routes and evict those of deleted streams"""
+        current = {route.id: route for route in routes.values()}
+        registered = {stream_id: hash for hash, streams in self.streams.items() for stream_id in streams}
+        for stream_id, hash in registered.items():
+            if stream_id not in current or current[stream_id].abi_hash != hash:
+                self.evict(stream_id)
+        for route in current.values():
+            if route.abi_hash not in self.streams or route.id not in self.streams[route.abi_hash]:
+                self.register(route)
+
+    def decode(self, hash, logs):
+        """return a dict of logIndex to decoded event for the logs with a decoder under hash"""
+        decoded = {}
+        for log in logs:
+            topics = log["topics"]
+            decoder = self.decoders.get((hash, topics[0].lower())) if topics else None
+            if decoder is None:
+                continue
+            try:
+                result = decoder.decode(log)
+            except Exception as exc:
+                logger.debug(f"{decoder} failed to decode log {log['logIndex']}: {exc}")
+                continue
+            if result is not None:
+                decoded[log["logIndex"]] = result
+        return decoded
+
+    def decode_batch(self, batch):
+        """return a dict of abi hash to decoded logs for a dict of abi hash to logs"""
+        return {hash: self.decode(hash, logs) for hash, logs in batch.items()}
+
+
+class DecodeStage:
+    """dispatcher stage adding decoded events to each payload"""
+
+    def __init__(self, registry=None):
+        self.registry = registry or DecoderRegistry()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.registry}>"
+
+    async def reload(self, routes):
+        self.registry.reload(routes)
+
+    async def __call__(self, block, groups, payloads):
+        batch = {}
+        for key, (logs, routes) in groups.items():
+            hash = routes[0].abi_hash
+            if hash is not None:
+                batch.setdefault(hash, {}).update((log["logIndex"], log) for log in logs)
+        if not batch:
+            return
+        decoded = await asyncio.to_thread(
+            self.registry.decode_batch, {hash: list(logs.values()) for hash, logs in batch.items()}
+        )
+        for key, (logs, routes) in groups.items():
+            hash = routes[0].abi_hash
+            if hash in decoded:
+                payloads[key].decoded = decoded[hash]
@@ -0,0 +1,604 @@
+# webhook delivery
+
+"""deliver stream updates to webhooks
+
+DeliveryQueue keeps an outbox of pending updates per stream and flushes each
+outbox as one webhook request.  All matches for a stream within a block are
+already a single update; with WEBHOOK_BATCH_BLOCKS set, updates for several
+blocks are coalesced into one request whose body is a JSON array of
+updates, bounded by WEBHOOK_LINGER seconds and WEBHOOK_BATCH_BYTES.  Each
+stream has at most one request in flight, so updates that arrive while a
+slow webhook is busy are batched into its next request.
+
+Each outbox holds at most WEBHOOK_QUEUE_SIZE updates in memory; beyond that,
+updates spill to the SpilledUpdate table and are paged back in order as the
+outbox drains.  A spilled update is deleted only once it has been delivered,
+so the updates paged back but not delivered before a restart are read again.
+Requests are rate limited per stream by a token bucket.  After
+WEBHOOK_BREAKER_FAILURES consecutive failures the circuit breaker sets the
+stream status to error and spills its updates, and delivery resumes from the
+spilled updates when the stream status is set back to active.
+
+The updates of paused streams spill to the SegmentSpool instead, and drain
+from it in order when the stream is set back to active.  A spooled update
+stays in the spool until it is delivered, dead-lettered or spilled again,
+when the queue acknowledges it.
+
+Failed requests are retried by a RetryScheduler without holding up the rest
+of the stream; updates that exhaust WEBHOOK_MAX_RETRIES are moved to the
+DeadLetter table, where the history API can list and replay them.
+
+The queue counts the updates of each stream it holds in memory per block, so
+settled() can tell the Checkpointer the last block with every update of a
+stream delivered or in durable storage.  Updates paged back keep their
+durable copy until delivered, so they are not counted.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+
+import httpx
+from eth_utils import keccak, to_hex
+from sqlalchemy import delete, func
+from sqlmodel import Session, select
+
+from . import db, settings
+from .dispatch import Update
+from .retry import RetryScheduler
+from .schema import DeadLetter, EventStream, EventStreamsStatusEnum, SpilledUpdate
+from .spool import SegmentSpool
+
+logger = logging.getLogger(__name__)
+
+
+def signature(body, secret):
+    """return the moralis-compatible x-signature header value: keccak256(body + secret)"""
+    return to_hex(keccak(body + secret))
+
+
+class WebhookDelivery:
+    """POST encoded ContractEventUpdate payloads to stream webhook URLs"""
+
+    def __init__(self, secret=None, timeout=None, pool_size=None):
+        secret = secret if secret is not None else settings.WEBHOOK_SECRET or str(settings.API_KEY)
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        pool_size = pool_size or settings.WEBHOOK_POOL_SIZE
+        self.client = httpx.AsyncClient(
+            timeout=timeout or settings.WEBHOOK_TIMEOUT,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self.sent = 0
+        self.failed = 0
+        self.errors = {}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} sent={self.sent} failed={self.failed}>"
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def send(self, route, updates):
+        """deliver a batch of updates for route as a single request, returning True on success"""
+        if len(updates) == 1:
+            body = updates[0].encode()
+        else:
+            body = b"[" + b",".join(update.encode() for update in updates) + b"]"
+        return await self.post(route, body)
+
+    async def post(self, route, body):
+        """sign and POST body to the route webhook, returning True on success"""
+        headers = {"content-type": "application/json", "x-signature": signature(body, self.secret)}
+        try:
+            response = await self.client.post(route.webhook_url, content=body, headers=headers)
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            self.failed += 1
+            self.errors[route.id] = f"{exc.__class__.__name__}: {exc}"
+            logger.warning(f"{route} delivery failed: {exc.__class__.__name__}: {exc}")
+            return False
+        self.sent += 1
+        return True
+
+
+class TokenBucket:
+    """request rate limiter; a rate of 0 is unlimited"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} rate={self.rate} burst={self.burst} tokens={self.tokens:.2f}>"
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """return seconds until a token is available"""
+        if not self.rate:
+            return 0.0
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+
+
+class CircuitBreaker:
+    """open after threshold consecutive failures"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self.open = False
+
+    def __repr__(self):
+        state = "open" if self.open else "closed"
+        return f"<{self.__class__.__name__} {state} failures={self.failures}/{self.threshold}>"
+
+    def record(self, success):
+        """record a request result, returning True if this failure opened the breaker"""
+        if success:
+            self.failures = 0
+            return False
+        self.failures += 1
+        if not self.open and self.failures >= self.threshold:
+            self.open = True
+            return True
+        return False
+
+    def reset(self):
+        self.failures = 0
+        self.open = False
+
+
+class Outbox:
+    """pending updates for one stream"""
+
+    def __init__(self, route, capacity, breaker_failures):
+        self.route = route
+        self.capacity = capacity
+        self.updates = []
+        self.size = 0
+        self.deadline = None
+        self.task = None
+        self.spilled = False
+        # the spilled updates are in the paused stream spool rather than the SpilledUpdate table
+        self.spooled = False
+        self.lock = asyncio.Lock()
+        self.bucket = TokenBucket(0, 1)
+        self.breaker = CircuitBreaker(breaker_failures)
+        self.configure(route)
+
+    def __repr__(self):
+        return (
+            f"<Outbox {self.route.stream_id} updates={len(self.updates)} size={self.size}"
+            f" spilled={self.spilled} breaker={self.breaker}>"
+        )
+
+    def configure(self, route):
+        """apply the stream rate limit settings of route"""
+        self.route = route
+        rate = route.webhook_rate_limit if route.webhook_rate_limit is not None else settings.WEBHOOK_RATE_LIMIT
+        burst = route.webhook_rate_burst or settings.WEBHOOK_RATE_BURST
+        if (rate, burst) != (self.bucket.rate, self.bucket.burst):
+            self.bucket = TokenBucket(rate, burst)
+
+    @property
+    def room(self):
+        return max(0, self.capacity - len(self.updates))
+
+    def add(self, update, deadline):
+        if not self.updates:
+            self.deadline = deadline
+        self.updates.append(update)
+        self.size += update.size
+
+    def ready(self, now, max_bytes):
+        return (
+            bool(self.updates)
+            and self.task is None
+            and not self.breaker.open
+            and (now >= self.deadline or self.size >= max_bytes)
+        )
+
+    def take(self, max_bytes, batch_blocks):
+        """remove and return the next batch of updates, at least one and at most max_bytes in total"""
+        count = 1
+        if batch_blocks:
+            size = self.updates[0].size
+            while count < len(self.updates) and size + self.updates[count].size <= max_bytes:
+                size += self.updates[count].size
+                count += 1
+        return self.remove(count)
+
+    def remove(self, count=None):
+        batch = self.updates[:count]
+        del self.updates[:count]
+        self.size -= sum(update.size for update in batch)
+        return batch
+
+    def requeue(self, batch, deadline):
+        """return a batch to the head of the outbox"""
+        self.updates[:0] = batch
+        self.size += sum(update.size for update in batch)
+        self.deadline = deadline
+
+
+class UpdateStore:
+    """durable overflow storage for stream updates"""
+
+    def __init__(self):
+        # stream id to the ids of the rows taken for delivery and not yet acknowledged
+        self.taken = {}
+
+    def write(self, updates):
+        with Session(db.engine) as session:
+            session.add_all(
+                [
+                    SpilledUpdate(
+                        stream_id=update.route.id,
+                        block_number=update.block_number,
+                        confirmed=update.confirmed,
+                        retries=update.retries,
+                        shared=update.shared,
+                    )
+                    for update in updates
+                ]
+            )
+            session.commit()
+
+    def read(self, route, limit):
+        """return up to limit of the oldest spilled updates for route not yet taken for delivery"""
+        taken = self.taken.setdefault(route.id, set())
+        with Session(db.engine) as session:
+            statement = (
+                select(SpilledUpdate)
+                .where(SpilledUpdate.stream_id == route.id)
+                .order_by(SpilledUpdate.id)
+                .limit(limit + len(taken))
+            )
+            rows = [row for row in session.exec(statement).all() if row.id not in taken][:limit]
+        taken.update(row.id for row in rows)
+        return [
+            Update(route, row.shared, row.block_number, row.confirmed, row.retries, stored=(self, row.id))
+            for row in rows
+        ]
+
+    def acknowledge(self, updates):
+        """delete the spilled updates that were delivered"""
+        ids = [update.stored[1] for update in updates]
+        with Session(db.engine) as session:
+            session.execute(delete(SpilledUpdate).where(SpilledUpdate.id.in_(ids)))
+            session.commit()
+        for update in updates:
+            self.taken.get(update.route.id, set()).discard(update.stored[1])
+
+    def dead_letter(self, updates, error):
+        now = datetime.now()
+        with Session(db.engine) as session:
+            session.add_all(
+                [
+                    DeadLetter(
+                        stream_id=update.route.id,
+                        block_number=update.block_number,
+                        confirmed=update.confirmed,
+                        retries=update.retries,
+                        shared=update.shared,
+                        error=error,
+                        created=now,
+                    )
+                    for update in updates
+                ]
+            )
+            session.commit()
+
+    def streams(self):
+        """return the ids of streams with spilled updates not yet taken for delivery"""
+        with Session(db.engine) as session:
+            statement = select(SpilledUpdate.stream_id, func.count(SpilledUpdate.id)).group_by(SpilledUpdate.stream_id)
+            rows = session.exec(statement).all()
+        return set(stream_id for stream_id, count in rows if count > len(self.taken.get(stream_id, ())))
+
+    def discard(self, stream_id):
+        with Session(db.engine) as session:
+            session.execute(delete(SpilledUpdate).where(SpilledUpdate.stream_id == stream_id))
+            session.commit()
+        self.taken.pop(stream_id, None)
+
+    def set_error(self, stream_id, message):
+        with Session(db.engine) as session:
+            stream = session.get(EventStream, stream_id)
+            if stream is not None:
+                stream.status = EventStreamsStatusEnum.ERROR.value
+                stream.statusMessage = message
+                stream.version = (stream.version or 0) + 1
+                session.add(stream)
+                session.commit()
+
+
+class DeliveryQueue:
+    """per-stream outboxes flushed by a background task through a WebhookDelivery sender"""
+
+    def __init__(
+        self,
+        sender=None,
+        linger=None,
+        max_bytes=None,
+        batch_blocks=None,
+        capacity=None,
+        breaker_failures=None,
+        store=None,
+        spool=None,
+    ):
+        self.sender = sender or WebhookDelivery()
+        self.linger = settings.WEBHOOK_LINGER if linger is None else linger
+        self.max_bytes = max_bytes or settings.WEBHOOK_BATCH_BYTES
+        self.batch_blocks = settings.WEBHOOK_BATCH_BLOCKS if batch_blocks is None else batch_blocks
+        self.capacity = capacity or settings.WEBHOOK_QUEUE_SIZE
+        self.breaker_failures = breaker_failures or settings.WEBHOOK_BREAKER_FAILURES
+        self.store = store or UpdateStore()
+        self.spool = spool or SegmentSpool()
+        self.retries = RetryScheduler(self.retry, self.dead_letter)
+        self.outboxes = {}
+        # stream id to the count of in-memory updates per block number
+        self.held = {}
+        self.wakeup = asyncio.Event()
+        self.requests = 0
+        self.delivered = 0
+        self.spills = 0
+
+    def __repr__(self):
+        pending = sum(len(outbox.updates) for outbox in self.outboxes.values())
+        return (
+            f"<{self.__class__.__name__} pending={pending} requests={self.requests}"
+            f" delivered={self.delivered} spills={self.spills} retries={len(self.retries)}>"
+        )
+
+    def outbox(self, route):
+        outbox = self.outboxes.get(route.id)
+        if outbox is None:
+            outbox = self.outboxes[route.id] = Outbox(route, self.capacity, self.breaker_failures)
+            if not route.active:
+                outbox.breaker.open = True
+        return outbox
+
+    def _hold(self, updates):
+        for update in updates:
+            self.held.setdefault(update.route.id, Counter())[update.block_number] += 1
+
+    def _release(self, updates):
+        """stop counting updates that were delivered or written to durable storage"""
+        for update in updates:
+            held = self.held.get(update.route.id)
+            # updates paged back from durable storage are not counted
+            if held is None or update.stored is not None:
+                continue
+            held[update.block_number] -= 1
+            if held[update.block_number] <= 0:
+                del held[update.block_number]
+
+    async def _acknowledge(self, updates):
+        """remove the durable copies of paged-back updates that were delivered or stored again"""
+        stored = {}
+        for update in updates:
+            if update.stored is not None:
+                stored.setdefault(update.stored[0], []).append(update)
+        for store, acknowledged in stored.items():
+            await asyncio.to_thread(store.acknowledge, acknowledged)
+
+    def settled(self, stream_id, head):
+        """return the last block up to head with every update of a stream delivered or in durable storage"""
+        held = self.held.get(stream_id)
+        return min(held) - 1 if held else head
+
+    async def reload(self, routes):
+        """apply a reloaded routing table: drop deleted streams, recover streams set back to active"""
+        for store in (self.spool, self.store):
+            for stream_id in await asyncio.to_thread(store.streams):
+                if stream_id in routes:
+                    outbox = self.outbox(routes[stream_id])
+                    if not outbox.spilled:
+                        outbox.spilled = True
+                        outbox.spooled = store is self.spool
+                elif stream_id not in self.outboxes:
+                    await asyncio.to_thread(store.discard, stream_id)
+        for stream_id, outbox in list(self.outboxes.items()):
+            route = routes.get(stream_id)
+            if route is None:
+                del self.outboxes[stream_id]
+                self.held.pop(stream_id, None)
+                for store in (self.spool, self.store):
+                    await asyncio.to_thread(store.discard, stream_id)
+                continue
+            outbox.configure(route)
+            if outbox.breaker.open and route.active:
+                logger.info(f"{route} is active, resuming delivery")
+                outbox.breaker.reset()
+                outbox.deadline = asyncio.get_running_loop().time()
+            elif not route.active:
+                outbox.breaker.open = True
+        self.wakeup.set()
+
+    async def submit(self, updates):
+        """queue a list of Update objects for delivery, spilling what exceeds outbox capacity"""
+        deadline = asyncio.get_running_loop().time() + self.linger
+        self._hold(updates)
+        overflow = {}
+        for update in updates:
+            outbox = self.outbox(update.route)
+            if outbox.spilled or outbox.breaker.open or not outbox.room:
+                overflow.setdefault(outbox, []).append(update)
+            else:
+                outbox.add(update, deadline)
+        for outbox, spill in overflow.items():
+            await self.spill(outbox, spill)
+        self.wakeup.set()
+
+    def _store(self, outbox):
+        return self.spool if outbox.spooled else self.store
+
+    async def spill(self, outbox, updates):
+        async with outbox.lock:
+            if not outbox.spilled:
+                # a stream keeps spilling to one store until it drains, so its updates stay in order
+                outbox.spooled = outbox.route.paused
+            await asyncio.to_thread(self._store(outbox).write, updates)
+            outbox.spilled = True
+        self._release(updates)
+        await self._acknowledge(updates)
+        self.spills += len(updates)
+
+    async def _unspill(self, outbox):
+        """page spilled updates back into the outbox, oldest first; they stay in durable storage until delivered"""
+        try:
+            async with outbox.lock:
+                room = outbox.room
+                updates = await asyncio.to_thread(self._store(outbox).read, outbox.route, room)
+                if len(updates) < room:
+                    other = self.store if outbox.spooled else self.spool
+                    if outbox.route.id in await asyncio.to_thread(other.streams):
+                        outbox.spooled = not outbox.spooled
+                    else:
+                        outbox.spilled = False
+            deadline = asyncio.get_running_loop().time()
+            for update in updates:
+                outbox.add(update, deadline)
+        finally:
+            outbox.task = None
+            self.wakeup.set()
+
+    async def retry(self, outbox, batch):
+        """return a batch due for retry to its outbox, or spill it if the stream is not deliverable"""
+        if self.outboxes.get(outbox.route.id) is not outbox:
+            logger.info(f"{outbox.route} was deleted, dropping {len(batch)} updates")
+            self._release(batch)
+            await self._acknowledge(batch)
+        elif outbox.breaker.open or outbox.spilled:
+            await self.spill(outbox, batch)
+        else:
+            outbox.requeue(batch, asyncio.get_running_loop().time())
+            self.wakeup.set()
+
+    async def dead_letter(self, outbox, updates, error):
+        await asyncio.to_thread(self.store.dead_letter, updates, error)
+        self._release(updates)
+        await self._acknowledge(updates)
+
+    async def _trip(self, outbox, batch, error):
+        route = outbox.route
+        message = f"webhook failed {outbox.breaker.failures} consecutive times: {error}"
+        logger.error(f"{route} {message}")
+        await asyncio.to_thread(self.store.set_error, route.id, message)
+        for _, retry in self.retries.take(outbox):
+            batch = retry + batch
+        updates = batch + outbox.remove()
+        if updates:
+            await self.spill(outbox, updates)
+
+    def _error(self, outbox):
+        return self.sender.errors.get(outbox.route.id, "delivery failed")
+
+    async def _send(self, outbox, batch):
+        """send a batch, returning (success, error); an exception is a failed request rather than a lost batch"""
+        try:
+            if await self.sender.send(outbox.route, batch):
+                return True, None
+            return False, self._error(outbox)
+        except asyncio.CancelledError:
+            # back to the head of the outbox, where it is delivered or spilled with the rest
+            outbox.requeue(batch, asyncio.get_running_loop().time())
+            raise
+        except Exception as exc:
+            error = f"{exc.__class__.__name__}: {exc}"
+            logger.exception(f"{outbox.route} delivery failed: {error}")
+            return False, error
+
+    async def _flush(self, outbox):
+        try:
+            batch = outbox.take(self.max_bytes, self.batch_blocks)
+            outbox.bucket.take()
+            self.requests += 1
+            success, error = await self._send(outbox, batch)
+            now = asyncio.get_running_loop().time()
+            if outbox.breaker.record(success):
+                await self._trip(outbox, batch, error)
+            elif not success:
+                await self.retries.schedule(outbox, batch, error)
+            else:
+                self.delivered += len(batch)
+                self._release(batch)
+                await self._acknowledge(batch)
+                if outbox.updates:
+                    outbox.deadline = min(outbox.deadline, now)
+        finally:
+            outbox.task = None
+            self.wakeup.set()
+
+    def _schedule(self):
+        """start flushes for ready outboxes; return seconds until the next deadline, or None"""
+        now = asyncio.get_running_loop().time()
+        timeout = None
+
+        def _wait(seconds):
+            return seconds if timeout is None else min(timeout, seconds)
+
+        for outbox in self.outboxes.values():
+            if outbox.task is not None or outbox.breaker.open:
+                continue
+            if outbox.ready(now, self.max_bytes):
+                wait = outbox.bucket.wait()
+                if wait:
+                    timeout = _wait(wait)
+                else:
+                    outbox.task = asyncio.create_task(self._flush(outbox))
+            elif outbox.spilled and outbox.room >= outbox.capacity // 2:
+                outbox.task = asyncio.create_task(self._unspill(outbox))
+            elif outbox.updates:
+                timeout = _wait(max(0.0, outbox.deadline - now))
+        return timeout
+
+    async def run(self):
+        retries = asyncio.create_task(self.retries.run())
+        try:
+            await self._run()
+        finally:
+            retries.cancel()
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            timeout = self._schedule()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+
+    async def drain(self):
+        """flush every deliverable outbox until empty; failed batches are left to the retry scheduler"""
+        while True:
+            pending = [o for o in self.outboxes.values() if o.task or (o.updates and not o.breaker.open)]
+            if not pending:
+                break
+            for outbox in pending:
+                if outbox.task is None:
+                    outbox.task = asyncio.create_task(self._flush(outbox))
+            await asyncio.gather(*[outbox.task for outbox in pending if outbox.task])
+
+    async def spill_all(self):
+        """move every in-memory update, including those awaiting retry, to the durable store"""
+        for outbox, batch in self.retries.take():
+            await self.spill(outbox, batch)
+        for outbox in self.outboxes.values():
+            if outbox.updates:
+                await self.spill(outbox, outbox.remove())
+
+    async def aclose(self):
+        await self.sender.aclose()
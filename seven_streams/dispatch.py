@@ -0,0 +1,195 @@
+# event dispatcher
+
+"""build ContractEventUpdate payloads for the streams matching each block
+
+Streams that match the same logs with the same payload options share one
+encoded body; each stream's payload is that body with the stream fields
+(abi, streamId, tag, confirmed, retries) spliced in ahead of it, so fan-out
+to many streams costs a byte concatenation per stream rather than a model
+build and JSON encode.
+"""
+
+import asyncio
+import logging
+
+from . import json
+from .poller import to_int
+
+logger = logging.getLogger(__name__)
+
+
+def _log(log, **extra):
+    result = dict(
+        logIndex=str(to_int(log["logIndex"])),
+        transactionHash=log["transactionHash"],
+        address=log["address"],
+        data=log["data"],
+    )
+    # topics a log does not index are omitted rather than sent as null
+    result.update((f"topic{n}", topic) for n, topic in enumerate(log["topics"]))
+    result.update((key, value) for key, value in extra.items() if value is not None)
+    return result
+
+
+class Update:
+    """a ContractEventUpdate for one stream: a shared encoded body plus the stream fields"""
+
+    __slots__ = ("route", "shared", "block_number", "confirmed", "retries", "stored")
+
+    def __init__(self, route, shared, block_number, confirmed=True, retries=0, stored=None):
+        self.route = route
+        self.shared = shared
+        self.block_number = block_number
+        self.confirmed = confirmed
+        self.retries = retries
+        # (store, key) of the durable copy of an update paged back for delivery, removed once it is delivered
+        self.stored = stored
+
+    def __repr__(self):
+        return f"<Update {self.route.stream_id} block={self.block_number} retries={self.retries}>"
+
+    @property
+    def size(self):
+        """approximate encoded size in bytes"""
+        return len(self.route.prefix) + len(self.shared) + 32
+
+    def encode(self):
+        return self.route.header(self.confirmed, self.retries) + b"," + self.shared[1:]
+
+
+class Payload:
+    """the parts of a ContractEventUpdate shared by every stream matching the same logs"""
+
+    # the attributes holding the record types named by getNativeBalances and trigger entries
+    RECORDS = dict(
+        tx="txs",
+        erc20transfer="erc20_transfers",
+        erc20approval="erc20_approvals",
+        nfttransfer="nft_transfers",
+        internaltx="txs_internal",
+    )
+
+    def __init__(self, block, logs):
+        self.block = block
+        self.logs = logs
+        self.decoded = {}
+        self.log_triggers = {}
+        self.txs = []
+        self.txs_internal = []
+        self.erc20_transfers = []
+        self.erc20_approvals = []
+        self.nft_transfers = []
+        self.nft_approvals = dict(ERC721=[], ERC1155=[])
+        self.native_balances = None
+
+    def records(self, type):
+        """return the record dicts of a record type; log records are the decoded arguments and address"""
+        if type == "log":
+            return [
+                dict((self.decoded.get(log["logIndex"]) or {}).get("args", {}), address=log["address"])
+                for log in self.logs
+            ]
+        attribute = self.RECORDS.get(type)
+        return getattr(self, attribute) if attribute else []
+
+    def fields(self):
+        block = self.block
+        fields = dict(
+            block=dict(number=str(block.number), hash=block.hash, timestamp=str(block.timestamp)),
+            chainId=block.chain_id,
+            logs=[
+                _log(log, decoded=self.decoded.get(log["logIndex"]), triggers=self.log_triggers.get(log["logIndex"]))
+                for log in self.logs
+            ],
+            txs=self.txs,
+            txsInternal=self.txs_internal,
+            erc20Transfers=self.erc20_transfers,
+            erc20Approvals=self.erc20_approvals,
+            nftTransfers=self.nft_transfers,
+            nftApprovals=self.nft_approvals,
+        )
+        if self.native_balances is not None:
+            fields["nativeBalances"] = self.native_balances
+        return fields
+
+    def encode(self):
+        return json.dumps(self.fields(), separators=(",", ":")).encode()
+
+
+class Dispatcher:
+    """pipeline handler routing each block to matching streams and submitting their updates"""
+
+    def __init__(self, router, delivery, stages=None, confirmed=True, publisher=None, bloom=None, checkpoints=None):
+        self.router = router
+        self.delivery = delivery
+        self.publisher = publisher
+        self.bloom = bloom
+        self.checkpoints = checkpoints
+        self.stages = list(stages or [])
+        self.confirmed = confirmed
+        self.refreshed = None
+        self.dispatched = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} dispatched={self.dispatched}>"
+
+    async def __call__(self, block):
+        await self.refresh(block.number)
+        updates = await self.dispatch(block)
+        if updates:
+            await self.delivery.submit(updates)
+            if self.publisher:
+                await self.publisher.publish(updates)
+        if self.checkpoints:
+            self.checkpoints.advance(block.number)
+
+    async def refresh(self, number):
+        """reload the routing table if any stream changed, once per block"""
+        if number == self.refreshed:
+            return
+        self.refreshed = number
+        if await asyncio.to_thread(self.router.refresh):
+            await self.reload(self.router.routes)
+
+    async def reload(self, routes):
+        if self.bloom:
+            self.bloom.reload(routes)
+        if self.checkpoints:
+            self.checkpoints.reload(routes)
+        for stage in self.stages:
+            if hasattr(stage, "reload"):
+                await stage.reload(routes)
+        await self.delivery.reload(routes)
+
+    def group(self, matches):
+        """return a dict of (log indexes, payload options) to the routes sharing that payload"""
+        groups = {}
+        for route, logs in matches.items():
+            key = (tuple(log["logIndex"] for log in logs), route.payload_options)
+            groups.setdefault(key, (logs, []))[1].append(route)
+        return groups
+
+    async def dispatch(self, block):
+        """return the list of Updates for block"""
+        if self.bloom and not self.bloom.may_match(block.header):
+            # no stream can match, so the logs are not routed and the stages fetch no receipts or traces
+            return []
+        matches = self.router.match(block)
+        if self.checkpoints:
+            # streams resumed from a checkpoint skip the blocks delivered before the restart
+            matches = {
+                route: logs for route, logs in matches.items() if not self.checkpoints.delivered(route, block.number)
+            }
+        if not matches:
+            return []
+        groups = self.group(matches)
+        payloads = {key: Payload(block, logs) for key, (logs, routes) in groups.items()}
+        for stage in self.stages:
+            await stage(block, groups, payloads)
+        updates = []
+        for key, (logs, routes) in groups.items():
+            shared = payloads[key].encode()
+            for route in routes:
+                updates.append(Update(route, shared, block.number, self.confirmed))
+        self.dispatched += len(updates)
+        return updates
@@ -0,0 +1,480 @@
+# contract event storage engines
+
+"""ContractEvent storage behind one interface, selected with EVENT_STORE
+
+"database" keeps events as ContractEvent rows, written by EventIngester.
+
+"segment" keeps them in an append-only log of segment files in
+EVENT_STORE_DIRECTORY, a better fit for the append-heavy, range-read
+workload of the event endpoints.  A record is the fixed-width HEADER
+followed by the JSON encoded event data.  Records are grouped in spans of
+EVENT_STORE_INDEX_INTERVAL records, and each segment's index file holds the
+offset, id range and block number range of every complete span: a sparse
+index that finds the spans holding an id or block range without touching
+the data, which is then read through mmap a span at a time.
+
+Ids are assigned in append order, so an id read bisects the spans by id.
+While events arrive in block order, as they do from the pipeline, the spans
+are also sorted by block number and a block range read bisects to its first
+span; events posted out of order cost only the spans they overlap.  The
+records after the last indexed span are rescanned when the store is opened,
+and a record torn by a crash is cut off.  Deleted ids are appended to a
+tombstone file.  Deleting every event removes the segments but keeps the
+next id in a file of its own, so ids are never reused and a since cursor
+taken before the delete still sees every event stored after it.
+
+A duplicate of a stored (chain ID, transaction hash, log index) key has the
+same block number, so ingestion looks for stored keys only in the spans
+overlapping the block range of the batch, which for a new block is none.
+
+The segment store keeps its index in memory and has a single writer, so it
+needs a single worker deployment; the server refuses to start with
+EVENT_STORE=segment and more than one worker.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from fastapi import Depends
+from sqlalchemy import delete
+from sqlalchemy.exc import NoResultFound
+from sqlmodel import select
+
+from . import json, settings
+from .db import CRUD, get_db
+from .ingest import event_key, ingester, keyed
+from .schema import ContractEvent
+
+logger = logging.getLogger(__name__)
+
+STORES = ["database", "segment"]
+
+# id, block number, chain id, log index, data length, contract address, event hash, transaction hash
+HEADER = struct.Struct("<QqqqI20s32s32s")
+# offset, end, first id, last id, min block number, max block number, records
+SPAN = struct.Struct("<QQQQqqI")
+OFFSET, END, FIRST_ID, LAST_ID, MIN_BLOCK, MAX_BLOCK, RECORDS = range(7)
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+TOMBSTONE_FILE = "deleted"
+NEXT_ID_FILE = "next_id"
+NEXT_ID = struct.Struct("<Q")
+# stored in place of a None integer field
+NONE = -1
+
+
+class DatabaseEventStore:
+    """ContractEvent rows in the database"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {ingester}>"
+
+    def ingest(self, events):
+        """store the events not already stored, returning the number stored"""
+        return ingester.ingest(self.session, events)
+
+    def read(self, since=None, limit=None, first_block=None, last_block=None):
+        """return up to limit events after the since id and within a block range, in id order"""
+        statement = select(ContractEvent)
+        if since is not None:
+            statement = statement.where(ContractEvent.id > since)
+        if first_block is not None:
+            statement = statement.where(ContractEvent.block_number >= first_block)
+        if last_block is not None:
+            statement = statement.where(ContractEvent.block_number <= last_block)
+        statement = statement.order_by(ContractEvent.id)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return self.session.exec(statement).all()
+
+    def read_one(self, event_id):
+        event = self.session.get(ContractEvent, event_id)
+        if event is None:
+            raise NoResultFound(f"no ContractEvent with id {event_id}")
+        return event
+
+    def delete(self, event_id=None):
+        """delete an event, or every event if event_id is None, returning the number deleted"""
+        statement = delete(ContractEvent)
+        if event_id is not None:
+            statement = statement.where(ContractEvent.id == event_id)
+        count = self.session.execute(statement).rowcount
+        self.session.commit()
+        if event_id is None:
+            ingester.recent.clear()
+        return count
+
+
+def _int(value):
+    return NONE if value is None else value
+
+
+def _none(value):
+    return None if value == NONE else value
+
+
+def _record(event_id, event):
+    data = json.dumps(event.data).encode()
+    return (
+        HEADER.pack(
+            event_id,
+            _int(event.block_number),
+            _int(event.chain_id),
+            _int(event.log_index),
+            len(data),
+            bytes(event.contract_address or b""),
+            bytes(event.event_hash or b""),
+            bytes(event.txn_hash or b""),
+        )
+        + data
+    )
+
+
+def _bytes(value):
+    return value if any(value) else None
+
+
+def _event(header, data, offset):
+    event_id, block_number, chain_id, log_index, size, contract_address, event_hash, txn_hash = header
+    return ContractEvent(
+        id=event_id,
+        block_number=_none(block_number),
+        chain_id=_none(chain_id),
+        log_index=_none(log_index),
+        contract_address=_bytes(contract_address),
+        event_hash=_bytes(event_hash),
+        txn_hash=_bytes(txn_hash),
+        data=json.loads(data[offset : offset + size]),
+    )
+
+
+def _overlaps(span, first_block, last_block):
+    if first_block is None and last_block is None:
+        return True
+    if span[MAX_BLOCK] == NONE:
+        # no record of the span has a block number
+        return False
+    return (first_block is None or span[MAX_BLOCK] >= first_block) and (
+        last_block is None or span[MIN_BLOCK] <= last_block
+    )
+
+
+class EventSegment:
+    """one segment file and its sparse index of record spans"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.interval = interval
+        self.spans = []
+        self.indexed = 0
+        # every span before the open last span starts at or after the block numbers of the one before it
+        self.sorted = True
+        if os.path.exists(path + INDEX_SUFFIX):
+            with open(path + INDEX_SUFFIX, "rb") as file:
+                data = file.read()
+            for offset in range(0, len(data) - SPAN.size + 1, SPAN.size):
+                self._add_span(list(SPAN.unpack_from(data, offset)))
+            self.indexed = len(self.spans)
+        self._recover()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.path} records={len(self)} spans={len(self.spans)} size={self.size}>"
+
+    def __len__(self):
+        return sum(span[RECORDS] for span in self.spans)
+
+    @property
+    def size(self):
+        return self.spans[-1][END] if self.spans else 0
+
+    @property
+    def last_id(self):
+        return self.spans[-1][LAST_ID] if self.spans else 0
+
+    def _add_span(self, span):
+        if self.spans and not self._follows(len(self.spans) - 1):
+            self.sorted = False
+        self.spans.append(span)
+
+    def _follows(self, index):
+        """return True if the span at index has block numbers, all at or after those of the span before it"""
+        span = self.spans[index]
+        if span[MIN_BLOCK] == NONE:
+            return False
+        return index == 0 or span[MIN_BLOCK] >= self.spans[index - 1][MAX_BLOCK]
+
+    def _add(self, event_id, block_number, offset, end):
+        span = self.spans[-1] if self.spans else None
+        if span is None or span[RECORDS] >= self.interval:
+            self._add_span([offset, end, event_id, event_id, block_number, block_number, 1])
+            return
+        span[END] = end
+        span[LAST_ID] = event_id
+        span[RECORDS] += 1
+        if block_number != NONE:
+            if span[MIN_BLOCK] == NONE or block_number < span[MIN_BLOCK]:
+                span[MIN_BLOCK] = block_number
+            span[MAX_BLOCK] = max(span[MAX_BLOCK], block_number)
+
+    def _recover(self):
+        """index the records after the last indexed span, cutting off a torn record"""
+        path = self.path + SEGMENT_SUFFIX
+        if not os.path.exists(path):
+            return
+        offset = self.size
+        with open(path, "r+b") as file:
+            file.seek(offset)
+            data = file.read()
+            position = 0
+            while position + HEADER.size <= len(data):
+                header = HEADER.unpack_from(data, position)
+                end = position + HEADER.size + header[4]
+                if end > len(data):
+                    break
+                self._add(header[0], header[1], offset + position, offset + end)
+                position = end
+            if position < len(data):
+                logger.warning(f"{self}: truncating {len(data) - position} bytes of a torn record")
+                file.truncate(offset + position)
+        self._save_index()
+
+    def _save_index(self):
+        # the open last span is indexed when the next span starts
+        complete = len(self.spans) - 1
+        if complete > self.indexed:
+            with open(self.path + INDEX_SUFFIX, "ab") as file:
+                file.write(b"".join(SPAN.pack(*span) for span in self.spans[self.indexed : complete]))
+            self.indexed = complete
+
+    def append(self, records):
+        """append (event id, block number, record) tuples"""
+        offset = self.size
+        with open(self.path + SEGMENT_SUFFIX, "ab") as file:
+            if file.tell() != offset:
+                file.truncate(offset)
+                file.seek(offset)
+            file.write(b"".join(record for _, _, record in records))
+        for event_id, block_number, record in records:
+            self._add(event_id, block_number, offset, offset + len(record))
+            offset += len(record)
+        self._save_index()
+
+    def is_sorted(self):
+        return self.sorted and (not self.spans or self._follows(len(self.spans) - 1))
+
+    def select(self, since=None, first_block=None, last_block=None):
+        """return copies of the spans that may hold events after since and within a block range"""
+        spans = self.spans
+        start = 0 if since is None else bisect_right(spans, since, key=lambda span: span[LAST_ID])
+        ordered = first_block is not None and self.is_sorted()
+        if ordered:
+            start = max(start, bisect_left(spans, first_block, key=lambda span: span[MAX_BLOCK]))
+        selected = []
+        for span in spans[start:]:
+            if _overlaps(span, first_block, last_block):
+                selected.append(tuple(span))
+            elif ordered and last_block is not None and span[MIN_BLOCK] > last_block:
+                break
+        return selected
+
+    def find(self, event_id):
+        """return a copy of the span whose id range holds event_id, or None"""
+        index = bisect_left(self.spans, event_id, key=lambda span: span[LAST_ID])
+        if index < len(self.spans) and self.spans[index][FIRST_ID] <= event_id:
+            return tuple(self.spans[index])
+        return None
+
+    def records(self, spans):
+        """yield the (header, data, data offset) of each record in spans"""
+        if not spans:
+            return
+        with open(self.path + SEGMENT_SUFFIX, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for span in spans:
+                    offset = span[OFFSET]
+                    while offset < span[END]:
+                        header = HEADER.unpack_from(data, offset)
+                        yield header, data, offset + HEADER.size
+                        offset += HEADER.size + header[4]
+
+    def delete(self):
+        for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+class SegmentEventStore:
+    """append-only segment log of events with a sparse block number index"""
+
+    def __init__(self, directory=None, segment_bytes=None, interval=None):
+        self.directory = directory or settings.EVENT_STORE_DIRECTORY
+        self.segment_bytes = segment_bytes or settings.EVENT_STORE_SEGMENT_BYTES
+        self.interval = interval or settings.EVENT_STORE_INDEX_INTERVAL
+        self.lock = threading.Lock()
+        self.inserted = 0
+        self.duplicates = 0
+        self._load()
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} {self.directory} segments={len(self.segments)}"
+            f" next_id={self.next_id} inserted={self.inserted} duplicates={self.duplicates}>"
+        )
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def _load(self):
+        names = []
+        if os.path.isdir(self.directory):
+            names = sorted(n[: -len(SEGMENT_SUFFIX)] for n in os.listdir(self.directory) if n.endswith(SEGMENT_SUFFIX))
+        self.segments = [EventSegment(self._path(name), self.interval) for name in names]
+        self.next_id = max([segment.last_id for segment in self.segments], default=0) + 1
+        if os.path.exists(self._path(NEXT_ID_FILE)):
+            with open(self._path(NEXT_ID_FILE), "rb") as file:
+                data = file.read()
+            if len(data) == NEXT_ID.size:
+                self.next_id = max(self.next_id, NEXT_ID.unpack(data)[0])
+        deleted = array("Q")
+        if os.path.exists(self._path(TOMBSTONE_FILE)):
+            with open(self._path(TOMBSTONE_FILE), "rb") as file:
+                data = file.read()
+            deleted.frombytes(data[: len(data) - len(data) % deleted.itemsize])
+        self.deleted = set(deleted)
+
+    def _add_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        number = int(self.segments[-1].name) + 1 if self.segments else 0
+        self.segments.append(EventSegment(self._path(f"{number:012d}"), self.interval))
+
+    def _scan(self, since=None, first_block=None, last_block=None):
+        """yield the (header, data, data offset) of the live records that may match, in id order"""
+        for segment in self.segments:
+            if since is not None and segment.last_id <= since:
+                continue
+            for header, data, offset in segment.records(segment.select(since, first_block, last_block)):
+                if header[0] in self.deleted or (since is not None and header[0] <= since):
+                    continue
+                if first_block is not None and (header[1] == NONE or header[1] < first_block):
+                    continue
+                if last_block is not None and (header[1] == NONE or header[1] > last_block):
+                    continue
+                yield header, data, offset
+
+    def _stored_keys(self, first_block, last_block):
+        return set(
+            (_none(header[2]), bytes(header[7]), _none(header[3]))
+            for header, _, _ in self._scan(first_block=first_block, last_block=last_block)
+        )
+
+    def ingest(self, events):
+        """append the events not already stored, returning the number appended"""
+        fresh = {}
+        for index, event in enumerate(events):
+            key = event_key(keyed(event))
+            if None in key or event.block_number is None:
+                # without a complete key and block number the event cannot be recognized as a duplicate
+                fresh[index] = event
+            elif key not in fresh:
+                fresh[key] = event
+        with self.lock:
+            blocks = [event.block_number for key, event in fresh.items() if isinstance(key, tuple)]
+            if blocks:
+                stored = self._stored_keys(min(blocks), max(blocks))
+                fresh = {key: event for key, event in fresh.items() if key not in stored}
+            records = []
+            for event in fresh.values():
+                records.append((self.next_id, _int(event.block_number), _record(self.next_id, event)))
+                self.next_id += 1
+            self._append(records)
+        self.inserted += len(records)
+        self.duplicates += len(events) - len(records)
+        return len(records)
+
+    def _append(self, records):
+        size = self.segments[-1].size if self.segments else self.segment_bytes
+        pending = []
+        for record in records:
+            if size >= self.segment_bytes:
+                if pending:
+                    self.segments[-1].append(pending)
+                    pending = []
+                self._add_segment()
+                size = 0
+            pending.append(record)
+            size += len(record[2])
+        if pending:
+            self.segments[-1].append(pending)
+
+    def read(self, since=None, limit=None, first_block=None, last_block=None):
+        """return up to limit events after the since id and within a block range, in id order"""
+        with self.lock:
+            records = self._scan(since, first_block, last_block)
+            events = []
+            for header, data, offset in records:
+                if limit is not None and len(events) >= limit:
+                    break
+                events.append(_event(header, data, offset))
+            records.close()
+        return events
+
+    def read_one(self, event_id):
+        with self.lock:
+            for segment in self.segments:
+                span = segment.find(event_id)
+                if span is not None and event_id not in self.deleted:
+                    for header, data, offset in segment.records([span]):
+                        if header[0] == event_id:
+                            return _event(header, data, offset)
+        raise NoResultFound(f"no ContractEvent with id {event_id}")
+
+    def delete(self, event_id=None):
+        """delete an event, or every event if event_id is None, returning the number deleted"""
+        with self.lock:
+            if event_id is None:
+                count = sum(len(segment) for segment in self.segments) - len(self.deleted)
+                # the next id is saved before the segments go, so a crash in between never reuses an id
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._path(NEXT_ID_FILE + ".tmp"), "wb") as file:
+                    file.write(NEXT_ID.pack(self.next_id))
+                os.replace(self._path(NEXT_ID_FILE + ".tmp"), self._path(NEXT_ID_FILE))
+                for segment in self.segments:
+                    segment.delete()
+                if os.path.exists(self._path(TOMBSTONE_FILE)):
+                    os.remove(self._path(TOMBSTONE_FILE))
+                self._load()
+                return count
+            if event_id in self.deleted or not any(segment.find(event_id) for segment in self.segments):
+                return 0
+            with open(self._path(TOMBSTONE_FILE), "ab") as file:
+                file.write(array("Q", [event_id]).tobytes())
+            self.deleted.add(event_id)
+            return 1
+
+
+_segment_store = None
+
+
+def event_store(session):
+    """return the event store selected by EVENT_STORE; the database store uses session"""
+    global _segment_store
+    if settings.EVENT_STORE not in STORES:
+        raise ValueError(f"unknown event store: {settings.EVENT_STORE}")
+    if settings.EVENT_STORE == "database":
+        return DatabaseEventStore(session)
+    if _segment_store is None:
+        _segment_store = SegmentEventStore()
+    return _segment_store
+
+
+def get_event_store(db: CRUD = Depends(get_db)):
+    return event_store(db.session)
@@ -0,0 +1,66 @@
+# incremental events feed
+
+"""long-poll GET /events?since=<cursor>&wait=<seconds>
+
+Events are numbered by their ContractEvent id, which only increases, so a
+consumer passes the id of the last event it received as since and gets only
+the events after it.  With wait, a request that finds no newer events blocks
+until events are stored or wait seconds pass.
+
+Events stored by this worker (pipeline ingest on the leader, POST /event)
+notify an asyncio condition that wakes its waiting requests at once; events
+stored by another worker are found by reading again every FEED_POLL seconds.
+"""
+
+import asyncio
+import contextlib
+
+from . import settings
+
+
+class EventFeed:
+    def __init__(self, poll=None):
+        self.poll = poll or settings.FEED_POLL
+        self.generation = 0
+        self.condition = None
+        self.waiting = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} generation={self.generation} waiting={self.waiting}>"
+
+    def _condition(self):
+        # created on first use, so it belongs to the running event loop
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    async def notify(self):
+        """wake the requests waiting for new events"""
+        condition = self._condition()
+        async with condition:
+            self.generation += 1
+            condition.notify_all()
+
+    async def read(self, read, since, wait):
+        """return read(since), waiting up to wait seconds for it to return events"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        condition = self._condition()
+        while True:
+            generation = self.generation
+            events = await asyncio.to_thread(read, since)
+            remaining = deadline - loop.time()
+            if events or remaining <= 0:
+                return events
+            self.waiting += 1
+            try:
+                async with condition:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(
+                            condition.wait_for(lambda: self.generation != generation), min(remaining, self.poll)
+                        )
+            finally:
+                self.waiting -= 1
+
+
+feed = EventFeed()
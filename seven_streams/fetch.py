@@ -0,0 +1,130 @@
+# block transaction fetcher
+
+"""fill the txs payload field from one fetch of the block's transactions and receipts
+
+The transactions and receipts of a block are fetched at most once, however
+many streams and logs refer to them: with eth_getBlockByNumber (full
+transactions) and eth_getBlockReceipts in a single JSON-RPC batch where the
+node supports it, and otherwise with one batch of eth_getTransactionByHash
+and eth_getTransactionReceipt calls for the unique transaction hashes of the
+matched logs.
+"""
+
+import logging
+
+from .poller import to_int
+from .rpc import RPCError
+
+logger = logging.getLogger(__name__)
+
+
+def _int(value):
+    return None if value is None else str(to_int(value))
+
+
+def transaction(tx, receipt):
+    """return a ContractEventUpdateTransaction dict from rpc transaction and receipt objects"""
+    receipt = receipt or {}
+    return dict(
+        hash=tx["hash"],
+        gas=_int(tx.get("gas")),
+        gasPrice=_int(tx.get("gasPrice")),
+        nonce=_int(tx.get("nonce")),
+        input=tx.get("input"),
+        transactionIndex=_int(tx.get("transactionIndex")),
+        fromAddress=tx.get("from"),
+        toAddress=tx.get("to"),
+        value=_int(tx.get("value")),
+        type=_int(tx.get("type")),
+        v=_int(tx.get("v")),
+        r=tx.get("r"),
+        s=tx.get("s"),
+        receiptCumulativeGasUsed=_int(receipt.get("cumulativeGasUsed")),
+        receiptGasUsed=_int(receipt.get("gasUsed")),
+        receiptContractAddress=receipt.get("contractAddress"),
+        root=receipt.get("root"),
+        receiptStatus=_int(receipt.get("status")),
+    )
+
+
+class TransactionFetcher:
+    """block-scoped cache of transaction payload dicts by transaction hash"""
+
+    def __init__(self, rpc, block_receipts=True):
+        self.rpc = rpc
+        # cleared if the node rejects block-level fetches, falling back to per-transaction calls
+        self.block_receipts = block_receipts
+        self.block_hash = None
+        self.transactions = {}
+        self.requests = 0
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} block={self.block_hash} txs={len(self.transactions)} requests={self.requests}>"
+        )
+
+    async def _fetch_block(self, block):
+        tag = hex(block.number)
+        self.requests += 1
+        header, receipts = await self.rpc.batch(
+            [("eth_getBlockByNumber", [tag, True]), ("eth_getBlockReceipts", [tag])]
+        )
+        if header is None or receipts is None:
+            return {}
+        receipts = {receipt["transactionHash"]: receipt for receipt in receipts}
+        return {tx["hash"]: transaction(tx, receipts.get(tx["hash"])) for tx in header["transactions"]}
+
+    async def _fetch_hashes(self, hashes):
+        calls = []
+        for hash in hashes:
+            calls.append(("eth_getTransactionByHash", [hash]))
+            calls.append(("eth_getTransactionReceipt", [hash]))
+        self.requests += 1
+        results = await self.rpc.batch(calls, return_exceptions=True)
+        fetched = {}
+        for i, hash in enumerate(hashes):
+            tx, receipt = results[2 * i], results[2 * i + 1]
+            if tx is None or isinstance(tx, RPCError):
+                logger.warning(f"transaction {hash} not available: {tx}")
+                continue
+            fetched[hash] = transaction(tx, None if isinstance(receipt, RPCError) else receipt)
+        return fetched
+
+    async def get(self, block, hashes):
+        """return a dict of transaction hash to payload dict for hashes in block"""
+        if block.hash != self.block_hash:
+            self.block_hash = block.hash
+            self.transactions = {}
+        missing = [hash for hash in hashes if hash not in self.transactions]
+        if missing:
+            if self.block_receipts:
+                try:
+                    self.transactions.update(await self._fetch_block(block))
+                except RPCError as exc:
+                    logger.info(f"block receipts unavailable, fetching transactions by hash: {exc.message}")
+                    self.block_receipts = False
+                missing = [hash for hash in missing if hash not in self.transactions]
+            if missing:
+                self.transactions.update(await self._fetch_hashes(missing))
+        return {hash: self.transactions[hash] for hash in hashes if hash in self.transactions}
+
+
+class TransactionStage:
+    """dispatcher stage filling the txs field for streams with includeNativeTxs"""
+
+    def __init__(self, rpc, fetcher=None):
+        self.fetcher = fetcher or TransactionFetcher(rpc)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.fetcher}>"
+
+    async def __call__(self, block, groups, payloads):
+        wanted = [key for key, (logs, routes) in groups.items() if routes[0].include_native_txs]
+        if not wanted:
+            return
+        hashes = list(dict.fromkeys(log["transactionHash"] for key in wanted for log in groups[key][0]))
+        transactions = await self.fetcher.get(block, hashes)
+        for key in wanted:
+            txs = [transactions.get(log["transactionHash"]) for log in groups[key][0]]
+            txs = list({tx["hash"]: tx for tx in txs if tx}.values())
+            payloads[key].txs = sorted(txs, key=lambda tx: int(tx["transactionIndex"] or 0))
@@ -0,0 +1,121 @@
+# idempotent event ingestion
+
+"""store each ContractEvent once per (chain ID, transaction hash, log index)
+
+Hardhat restarts and poller retries submit the same logs again.  A unique
+index on the key makes a duplicate insert a no-op, and batches are written
+with a single INSERT ... ON CONFLICT DO NOTHING (INSERT OR IGNORE on
+sqlite), so a replayed block costs one statement.  The keys of recently
+stored events are kept in an LRU set, so obvious duplicates are dropped
+without touching the database at all.
+
+The recent keys are per worker; deleting events through the API clears
+them in the worker that served the request.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import insert
+
+from . import settings
+from .poller import to_int
+from .router import chain_id
+from .schema import ContractEvent
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("contract_address", "event_hash", "txn_hash", "chain_id", "log_index", "block_number", "data")
+
+
+def keyed(event):
+    """fill the chain_id, log_index and block_number fields of event from its data when unset"""
+    data = event.data or {}
+    if event.chain_id is None and data.get("chainId") is not None:
+        event.chain_id = chain_id(data["chainId"])
+    if event.log_index is None and data.get("logIndex") is not None:
+        event.log_index = to_int(data["logIndex"])
+    if event.block_number is None and data.get("blockNumber") is not None:
+        event.block_number = to_int(data["blockNumber"])
+    return event
+
+
+def event_key(event):
+    return (event.chain_id, bytes(event.txn_hash or b""), event.log_index)
+
+
+def _insert_ignore(dialect):
+    if dialect == "sqlite":
+        return sqlite.insert(ContractEvent).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(ContractEvent).on_conflict_do_nothing()
+    return insert(ContractEvent).prefix_with("IGNORE")
+
+
+class RecentKeys:
+    """LRU set of the keys of recently stored events"""
+
+    def __init__(self, size=None):
+        self.size = size or settings.INGEST_RECENT_KEYS
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self.keys)}/{self.size} hits={self.hits}>"
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                self.hits += 1
+                return True
+        return False
+
+    def add(self, keys):
+        with self.lock:
+            for key in keys:
+                self.keys[key] = None
+                self.keys.move_to_end(key)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+
+class EventIngester:
+    def __init__(self, recent=None):
+        self.recent = recent or RecentKeys()
+        self.inserted = 0
+        self.duplicates = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} inserted={self.inserted} duplicates={self.duplicates} {self.recent}>"
+
+    def ingest(self, session, events):
+        """insert the events not already stored, returning the number inserted"""
+        fresh = {}
+        for index, event in enumerate(events):
+            key = event_key(keyed(event))
+            if None in key:
+                # without a complete key the event cannot be recognized as a duplicate
+                fresh[index] = event
+            elif key not in fresh and key not in self.recent:
+                fresh[key] = event
+        inserted = 0
+        if fresh:
+            rows = [{column: getattr(event, column) for column in COLUMNS} for event in fresh.values()]
+            result = session.execute(_insert_ignore(session.bind.dialect.name), rows)
+            session.commit()
+            inserted = max(result.rowcount, 0)
+            self.recent.add(key for key in fresh if isinstance(key, tuple))
+        self.inserted += inserted
+        self.duplicates += len(events) - inserted
+        return inserted
+
+
+ingester = EventIngester()
@@ -0,0 +1,126 @@
+# worker leader election
+
+"""elect one server worker to run the ingestion and dispatch pipeline
+
+Each worker periodically tries to acquire or renew a named lease row in the
+database.  The holder renews it every heartbeat; if the holder stops renewing
+(crash, hang, shutdown) the lease expires and another worker takes over.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from uuid import uuid4
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from . import db, settings
+from .schema import Lease
+
+logger = logging.getLogger(__name__)
+
+
+class Leader:
+    def __init__(self, name="pipeline", ttl=None, identity=None):
+        self.name = name
+        self.ttl = ttl or settings.LEADER_LEASE
+        self.heartbeat = self.ttl / 3
+        self.identity = identity or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.expires = 0.0
+        self.is_leader = False
+
+    def __repr__(self):
+        role = "leader" if self.is_leader else "follower"
+        return f"<{self.__class__.__name__} {self.name} {self.identity} {role}>"
+
+    def acquire(self):
+        """acquire or renew the lease, returning True if this worker holds it"""
+        now = time.time()
+        with Session(db.engine) as session:
+            if session.get(Lease, self.name) is None:
+                try:
+                    session.add(Lease(name=self.name))
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+            result = session.execute(
+                update(Lease)
+                .where(Lease.name == self.name, or_(Lease.holder == self.identity, Lease.expires < now))
+                .values(holder=self.identity, expires=now + self.ttl)
+            )
+            session.commit()
+        if result.rowcount == 1:
+            self.expires = now + self.ttl
+            return True
+        return False
+
+    def release(self):
+        with Session(db.engine) as session:
+            session.execute(
+                update(Lease)
+                .where(Lease.name == self.name, Lease.holder == self.identity)
+                .values(holder="", expires=0.0)
+            )
+            session.commit()
+        self.expires = 0.0
+
+    def holder(self):
+        """return the identity of the current unexpired lease holder, or None"""
+        with Session(db.engine) as session:
+            lease = session.get(Lease, self.name)
+        if lease and lease.holder and lease.expires >= time.time():
+            return lease.holder
+        return None
+
+    async def _renew(self):
+        renewal = asyncio.ensure_future(asyncio.to_thread(self.acquire))
+        try:
+            return await asyncio.shield(renewal)
+        except asyncio.CancelledError:
+            # the thread runs on, so let it finish before the lease is released
+            await asyncio.wait([renewal])
+            raise
+        except Exception as exc:
+            logger.error(f"{self.name} lease renewal failed: {exc.__class__.__name__}: {exc}")
+            # keep leading until the lease we already hold runs out
+            return self.expires > time.time() + self.heartbeat
+
+    async def _resign(self, stop):
+        """stop leading and release the lease so another worker can take over"""
+        self.is_leader = False
+        try:
+            await stop()
+        except Exception as exc:
+            logger.error(f"{self.name} stop failed: {exc.__class__.__name__}: {exc}")
+        try:
+            await asyncio.to_thread(self.release)
+        except Exception as exc:
+            logger.error(f"{self.name} lease release failed: {exc.__class__.__name__}: {exc}")
+
+    async def run(self, start, stop):
+        """contend for the lease forever, awaiting start() on election and stop() on losing it"""
+        try:
+            while True:
+                leader = await self._renew()
+                if leader and not self.is_leader:
+                    logger.info(f"{self.identity} elected {self.name} leader")
+                    self.is_leader = True
+                    try:
+                        await start()
+                    except Exception as exc:
+                        logger.error(f"{self.name} start failed: {exc.__class__.__name__}: {exc}")
+                        await self._resign(stop)
+                elif self.is_leader and not leader:
+                    logger.warning(f"{self.identity} lost {self.name} leadership")
+                    self.is_leader = False
+                    await stop()
+                await asyncio.sleep(self.heartbeat)
+        finally:
+            if self.is_leader:
+                self.is_leader = False
+                await stop()
+                await asyncio.to_thread(self.release)
@@ -0,0 +1,482 @@
+# synthetic hardhat event load generator
+
+"""generate ContractEventUpdate-shaped blocks without a live chain
+
+Blocks can be served through a fake JSON-RPC endpoint, or their logs posted to
+the /event endpoint on an open-loop schedule.  Open-loop requests are issued at
+their scheduled time regardless of outstanding responses, and latency is
+measured from the scheduled time so a stalled server is not hidden by
+coordinated omission.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+from eth_abi import encode
+from eth_utils import event_signature_to_log_topic, keccak, to_hex
+
+from . import json
+from .bloom import logs_bloom
+from .rpc import RPCError
+
+DEFAULT_TOPIC0 = ["Transfer(address,address,uint256)", "Approval(address,address,uint256)"]
+DEFAULT_CHAIN_ID = "0x7a69"
+# ERC20 Transfer and Approval index two addresses and carry the value in data
+ERC20_TOPIC0 = frozenset(to_hex(event_signature_to_log_topic(signature)) for signature in DEFAULT_TOPIC0)
+BLOCK_GAS_LIMIT = 30_000_000
+
+logger = logging.getLogger(__name__)
+
+
+def _topic(value):
+    if value.startswith("0x") and len(value) == 66:
+        return value
+    return to_hex(event_signature_to_log_topic(value))
+
+
+def _hex(value):
+    return hex(value)
+
+
+class BlockGenerator:
+    """deterministic generator of synthetic blocks with transactions, receipts and logs"""
+
+    def __init__(
+        self,
+        addresses=None,
+        topic0=None,
+        logs_per_block=10,
+        txs_per_block=5,
+        chain_id=DEFAULT_CHAIN_ID,
+        start_block=1,
+        block_time=1.0,
+        seed=0,
+        address_count=8,
+    ):
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.addresses = [a.lower() for a in addresses] if addresses else self._addresses(address_count)
+        self.topic0 = [_topic(t) for t in (topic0 or DEFAULT_TOPIC0)]
+        self.logs_per_block = logs_per_block
+        self.txs_per_block = max(1, txs_per_block)
+        self.chain_id = chain_id
+        self.start_block = start_block
+        self.block_time = block_time
+        self.genesis_time = time.time()
+        self.blocks = {}
+        self.transactions = {}
+        self.receipts = {}
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} addresses={len(self.addresses)} topic0={len(self.topic0)}"
+            f" logs={self.logs_per_block} txs={self.txs_per_block}>"
+        )
+
+    def _addresses(self, count):
+        return [to_hex(keccak(text=f"address:{self.seed}:{n}")[-20:]) for n in range(count)]
+
+    def _hash(self, *parts):
+        return to_hex(keccak(text=":".join(str(p) for p in (self.seed,) + parts)))
+
+    def _word(self, value=None):
+        if value is None:
+            value = self.random.getrandbits(256)
+        return "0x" + value.to_bytes(32, "big").hex()
+
+    def _address_word(self, address):
+        return "0x" + address[2:].rjust(64, "0")
+
+    def block(self, number):
+        """return the rpc-shaped block for number, generating it on first reference"""
+        if number not in self.blocks:
+            self.blocks[number] = self._generate(number)
+        return self.blocks[number]
+
+    def _generate(self, number):
+        block_hash = self._hash("block", number)
+        timestamp = int(self.genesis_time + (number - self.start_block) * self.block_time)
+        txs = []
+        for index in range(self.txs_per_block):
+            tx_hash = self._hash("tx", number, index)
+            tx = {
+                "hash": tx_hash,
+                "nonce": _hex(number * self.txs_per_block + index),
+                "blockHash": block_hash,
+                "blockNumber": _hex(number),
+                "transactionIndex": _hex(index),
+                "from": self.random.choice(self.addresses),
+                "to": self.random.choice(self.addresses),
+                "value": _hex(self.random.randrange(0, 10**18)),
+                "gas": _hex(200_000),
+                "gasPrice": _hex(1_000_000_000),
+                "input": "0x",
+                "type": "0x2",
+                "v": "0x1",
+                "r": self._word(),
+                "s": self._word(),
+            }
+            txs.append(tx)
+            self.transactions[tx_hash] = tx
+
+        logs = []
+        for index in range(self.logs_per_block):
+            tx = txs[index % len(txs)]
+            topic0 = self.random.choice(self.topic0)
+            topics = [topic0, self._address_word(tx["from"]), self._address_word(tx["to"])]
+            if topic0 not in ERC20_TOPIC0:
+                topics.append(self._word(index))
+            logs.append(
+                {
+                    "address": self.random.choice(self.addresses),
+                    "topics": topics,
+                    "data": self._word(self.random.randrange(0, 10**24)),
+                    "blockNumber": _hex(number),
+                    "blockHash": block_hash,
+                    "transactionHash": tx["hash"],
+                    "transactionIndex": tx["transactionIndex"],
+                    "logIndex": _hex(index),
+                    "removed": False,
+                }
+            )
+
+        cumulative = 0
+        for tx in txs:
+            tx_logs = [log for log in logs if log["transactionHash"] == tx["hash"]]
+            gas_used = 21_000 + 30_000 * len(tx_logs)
+            cumulative += gas_used
+            self.receipts[tx["hash"]] = {
+                "transactionHash": tx["hash"],
+                "transactionIndex": tx["transactionIndex"],
+                "blockHash": block_hash,
+                "blockNumber": _hex(number),
+                "from": tx["from"],
+                "to": tx["to"],
+                "cumulativeGasUsed": _hex(cumulative),
+                "gasUsed": _hex(gas_used),
+                "effectiveGasPrice": tx["gasPrice"],
+                "contractAddress": None,
+                "logs": tx_logs,
+                "logsBloom": to_hex(logs_bloom(tx_logs)),
+                "status": "0x1",
+                "type": tx["type"],
+            }
+
+        return {
+            "number": _hex(number),
+            "hash": block_hash,
+            "parentHash": self._hash("block", number - 1),
+            "timestamp": _hex(timestamp),
+            "gasLimit": _hex(BLOCK_GAS_LIMIT),
+            "gasUsed": _hex(cumulative),
+            "logsBloom": to_hex(logs_bloom(logs)),
+            "transactions": txs,
+            "logs": logs,
+        }
+
+    def head(self):
+        """return the current head block number, advancing one block per block_time"""
+        if not self.block_time:
+            return self.start_block + len(self.blocks)
+        return self.start_block + int((time.time() - self.genesis_time) / self.block_time)
+
+    def blocks_range(self, start, count):
+        for number in range(start, start + count):
+            yield self.block(number)
+
+    def update(self, number, stream_id=None, tag="", confirmed=False):
+        """return block number as a ContractEventUpdate-shaped dict"""
+        block = self.block(number)
+        receipts = [self.receipts[tx["hash"]] for tx in block["transactions"]]
+        return dict(
+            abi=[],
+            block=dict(
+                number=int(block["number"], 16),
+                hash=block["hash"],
+                timestamp=int(block["timestamp"], 16),
+            ),
+            chainId=self.chain_id,
+            confirmed=confirmed,
+            erc20Approvals=[],
+            erc20Transfers=[],
+            logs=[
+                dict(
+                    logIndex=int(log["logIndex"], 16),
+                    transactionHash=log["transactionHash"],
+                    address=log["address"],
+                    data=log["data"],
+                    **{f"topic{n}": topic for n, topic in enumerate(log["topics"])},
+                )
+                for log in block["logs"]
+            ],
+            nftApprovals=dict(ERC721=[], ERC1155=[]),
+            nftTransfers=[],
+            retries=0,
+            streamId=stream_id,
+            tag=tag,
+            txs=[
+                dict(
+                    hash=tx["hash"],
+                    gas=int(tx["gas"], 16),
+                    gasPrice=int(tx["gasPrice"], 16),
+                    nonce=int(tx["nonce"], 16),
+                    input=tx["input"],
+                    transactionIndex=int(tx["transactionIndex"], 16),
+                    fromAddress=tx["from"],
+                    toAddress=tx["to"],
+                    value=int(tx["value"], 16),
+                    type=int(tx["type"], 16),
+                    v=int(tx["v"], 16),
+                    r=tx["r"],
+                    s=tx["s"],
+                    receiptCumulativeGasUsed=int(receipt["cumulativeGasUsed"], 16),
+                    receiptGasUsed=int(receipt["gasUsed"], 16),
+                    receiptContractAddress=receipt["contractAddress"],
+                    receiptStatus=int(receipt["status"], 16),
+                )
+                for tx, receipt in zip(block["transactions"], receipts)
+            ],
+            txsInternal=[],
+        )
+
+    def events(self, number):
+        """return the logs of block number as ContractEvent request bodies"""
+        block = self.block(number)
+        return [
+            dict(
+                contract_address=log["address"],
+                event_hash=log["topics"][0],
+                txn_hash=log["transactionHash"],
+                data=dict(
+                    blockNumber=number,
+                    blockHash=log["blockHash"],
+                    logIndex=int(log["logIndex"], 16),
+                    topics=log["topics"],
+                    data=log["data"],
+                ),
+            )
+            for log in block["logs"]
+        ]
+
+
+class FakeRPC:
+    """JSON-RPC method handlers answering from a BlockGenerator"""
+
+    def __init__(self, generator):
+        self.generator = generator
+
+    def _block_number(self, tag):
+        if tag in ("latest", "pending", "safe", "finalized"):
+            return self.generator.head()
+        if tag == "earliest":
+            return self.generator.start_block
+        return int(tag, 16)
+
+    def _block(self, number, full):
+        if number < self.generator.start_block or number > self.generator.head():
+            return None
+        block = dict(self.generator.block(number))
+        block.pop("logs")
+        if not full:
+            block["transactions"] = [tx["hash"] for tx in block["transactions"]]
+        return block
+
+    def eth_chainId(self):
+        return self.generator.chain_id
+
+    def eth_blockNumber(self):
+        return _hex(self.generator.head())
+
+    def eth_getBlockByNumber(self, tag, full=False):
+        return self._block(self._block_number(tag), full)
+
+    def eth_getBlockByHash(self, block_hash, full=False):
+        for number, block in self.generator.blocks.items():
+            if block["hash"] == block_hash:
+                return self._block(number, full)
+        return None
+
+    def eth_getLogs(self, filter):
+        if "blockHash" in filter:
+            numbers = [n for n, b in self.generator.blocks.items() if b["hash"] == filter["blockHash"]]
+        else:
+            start = self._block_number(filter.get("fromBlock", "latest"))
+            end = self._block_number(filter.get("toBlock", "latest"))
+            numbers = range(max(start, self.generator.start_block), end + 1)
+        addresses = filter.get("address")
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = set(a.lower() for a in addresses) if addresses else None
+        topic0 = (filter.get("topics") or [None])[0]
+        if isinstance(topic0, str):
+            topic0 = [topic0]
+        logs = []
+        for number in numbers:
+            for log in self.generator.block(number)["logs"]:
+                if addresses and log["address"] not in addresses:
+                    continue
+                if topic0 and log["topics"][0] not in topic0:
+                    continue
+                logs.append(log)
+        return logs
+
+    def eth_getTransactionByHash(self, tx_hash):
+        return self.generator.transactions.get(tx_hash)
+
+    def eth_getTransactionReceipt(self, tx_hash):
+        return self.generator.receipts.get(tx_hash)
+
+    def eth_getBlockReceipts(self, tag):
+        number = self._block_number(tag)
+        block = self._block(number, True)
+        if block is None:
+            return None
+        return [self.generator.receipts[tx["hash"]] for tx in block["transactions"]]
+
+    def eth_getBalance(self, address, tag="latest"):
+        """a balance derived from the address and block number"""
+        number = self._block_number(tag)
+        return _hex(int(address[-8:], 16) * 10**9 + number)
+
+    def eth_call(self, call, tag="latest"):
+        """answer the ERC20 name, symbol, decimals and balanceOf getters for any address"""
+        data = call.get("input") or call.get("data") or ""
+        selector = data[:10]
+        address = call["to"].lower()
+        if selector == "0x06fdde03":
+            return to_hex(encode(["string"], [f"Token {address[-4:]}"]))
+        if selector == "0x95d89b41":
+            return to_hex(encode(["string"], [f"T{address[-4:].upper()}"]))
+        if selector == "0x313ce567":
+            return to_hex(encode(["uint8"], [18]))
+        if selector == "0x70a08231":
+            owner = data[-40:]
+            return to_hex(encode(["uint256"], [int(owner[-8:], 16) + self._block_number(tag)]))
+        raise RPCError(3, "execution reverted")
+
+    def debug_traceTransaction(self, tx_hash, options=None):
+        """trace one internal value transfer from the transaction recipient, as callTracer or struct logs"""
+        tx = self.generator.transactions.get(tx_hash)
+        if tx is None:
+            raise RPCError(-32000, f"transaction {tx_hash} not found")
+        target = "0x" + tx_hash[-40:]
+        if (options or {}).get("tracer") == "callTracer":
+            call = {"type": "CALL", "from": tx["to"], "to": target, "value": _hex(1000), "gas": _hex(2300)}
+            return {"type": "CALL", "from": tx["from"], "to": tx["to"], "value": tx["value"], "calls": [call]}
+        stack = [_hex(0)[2:].zfill(64)] * 4 + [_hex(1000)[2:].zfill(64), target[2:].zfill(64), _hex(2300)[2:].zfill(64)]
+        return {
+            "gas": 21_000,
+            "failed": False,
+            "returnValue": "",
+            "structLogs": [{"pc": 0, "op": "CALL", "gas": 100_000, "gasCost": 2300, "depth": 1, "stack": stack}],
+        }
+
+    def handle(self, request):
+        """return the response object for a single JSON-RPC request object"""
+        response = dict(jsonrpc="2.0", id=request.get("id"))
+        try:
+            method = request.get("method", "")
+            handler = getattr(self, method, None) if method.startswith(("eth_", "debug_")) else None
+            if handler is None:
+                raise RPCError(-32601, f"method not found: {method}")
+            response["result"] = handler(*request.get("params", []))
+        except RPCError as exc:
+            response["error"] = dict(code=exc.code, message=exc.message)
+        except (TypeError, ValueError, KeyError) as exc:
+            response["error"] = dict(code=-32602, message=f"invalid params: {exc}")
+        return response
+
+    def handle_payload(self, payload):
+        if isinstance(payload, list):
+            return [self.handle(request) for request in payload]
+        return self.handle(payload)
+
+
+def rpc_app(generator):
+    """return an ASGI application serving JSON-RPC requests from generator"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import Response
+
+    rpc = FakeRPC(generator)
+    app = FastAPI(title="fake hardhat json-rpc")
+
+    @app.post("/")
+    async def json_rpc(request: Request):
+        payload = json.loads(await request.body())
+        return Response(content=json.dumps(rpc.handle_payload(payload)), media_type="application/json")
+
+    return app
+
+
+class OpenLoopResult:
+    def __init__(self):
+        self.latencies = []
+        self.lag = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def summary(self):
+        from .bench import summarize
+
+        return dict(
+            sent=len(self.latencies) + self.errors,
+            errors=self.errors,
+            latency=summarize(self.latencies, self.elapsed),
+            schedule_lag=summarize(self.lag, self.elapsed),
+        )
+
+
+async def post_events(generator, url, api_key, rate, duration, start_block=None, client=None):
+    """post generated logs to url/event at a target rate (requests per second) on an open-loop schedule
+
+    Each request is started at its scheduled time whether or not earlier
+    requests have completed.  Latency is measured from the scheduled time,
+    and schedule_lag records how late each request actually started.
+    """
+    import httpx
+
+    result = OpenLoopResult()
+    interval = 1.0 / rate
+    total = int(rate * duration)
+    headers = {"x-api-key": api_key, "content-type": "application/json"}
+
+    def bodies():
+        number = start_block or generator.start_block
+        while True:
+            for event in generator.events(number):
+                yield json.dumps(event)
+            number += 1
+
+    async def send(client, body, scheduled):
+        started = time.perf_counter()
+        result.lag.append(started - scheduled)
+        try:
+            response = await client.post(url + "/event", content=body, headers=headers)
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            logger.debug(f"post failed: {exc}")
+            result.errors += 1
+        else:
+            result.latencies.append(time.perf_counter() - scheduled)
+
+    owned = client is None
+    if owned:
+        client = httpx.AsyncClient(timeout=30.0, limits=httpx.Limits(max_connections=None))
+    try:
+        tasks = []
+        source = bodies()
+        start = time.perf_counter()
+        for n in range(total):
+            scheduled = start + n * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, next(source), scheduled)))
+        await asyncio.gather(*tasks)
+        result.elapsed = time.perf_counter() - start
+    finally:
+        if owned:
+            await client.aclose()
+    return result
@@ -0,0 +1,132 @@
+# ingestion and dispatch pipeline
+
+import asyncio
+import contextlib
+import logging
+
+from eth_utils import to_bytes
+from sqlmodel import Session
+
+from . import db, settings
+from .balances import BalanceStage
+from .bloom import StreamBloom
+from .checkpoint import Checkpointer
+from .decode import DecodeStage
+from .delivery import DeliveryQueue
+from .dispatch import Dispatcher
+from .eventstore import event_store
+from .feed import feed
+from .fetch import TransactionStage
+from .poller import ChainPoller, to_int
+from .router import StreamRouter, chain_id
+from .rpc import RPCClient
+from .schema import ContractEvent
+from .subscribe import Publisher
+from .tokens import TokenStage
+from .trace import TraceStage
+from .triggers import TriggerStage
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """chain polling, ingestion and dispatch; run by the elected leader worker only"""
+
+    def __init__(self, rpc_url=None, poll_interval=None, start_block=None):
+        self.rpc_url = rpc_url or settings.RPC_URL
+        self.poll_interval = poll_interval or settings.POLL_INTERVAL
+        self.start_block = start_block if start_block is not None else settings.START_BLOCK
+        self.rpc = None
+        self.poller = None
+        self.delivery = None
+        self.dispatcher = None
+        self.checkpoints = None
+        self.tasks = []
+
+    def __repr__(self):
+        state = "running" if self.tasks else "stopped"
+        return f"<{self.__class__.__name__} {self.rpc_url} {state}>"
+
+    async def start(self):
+        logger.info(f"starting pipeline for {self.rpc_url}")
+        self.rpc = RPCClient(self.rpc_url)
+        self.delivery = DeliveryQueue()
+        stages = [
+            DecodeStage(),
+            TokenStage(self.rpc),
+            TransactionStage(self.rpc),
+            TraceStage(self.rpc),
+            TriggerStage(self.rpc),
+            BalanceStage(self.rpc),
+        ]
+        bloom = StreamBloom() if settings.BLOOM_PREFILTER else None
+        self.checkpoints = Checkpointer(self.delivery)
+        self.dispatcher = Dispatcher(
+            StreamRouter(),
+            self.delivery,
+            stages=stages,
+            publisher=Publisher(),
+            bloom=bloom,
+            checkpoints=self.checkpoints,
+        )
+        self.poller = ChainPoller(
+            self.rpc,
+            handlers=[self.ingest, self.dispatcher],
+            start_block=self.start_block,
+            poll_interval=self.poll_interval,
+            resume=self.checkpoints.resume,
+            prefetch=settings.POLL_PREFETCH,
+        )
+        self.tasks = [
+            asyncio.create_task(self.poller.run()),
+            asyncio.create_task(self.delivery.run()),
+            asyncio.create_task(self.checkpoints.run()),
+        ]
+
+    async def stop(self):
+        if self.tasks:
+            logger.info("stopping pipeline")
+            for task in self.tasks:
+                task.cancel()
+            for task in self.tasks:
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+            self.tasks = []
+        if self.rpc:
+            # resume from where this leader stopped if it is re-elected
+            self.start_block = self.poller.next_block
+            await self.rpc.aclose()
+            self.rpc = None
+        if self.delivery:
+            try:
+                await asyncio.wait_for(self.delivery.drain(), settings.WEBHOOK_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"spilling undelivered updates: {self.delivery}")
+            await self.delivery.spill_all()
+            try:
+                await self.checkpoints.save()
+            except Exception as exc:
+                logger.error(f"checkpoint save failed: {exc.__class__.__name__}: {exc}")
+            await self.delivery.aclose()
+            self.delivery = None
+
+    async def ingest(self, block):
+        if block.logs and await asyncio.to_thread(self._store, block):
+            await feed.notify()
+
+    def _store(self, block):
+        events = [
+            ContractEvent(
+                contract_address=to_bytes(hexstr=log["address"]),
+                event_hash=to_bytes(hexstr=log["topics"][0]),
+                txn_hash=to_bytes(hexstr=log["transactionHash"]),
+                chain_id=chain_id(block.chain_id),
+                log_index=to_int(log["logIndex"]),
+                block_number=block.number,
+                data=dict(log, chainId=block.chain_id),
+            )
+            for log in block.logs
+            if log["topics"]
+        ]
+        with Session(db.engine) as session:
+            return event_store(session).ingest(events)
@@ -0,0 +1,104 @@
+# hardhat chain poller
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def to_int(value):
+    if isinstance(value, str):
+        return int(value, 16)
+    return int(value or 0)
+
+
+class Block:
+    """a block header with its logs, as passed to the pipeline handlers"""
+
+    def __init__(self, chain_id, header, logs):
+        self.chain_id = chain_id
+        self.header = header
+        self.logs = logs
+        self.number = to_int(header["number"])
+        self.hash = header["hash"]
+        self.timestamp = to_int(header.get("timestamp"))
+
+    def __repr__(self):
+        return f"<Block {self.number} logs={len(self.logs)}>"
+
+
+class ChainPoller:
+    """follow the chain head, passing each new block to the handlers in order"""
+
+    def __init__(self, rpc, handlers=None, start_block=None, poll_interval=1.0, resume=None, prefetch=1):
+        self.rpc = rpc
+        self.handlers = list(handlers or [])
+        # async callable given the chain id, head and start block, returning the block to poll from
+        self.resume = resume
+        self.start_block = start_block
+        self.poll_interval = poll_interval
+        # blocks fetched concurrently while catching up with the head
+        self.prefetch = max(1, prefetch)
+        self.chain_id = None
+        self.next_block = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} chain={self.chain_id} next={self.next_block}>"
+
+    async def head(self):
+        return to_int(await self.rpc.call("eth_blockNumber"))
+
+    async def fetch_block(self, number):
+        tag = hex(number)
+        header, logs = await self.rpc.batch(
+            [
+                ("eth_getBlockByNumber", [tag, False]),
+                ("eth_getLogs", [dict(fromBlock=tag, toBlock=tag)]),
+            ]
+        )
+        if header is None:
+            return None
+        return Block(self.chain_id, header, logs)
+
+    async def handle(self, block):
+        for handler in self.handlers:
+            await handler(block)
+
+    async def poll(self):
+        """process blocks up to the current head, returning the number processed"""
+        head = await self.head()
+        if self.next_block is None:
+            next_block = head if self.start_block is None else self.start_block
+            if self.resume is not None:
+                next_block = await self.resume(self.chain_id, head, next_block)
+            self.next_block = next_block
+        count = 0
+        fetches = {}
+        try:
+            while self.next_block <= head:
+                for number in range(self.next_block, min(head, self.next_block + self.prefetch - 1) + 1):
+                    if number not in fetches:
+                        fetches[number] = asyncio.create_task(self.fetch_block(number))
+                block = await fetches.pop(self.next_block)
+                if block is None:
+                    break
+                await self.handle(block)
+                self.next_block += 1
+                count += 1
+        finally:
+            for fetch in fetches.values():
+                fetch.cancel()
+            await asyncio.gather(*fetches.values(), return_exceptions=True)
+        return count
+
+    async def run(self):
+        self.chain_id = await self.rpc.call("eth_chainId")
+        logger.info(f"polling chain {self.chain_id} every {self.poll_interval}s")
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error(f"poll failed at block {self.next_block}: {exc.__class__.__name__}: {exc}")
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,102 @@
+# request profiler
+
+"""opt-in per-request profiling with capture of the slowest requests
+
+Requests are profiled when PROFILE_REQUESTS is set, for a PROFILE_SAMPLE_RATE
+fraction of requests, or when the request carries the API key in the
+X-Profile header.  The PROFILE_KEEP slowest profiles are kept in memory, per
+worker, for the admin endpoint and the ses profiles command.
+
+Profiles are taken with cProfile on the event loop thread, one request at a
+time; a request arriving while another is being profiled is not profiled.
+Since the event loop interleaves requests, a profile may include time spent
+on other requests while the profiled one was awaiting, and the work of sync
+endpoints, which run in the threadpool, shows only as the time waited for it.
+"""
+
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import random
+import time
+from datetime import datetime
+
+from . import settings
+
+PROFILE_HEADER = "x-profile"
+STATS_LINES = 40
+
+
+class RequestProfiler:
+    def __init__(self, enabled=None, sample_rate=None, keep=None):
+        self.enabled = settings.PROFILE_REQUESTS if enabled is None else enabled
+        self.sample_rate = settings.PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.keep = keep or settings.PROFILE_KEEP
+        # min-heap of (elapsed, sequence, profile), so the fastest kept profile is replaced first
+        self.heap = []
+        self.counter = itertools.count()
+        self.active = False
+        self.profiled = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} enabled={self.enabled} profiled={self.profiled} kept={len(self.heap)}>"
+
+    def wanted(self, request):
+        key = request.headers.get(PROFILE_HEADER)
+        if key is not None:
+            return key == str(settings.API_KEY)
+        return self.enabled and random.random() < self.sample_rate
+
+    def add(self, profile):
+        entry = (profile["elapsed"], next(self.counter), profile)
+        if len(self.heap) < self.keep:
+            heapq.heappush(self.heap, entry)
+        elif entry[0] > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def slowest(self, limit=None):
+        """return the kept profiles, slowest first"""
+        profiles = [entry[2] for entry in sorted(self.heap, reverse=True)]
+        return profiles[:limit] if limit else profiles
+
+    def clear(self):
+        count = len(self.heap)
+        self.heap = []
+        return count
+
+    async def __call__(self, request, call_next):
+        """http middleware"""
+        if self.active or not self.wanted(request):
+            return await call_next(request)
+        self.active = True
+        profile = cProfile.Profile()
+        started = datetime.now()
+        start = time.perf_counter()
+        status = 500
+        try:
+            profile.enable()
+            try:
+                response = await call_next(request)
+            finally:
+                profile.disable()
+            status = response.status_code
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            self.active = False
+            self.profiled += 1
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(STATS_LINES)
+            self.add(
+                dict(
+                    method=request.method,
+                    path=request.url.path,
+                    query=request.url.query,
+                    status=status,
+                    started=started.isoformat(timespec="milliseconds"),
+                    elapsed=round(elapsed, 6),
+                    stats=output.getvalue(),
+                )
+            )
@@ -0,0 +1,82 @@
+# delivery retry scheduler
+
+"""retry failed deliveries from a single timer heap
+
+Failed batches are pushed on a min-heap keyed by their next attempt time,
+with exponential backoff and jitter, so any number of pending retries costs
+one task.  Updates that exceed the maximum retry count are passed to the
+dead letter handler instead.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduler:
+    def __init__(self, retry, dead_letter, max_retries=None, base=None, cap=None):
+        self.retry = retry
+        self.dead_letter = dead_letter
+        self.max_retries = settings.WEBHOOK_MAX_RETRIES if max_retries is None else max_retries
+        self.base = base or settings.WEBHOOK_RETRY_BASE
+        self.cap = cap or settings.WEBHOOK_RETRY_MAX
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.scheduled = 0
+        self.dead = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} pending={len(self.heap)} scheduled={self.scheduled} dead={self.dead}>"
+
+    def __len__(self):
+        return len(self.heap)
+
+    def backoff(self, retries):
+        """return the delay before retry number retries: exponential, capped, with jitter"""
+        delay = min(self.cap, self.base * 2 ** (retries - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def schedule(self, outbox, batch, error):
+        """schedule a failed batch for retry, dead-lettering updates that are out of retries"""
+        retry = []
+        dead = []
+        for update in batch:
+            update.retries += 1
+            (dead if update.retries > self.max_retries else retry).append(update)
+        if dead:
+            self.dead += len(dead)
+            logger.warning(f"{outbox.route} dead-lettering {len(dead)} updates after {self.max_retries} retries")
+            await self.dead_letter(outbox, dead, error)
+        if retry:
+            due = asyncio.get_running_loop().time() + self.backoff(max(update.retries for update in retry))
+            heapq.heappush(self.heap, (due, next(self.counter), outbox, retry))
+            self.scheduled += len(retry)
+            self.wakeup.set()
+
+    def take(self, outbox=None):
+        """remove and return the pending (outbox, batch) entries, for outbox or all"""
+        taken = [(entry[2], entry[3]) for entry in self.heap if outbox is None or entry[2] is outbox]
+        if taken:
+            self.heap = [entry for entry in self.heap if not (outbox is None or entry[2] is outbox)]
+            heapq.heapify(self.heap)
+        return taken
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, outbox, batch = heapq.heappop(self.heap)
+                await self.retry(outbox, batch)
+            timeout = self.heap[0][0] - now if self.heap else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
@@ -0,0 +1,170 @@
+# stream routing table
+
+"""match block logs to the streams that subscribe to them
+
+The router keeps an in-memory index of streams by (address, topic0), plus
+allAddresses streams by topic0, rebuilt from the database whenever the set of
+stream versions changes.
+"""
+
+import hashlib
+import logging
+
+from eth_utils import to_hex
+from sqlmodel import Session
+
+from . import db, json
+from .balances import selectors
+from .db import CRUD
+from .decode import abi_hash, topic_hash
+from .schema import Address, AddressMap, EventStream, EventStreamsStatusEnum
+from .triggers import parse as parse_triggers
+
+logger = logging.getLogger(__name__)
+
+INACTIVE = (
+    EventStreamsStatusEnum.PAUSED.value,
+    EventStreamsStatusEnum.ERROR.value,
+    EventStreamsStatusEnum.TERMINATED.value,
+)
+
+# paused streams and streams in error are still routed, so their updates are retained for delivery on recovery
+UNROUTED = (EventStreamsStatusEnum.TERMINATED.value,)
+
+
+def chain_id(value):
+    if isinstance(value, str):
+        return int(value, 16) if value.startswith("0x") else int(value)
+    return int(value)
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+class StreamRoute:
+    """immutable per-stream routing and payload state, built once per routing table load"""
+
+    def __init__(self, stream, addresses):
+        self.id = stream.id
+        self.stream_id = str(stream.streamId)
+        self.tag = stream.tag or ""
+        self.webhook_url = str(stream.webhookUrl)
+        self.status = stream.status
+        self.version = stream.version
+        self.addresses = frozenset(addresses)
+        self.topic0 = frozenset(topic_hash(t) for t in stream.topic0 or [])
+        self.all_addresses = bool(stream.allAddresses)
+        self.chain_ids = frozenset(chain_id(c) for c in stream.chainIds or [])
+        self.include_contract_logs = stream.includeContractLogs is not False
+        self.include_native_txs = bool(stream.includeNativeTxs)
+        self.include_internal_txs = bool(stream.includeInternalTxs)
+        self.include_all_tx_logs = bool(stream.includeAllTxLogs)
+        self.webhook_rate_limit = stream.webhookRateLimit
+        self.webhook_rate_burst = stream.webhookRateBurst
+        self.abi = list(stream.abi or [])
+        self.abi_hash = abi_hash(self.abi)
+        self.native_balances = selectors(stream.getNativeBalances)
+        self.triggers = parse_triggers(stream.triggers)
+        # the per-stream payload fields, pre-encoded for splicing ahead of a shared body
+        self.prefix = (
+            b'{"abi":' + _dumps(self.abi) + b',"streamId":' + _dumps(self.stream_id) + b',"tag":' + _dumps(self.tag)
+        )
+
+    def __repr__(self):
+        return f"<StreamRoute {self.stream_id} tag={self.tag} status={self.status}>"
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, StreamRoute) and other.id == self.id
+
+    @property
+    def active(self):
+        return self.status not in INACTIVE
+
+    @property
+    def paused(self):
+        return self.status == EventStreamsStatusEnum.PAUSED.value
+
+    @property
+    def routed(self):
+        return self.status not in UNROUTED
+
+    @property
+    def payload_options(self):
+        """the stream options that determine the shared part of its payload"""
+        return (self.include_native_txs, self.include_internal_txs, self.abi_hash, self.native_balances, self.triggers)
+
+    def header(self, confirmed, retries):
+        return self.prefix + b',"confirmed":' + (b"true" if confirmed else b"false") + b',"retries":%d' % retries
+
+
+class StreamRouter:
+    def __init__(self):
+        self.fingerprint = None
+        self.routes = {}
+        self.by_address = {}
+        self.by_topic0 = {}
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} streams={len(self.routes)} addresses={len(self.by_address)}>"
+
+    def _fingerprint(self, crud):
+        digest = hashlib.sha1()
+        for id, version in crud.read_values([EventStream.id, EventStream.version]):
+            digest.update(b"%d.%d;" % (id, version or 0))
+        return digest.hexdigest()
+
+    def refresh(self, force=False):
+        """reload the routing table if any stream changed; return True if reloaded"""
+        with Session(db.engine) as session:
+            with CRUD(session) as crud:
+                fingerprint = self._fingerprint(crud)
+                if fingerprint == self.fingerprint and not force:
+                    return False
+                streams = crud.read_all(EventStream)
+                addresses = {a.id: to_hex(a.address) for a in crud.read_all(Address)}
+                stream_addresses = {}
+                for map in crud.read_all(AddressMap):
+                    if map.address_id in addresses:
+                        stream_addresses.setdefault(map.stream_id, []).append(addresses[map.address_id])
+        self.load([StreamRoute(stream, stream_addresses.get(stream.id, [])) for stream in streams])
+        self.fingerprint = fingerprint
+        logger.info(f"loaded {self}")
+        return True
+
+    def load(self, routes):
+        self.routes = {route.id: route for route in routes}
+        by_address = {}
+        by_topic0 = {}
+        for route in routes:
+            if not (route.routed and route.include_contract_logs):
+                continue
+            if route.all_addresses:
+                for topic0 in route.topic0:
+                    by_topic0.setdefault(topic0, []).append(route)
+            else:
+                for address in route.addresses:
+                    for topic0 in route.topic0:
+                        by_address.setdefault((address, topic0), []).append(route)
+        self.by_address = {key: tuple(value) for key, value in by_address.items()}
+        self.by_topic0 = {key: tuple(value) for key, value in by_topic0.items()}
+
+    def match(self, block):
+        """return a dict of StreamRoute to the list of block logs it matches"""
+        matches = {}
+        empty = ()
+        block_chain_id = chain_id(block.chain_id)
+        for log in block.logs:
+            topics = log["topics"]
+            if not topics:
+                continue
+            topic0 = topics[0].lower()
+            address = log["address"].lower()
+            for route in self.by_address.get((address, topic0), empty) + self.by_topic0.get(topic0, empty):
+                if route.chain_ids and block_chain_id not in route.chain_ids:
+                    continue
+                matches.setdefault(route, []).append(log)
+        return matches
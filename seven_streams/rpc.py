@@ -0,0 +1,93 @@
+# ethereum json-rpc client
+
+import asyncio
+import itertools
+import logging
+
+import httpx
+
+from . import json
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_POOL_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+class RPCClient:
+    """asyncio JSON-RPC client with request batching over a pooled keep-alive connection"""
+
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.url = url
+        self.batch_size = batch_size
+        self.ids = itertools.count(1)
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={"content-type": "application/json"},
+        )
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.url}>"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _post(self, payload):
+        response = await self.client.post(self.url, content=json.dumps(payload))
+        response.raise_for_status()
+        return json.loads(response.content)
+
+    def _result(self, response):
+        if "error" in response:
+            error = response["error"]
+            raise RPCError(error.get("code"), error.get("message"))
+        return response.get("result")
+
+    async def call(self, method, *params):
+        """return the result of a single json-rpc call"""
+        request = dict(jsonrpc="2.0", id=next(self.ids), method=method, params=list(params))
+        return self._result(await self._post(request))
+
+    async def batch(self, calls, return_exceptions=False):
+        """return results of (method, params) calls, sent as json-rpc batches of at most batch_size requests
+
+        Failed calls raise RPCError, or are returned as RPCError instances if
+        return_exceptions is set.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        requests = [dict(jsonrpc="2.0", id=next(self.ids), method=m, params=list(p)) for m, p in calls]
+        chunks = [requests[i : i + self.batch_size] for i in range(0, len(requests), self.batch_size)]
+        responses = {}
+        for chunk_responses in await asyncio.gather(*[self._post(chunk) for chunk in chunks]):
+            if isinstance(chunk_responses, dict):
+                # some servers answer a failed batch with a single error object
+                self._result(chunk_responses)
+            for response in chunk_responses:
+                responses[response.get("id")] = response
+        results = []
+        for request in requests:
+            response = responses.get(request["id"], dict(error=dict(code=-32603, message="missing batch response")))
+            try:
+                results.append(self._result(response))
+            except RPCError as exc:
+                if not return_exceptions:
+                    raise
+                results.append(exc)
+        return results
@@ -3,13 +3,14 @@
 import enum
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Union
-from uuid import UUID
+from uuid import UUID, uuid4
 
 from eth_utils import humanize_bytes, humanize_hash
 from hexbytes import HexBytes
 from pydantic import AnyUrl
 from pydantic import BaseModel as _BaseModel
 from pydantic import root_validator, validator
+from sqlalchemy import Index
 from sqlmodel import JSON, Column, Field
 from sqlmodel import SQLModel as _SQLModel
 
@@ -102,7 +103,9 @@ class AddressResponse(AddressRequest):
 
 class HistoryOptions(BaseModel):
     excludePayload: bool = Field(True, description="exclude payload from results if True")
-    id: UUID = Field(..., description="requested history id")
+    id: Optional[UUID] = Field(None, description="requested history id")
+    streamId: Optional[UUID] = Field(None, description="return history for this stream only")
+    limit: int = Field(100, ge=1, description="maximum number of history items")
 
 
 class HistoryReplayOptions(BaseModel):
@@ -123,6 +126,12 @@ class Setting(SettingBase, table=True):
     id: Optional[int] = Field(None, primary_key=True)
 
 
+class Lease(SQLModel, table=True):
+    name: str = Field(..., primary_key=True, description="lease name")
+    holder: str = Field("", description="identity of the current lease holder")
+    expires: float = Field(0.0, description="lease expiration time in unix seconds")
+
+
 class JSONList(JSON):
     @classmethod
     def __get_validators__(cls):
@@ -186,6 +195,10 @@ class EventStreamBase(SQLModel):
         sa_column=Column(JSON),
         description="list of json strings describing  advanced options (see moralis streams docs)",
     )
+    webhookRateLimit: Optional[float] = Field(
+        None, description="maximum webhook requests per second (0 for unlimited, default WEBHOOK_RATE_LIMIT)"
+    )
+    webhookRateBurst: Optional[int] = Field(None, description="webhook request burst size (default WEBHOOK_RATE_BURST)")
     status: Optional[str] = Field("", description="Status Word")
     statusMessage: Optional[str] = Field("", description="Detailed Status")
     streamId: Optional[UUID] = Field(None, description="stream identifier GUID")
@@ -201,6 +214,7 @@ class EventStreamBase(SQLModel):
 
 class EventStream(EventStreamBase, table=True):
     id: Optional[int] = Field(None, primary_key=True)
+    version: int = Field(0, description="record version, incremented on each change to the stream or its addresses")
 
 
 class StreamResponse(EventStreamBase):
@@ -222,6 +236,9 @@ class ContractEventBase(SQLModel):
     contract_address: bytes = Field(None, description="address of event source contract")
     event_hash: bytes = Field(None, description="event hash")
     txn_hash: bytes = Field(None, description="event source transaction hash")
+    chain_id: Optional[int] = Field(None, description="event source chain ID")
+    log_index: Optional[int] = Field(None, description="event log index in its block")
+    block_number: Optional[int] = Field(None, description="event block number", index=True)
     data: JSONDict = Field(..., sa_column=Column(JSON), description="event data as json")
 
     def __repr__(self):
@@ -241,9 +258,66 @@ class ContractEventBase(SQLModel):
 
 
 class ContractEvent(ContractEventBase, table=True):
+    # a unique index rather than a constraint, so db.migrate can add it to an existing table
+    __table_args__ = (Index("uq_contractevent_key", "chain_id", "txn_hash", "log_index", unique=True),)
+
     id: Optional[int] = Field(None, primary_key=True)
 
 
+class SpilledUpdateBase(SQLModel):
+    stream_id: int = Field(..., description="stream ID", foreign_key="eventstream.id", index=True)
+    block_number: int = Field(..., description="block number of the update")
+    confirmed: bool = Field(True, description="update confirmed flag")
+    retries: int = Field(0, description="delivery retry count")
+    shared: bytes = Field(..., description="encoded payload fields shared with other streams")
+
+
+class SpilledUpdate(SpilledUpdateBase, table=True):
+    id: Optional[int] = Field(None, primary_key=True)
+
+
+class DeadLetterBase(SpilledUpdateBase):
+    historyId: UUID = Field(default_factory=uuid4, description="history item ID", index=True)
+    error: str = Field("", description="last delivery error")
+    created: datetime = Field(default_factory=datetime.now, description="time the update was dead-lettered")
+
+
+class DeadLetter(DeadLetterBase, table=True):
+    id: Optional[int] = Field(None, primary_key=True)
+
+
+class PublishedUpdate(SpilledUpdateBase, table=True):
+    # ids are never reused once pruned, so a subscriber's cursor cannot skip updates published after it
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id: Optional[int] = Field(None, primary_key=True, description="subscription cursor")
+    created: float = Field(..., description="time the update was published in unix seconds", index=True)
+
+
+class SubscriberLease(SQLModel, table=True):
+    stream_id: int = Field(..., primary_key=True, foreign_key="eventstream.id", description="stream ID")
+    expires: float = Field(0.0, description="time updates stop being published in unix seconds")
+
+
+class StreamCheckpoint(SQLModel, table=True):
+    stream_id: int = Field(..., primary_key=True, foreign_key="eventstream.id", description="stream ID")
+    chain_id: int = Field(..., primary_key=True, description="chain ID")
+    block_number: int = Field(..., description="last block with every update of the stream delivered")
+    updated: float = Field(..., description="time the checkpoint was saved in unix seconds")
+
+
+class HistoryItem(BaseModel):
+    id: UUID = Field(..., description="history item ID")
+    date: datetime = Field(..., description="time delivery was abandoned")
+    streamId: UUID = Field(..., description="stream identifier GUID")
+    tag: Optional[str] = Field("", description="client identifier for event notification stream")
+    webhookUrl: str = Field(..., description="event receiver webhook URL")
+    blockNumber: int = Field(..., description="block number of the undelivered update")
+    retries: int = Field(..., description="delivery attempts made")
+    errorMessage: str = Field("", description="last delivery error")
+    payload: Optional[Dict] = Field(None, description="the undelivered ContractEventUpdate")
+
+
 class EventResponse(BaseModel):
     status: str = Field(..., description="status message")
     count: int = Field(..., description="record count")
@@ -276,9 +350,11 @@ class ContractEventUpdateLog(BaseModel):
     address: bytes = Field(..., description="address of contract emitting event")
     data: Union[bytes, None] = Field(..., description="event data")
     topic0: bytes = Field(..., description="event topic0")
-    topic1: bytes = Field(..., description="event topic1")
-    topic2: bytes = Field(..., description="event topic2")
-    topic3: bytes = Field(..., description="event topic3")
+    topic1: Optional[bytes] = Field(None, description="event topic1, if indexed")
+    topic2: Optional[bytes] = Field(None, description="event topic2, if indexed")
+    topic3: Optional[bytes] = Field(None, description="event topic3, if indexed")
+    decoded: Optional[Dict] = Field(None, description="event name and arguments decoded with the stream ABI")
+    triggers: Optional[List[Dict]] = Field(None, description="stream trigger results")
 
     @validator("transactionHash", "topic0", "topic1", "topic2", "topic3")
     def validate_hash(cls, v, field):
@@ -315,6 +391,7 @@ class ContractEventUpdateTransaction(BaseModel):
     receiptContractAddress: Optional[bytes] = Field(None, description="address of deployed transaction")
     root: Optional[bytes] = Field(None, description="Pre-Byzantium transaction root field")
     receiptStatus: int = Field(..., description="transaction status: 1=success, 0=reverted")
+    triggers: Optional[List[Dict]] = Field(None, description="stream trigger results")
 
     @validator("hash")
     def validate_hash(cls, v, field):
@@ -338,6 +415,7 @@ class ContractEventUpdateInternalTransaction(BaseModel):
     value: int = Field(..., description="value transferred by transacition in WEI")
     gas: int = Field(..., description="gas used by transaction")
     transactionHash: bytes = Field(..., description="transaction hash")
+    triggers: Optional[List[Dict]] = Field(None, description="stream trigger results")
 
     @root_validator(pre=True)
     def validate_internal_txn(cls, values):
@@ -368,6 +446,7 @@ class ContractEventUpdate(BaseModel):
     logs: List[ContractEventUpdateLog] = Field(..., description="event log data")
     nftApprovals: Dict[str, List[Dict]] = Field(..., description="ERC721 or ERC1155 approval data")
     nftTransfers: List[Dict] = Field(..., description="ERC721 or ERC1155 transfer data")
+    nativeBalances: Optional[List[Dict]] = Field(None, description="native balances of selected addresses at the block")
     retries: Optional[int] = Field(None, description="number of event notification retries")
     streamId: Union[UUID, Any] = Field(..., description="ID of stream delivering event notification")
     tag: Union[str, Any] = Field(..., description="client identifier for event notification stream")
@@ -13,3 +13,44 @@ GATEWAY_URL = config("GATEWAY_URL", cast=str, default="http://localhost:8891")
 WORKERS = config("WORKERS", cast=int, default=1)
 DATABASE_FILE = config("DATABASE_FILE", cast=str, default="./streams.db")
 DATABASE_URL = config("DATABASE_URL", cast=str, default=f"sqlite:///{DATABASE_FILE}")
+RPC_URL = config("RPC_URL", cast=str, default="")
+POLL_INTERVAL = config("POLL_INTERVAL", cast=float, default=1.0)
+START_BLOCK = config("START_BLOCK", cast=int, default=None)
+LEADER_LEASE = config("LEADER_LEASE", cast=float, default=10.0)
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", cast=str, default="")
+WEBHOOK_TIMEOUT = config("WEBHOOK_TIMEOUT", cast=float, default=10.0)
+WEBHOOK_POOL_SIZE = config("WEBHOOK_POOL_SIZE", cast=int, default=20)
+WEBHOOK_LINGER = config("WEBHOOK_LINGER", cast=float, default=0.0)
+WEBHOOK_BATCH_BYTES = config("WEBHOOK_BATCH_BYTES", cast=int, default=1_000_000)
+WEBHOOK_BATCH_BLOCKS = config("WEBHOOK_BATCH_BLOCKS", cast=bool, default=False)
+WEBHOOK_QUEUE_SIZE = config("WEBHOOK_QUEUE_SIZE", cast=int, default=1000)
+WEBHOOK_RATE_LIMIT = config("WEBHOOK_RATE_LIMIT", cast=float, default=0.0)
+WEBHOOK_RATE_BURST = config("WEBHOOK_RATE_BURST", cast=int, default=10)
+WEBHOOK_BREAKER_FAILURES = config("WEBHOOK_BREAKER_FAILURES", cast=int, default=5)
+WEBHOOK_MAX_RETRIES = config("WEBHOOK_MAX_RETRIES", cast=int, default=5)
+WEBHOOK_RETRY_BASE = config("WEBHOOK_RETRY_BASE", cast=float, default=1.0)
+WEBHOOK_RETRY_MAX = config("WEBHOOK_RETRY_MAX", cast=float, default=300.0)
+TOKEN_CACHE_SIZE = config("TOKEN_CACHE_SIZE", cast=int, default=10000)
+TRACE_TRACER = config("TRACE_TRACER", cast=str, default="callTracer")
+TRACE_CONCURRENCY = config("TRACE_CONCURRENCY", cast=int, default=4)
+TRACE_CACHE_SIZE = config("TRACE_CACHE_SIZE", cast=int, default=10000)
+BALANCE_CACHE_SIZE = config("BALANCE_CACHE_SIZE", cast=int, default=10000)
+PROFILE_REQUESTS = config("PROFILE_REQUESTS", cast=bool, default=False)
+PROFILE_SAMPLE_RATE = config("PROFILE_SAMPLE_RATE", cast=float, default=1.0)
+PROFILE_KEEP = config("PROFILE_KEEP", cast=int, default=20)
+SUBSCRIBE_RETENTION = config("SUBSCRIBE_RETENTION", cast=float, default=300.0)
+SUBSCRIBE_BUFFER = config("SUBSCRIBE_BUFFER", cast=int, default=100)
+SUBSCRIBE_POLL = config("SUBSCRIBE_POLL", cast=float, default=0.5)
+SUBSCRIBE_KEEPALIVE = config("SUBSCRIBE_KEEPALIVE", cast=float, default=15.0)
+FEED_POLL = config("FEED_POLL", cast=float, default=1.0)
+FEED_MAX_WAIT = config("FEED_MAX_WAIT", cast=float, default=60.0)
+INGEST_RECENT_KEYS = config("INGEST_RECENT_KEYS", cast=int, default=100000)
+BLOOM_PREFILTER = config("BLOOM_PREFILTER", cast=bool, default=True)
+SPOOL_DIRECTORY = config("SPOOL_DIRECTORY", cast=str, default="./spool")
+SPOOL_SEGMENT_BYTES = config("SPOOL_SEGMENT_BYTES", cast=int, default=16_000_000)
+EVENT_STORE = config("EVENT_STORE", cast=str, default="database")
+EVENT_STORE_DIRECTORY = config("EVENT_STORE_DIRECTORY", cast=str, default="./events")
+EVENT_STORE_SEGMENT_BYTES = config("EVENT_STORE_SEGMENT_BYTES", cast=int, default=64_000_000)
+EVENT_STORE_INDEX_INTERVAL = config("EVENT_STORE_INDEX_INTERVAL", cast=int, default=64)
+CHECKPOINT_INTERVAL = config("CHECKPOINT_INTERVAL", cast=float, default=1.0)
+POLL_PREFETCH = config("POLL_PREFETCH", cast=int, default=8)
@@ -0,0 +1,275 @@
+# paused stream spool
+
+"""append-only segment files retaining the updates of paused streams
+
+While a stream is paused its updates are appended to segment files in a
+directory per stream under SPOOL_DIRECTORY, rather than stored as rows of
+the SpilledUpdate table.  Each segment file has an index file of record end
+offsets, appended after the records, so a record torn by a crash is never
+indexed; it is cut off, along with any torn index entry, when the segment
+is next opened.  Segments are read back through mmap, a page of records at
+a time, when the stream is active again and its outbox drains the spool in
+order.  Reading only moves a
+position in memory; the outbox acknowledges each record once it has been
+delivered, and the cursor of (segment, record number) kept in a cursor file
+advances over the acknowledged records, deleting each segment once every
+record in it is acknowledged.  After a restart the spool is read again from
+the cursor, so records taken but not yet delivered are not lost.
+
+A record is the HEADER fields followed by the encoded shared payload.
+"""
+
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+from array import array
+
+from . import settings
+from .dispatch import Update
+
+logger = logging.getLogger(__name__)
+
+# block number, retries, confirmed
+HEADER = struct.Struct("<QIB")
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+CURSOR_FILE = "cursor"
+
+
+class Segment:
+    """one segment file and its index of record end offsets"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.ends = array("Q")
+        if os.path.exists(path + INDEX_SUFFIX):
+            with open(path + INDEX_SUFFIX, "rb") as file:
+                data = file.read()
+            self.ends.frombytes(data[: len(data) - len(data) % self.ends.itemsize])
+            segment_size = os.path.getsize(path + SEGMENT_SUFFIX) if os.path.exists(path + SEGMENT_SUFFIX) else 0
+            while self.ends and self.ends[-1] > segment_size:
+                self.ends.pop()
+            # cut off an index entry or records torn by a crash, so the next append starts at a record boundary
+            if len(data) != len(self.ends) * self.ends.itemsize:
+                os.truncate(path + INDEX_SUFFIX, len(self.ends) * self.ends.itemsize)
+            if segment_size > self.size:
+                os.truncate(path + SEGMENT_SUFFIX, self.size)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.path} records={len(self)} size={self.size}>"
+
+    def __len__(self):
+        return len(self.ends)
+
+    @property
+    def size(self):
+        return self.ends[-1] if self.ends else 0
+
+    def append(self, records):
+        with open(self.path + SEGMENT_SUFFIX, "ab") as file:
+            if file.tell() != self.size:
+                # drop a record torn by a crash before it was indexed
+                file.truncate(self.size)
+                file.seek(self.size)
+            ends = array("Q")
+            end = self.size
+            for record in records:
+                file.write(record)
+                end += len(record)
+                ends.append(end)
+        with open(self.path + INDEX_SUFFIX, "ab") as file:
+            file.write(ends.tobytes())
+        self.ends.extend(ends)
+
+    def read(self, start, limit):
+        """return up to limit records from record number start"""
+        stop = min(len(self.ends), start + limit)
+        if start >= stop:
+            return []
+        with open(self.path + SEGMENT_SUFFIX, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = self.ends[start - 1] if start else 0
+                records = []
+                for end in self.ends[start:stop]:
+                    records.append(data[offset:end])
+                    offset = end
+        return records
+
+    def delete(self):
+        for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+def _record(update):
+    return HEADER.pack(update.block_number, update.retries, update.confirmed) + update.shared
+
+
+def _update(route, record, stored):
+    block_number, retries, confirmed = HEADER.unpack_from(record)
+    return Update(route, bytes(record[HEADER.size :]), block_number, bool(confirmed), retries, stored=stored)
+
+
+class SegmentSpool:
+    """per-stream segment file spool, with the spill store interface of UpdateStore"""
+
+    def __init__(self, directory=None, segment_bytes=None):
+        self.directory = directory or settings.SPOOL_DIRECTORY
+        self.segment_bytes = segment_bytes or settings.SPOOL_SEGMENT_BYTES
+        self.segments = {}
+        # stream id to the (segment name, record number) of the oldest unacknowledged record
+        self.cursors = {}
+        # stream id to the position after the last record taken for delivery
+        self.taken = {}
+        # stream id to the positions acknowledged beyond the cursor
+        self.acked = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.directory} streams={len(self.streams())}>"
+
+    def _path(self, stream_id, *names):
+        return os.path.join(self.directory, str(stream_id), *names)
+
+    def _load(self, stream_id):
+        """return the segments of a stream, oldest first, loading them on first use"""
+        segments = self.segments.get(stream_id)
+        if segments is None:
+            names = []
+            if os.path.isdir(self._path(stream_id)):
+                names = sorted(
+                    n[: -len(INDEX_SUFFIX)] for n in os.listdir(self._path(stream_id)) if n.endswith(INDEX_SUFFIX)
+                )
+            segments = self.segments[stream_id] = [Segment(self._path(stream_id, name)) for name in names]
+            cursor = (segments[0].name, 0) if segments else None
+            if os.path.exists(self._path(stream_id, CURSOR_FILE)):
+                with open(self._path(stream_id, CURSOR_FILE)) as file:
+                    name, index = file.read().split()
+                cursor = (name, int(index))
+            while segments and cursor[0] > segments[0].name:
+                # acknowledged before a crash interrupted its deletion
+                segments.pop(0).delete()
+            self.cursors[stream_id] = self.taken[stream_id] = cursor if segments else None
+            self.acked[stream_id] = set()
+        return segments
+
+    def _save_cursor(self, stream_id):
+        path = self._path(stream_id, CURSOR_FILE)
+        name, index = self.cursors[stream_id]
+        with open(path + ".tmp", "w") as file:
+            file.write(f"{name} {index}")
+        os.replace(path + ".tmp", path)
+
+    def write(self, updates):
+        by_stream = {}
+        for update in updates:
+            by_stream.setdefault(update.route.id, []).append(_record(update))
+        with self.lock:
+            for stream_id, records in by_stream.items():
+                segments = self._load(stream_id)
+                size = segments[-1].size if segments else self.segment_bytes
+                pending = []
+                for record in records:
+                    if size >= self.segment_bytes:
+                        if pending:
+                            segments[-1].append(pending)
+                            pending = []
+                        self._add_segment(stream_id, segments)
+                        size = 0
+                    pending.append(record)
+                    size += len(record)
+                segments[-1].append(pending)
+
+    def _add_segment(self, stream_id, segments):
+        os.makedirs(self._path(stream_id), exist_ok=True)
+        number = int(segments[-1].name) + 1 if segments else 0
+        segments.append(Segment(self._path(stream_id, f"{number:012d}")))
+        if self.cursors[stream_id] is None:
+            self.cursors[stream_id] = (segments[0].name, 0)
+
+    def read(self, route, limit):
+        """return up to limit of the oldest spooled updates for route not yet taken for delivery"""
+        updates = []
+        with self.lock:
+            segments = self._load(route.id)
+            position = self.taken[route.id]
+            for segment in segments:
+                if len(updates) >= limit:
+                    break
+                if position is not None and position[0] > segment.name:
+                    continue
+                index = position[1] if position is not None and position[0] == segment.name else 0
+                records = segment.read(index, limit - len(updates))
+                updates.extend(
+                    _update(route, record, (self, (segment.name, index + n))) for n, record in enumerate(records)
+                )
+                position = (segment.name, index + len(records))
+            self.taken[route.id] = position
+        return updates
+
+    def acknowledge(self, updates):
+        """advance the cursors over delivered updates, deleting each segment once all its records are acknowledged"""
+        by_stream = {}
+        for update in updates:
+            by_stream.setdefault(update.route.id, []).append(update.stored[1])
+        with self.lock:
+            for stream_id, positions in by_stream.items():
+                segments = self._load(stream_id)
+                acked = self.acked[stream_id]
+                acked.update(positions)
+                cursor = self.cursors[stream_id]
+                delivered = []
+                while segments:
+                    name, index = cursor
+                    while (name, index) in acked:
+                        acked.remove((name, index))
+                        index += 1
+                    if index < len(segments[0]):
+                        cursor = (name, index)
+                        break
+                    # every record of the segment has been delivered
+                    delivered.append(segments.pop(0))
+                    cursor = (segments[0].name, 0) if segments else None
+                if segments:
+                    self.cursors[stream_id] = cursor
+                    self._save_cursor(stream_id)
+                    # after the cursor moves past them, so a crash never leaves it naming a deleted segment
+                    for segment in delivered:
+                        segment.delete()
+                else:
+                    self.cursors[stream_id] = self.taken[stream_id] = None
+                    acked.clear()
+                    if os.path.isdir(self._path(stream_id)):
+                        shutil.rmtree(self._path(stream_id))
+
+    def _pending(self, stream_id):
+        """return True if the stream has spooled updates not yet taken for delivery"""
+        segments = self._load(stream_id)
+        position = self.taken[stream_id]
+        for segment in segments:
+            if position is None or segment.name > position[0]:
+                if len(segment):
+                    return True
+            elif segment.name == position[0] and len(segment) > position[1]:
+                return True
+        return False
+
+    def streams(self):
+        """return the ids of streams with spooled updates not yet taken for delivery"""
+        if not os.path.isdir(self.directory):
+            return set()
+        streams = set(int(name) for name in os.listdir(self.directory) if name.isdigit())
+        with self.lock:
+            return set(stream_id for stream_id in streams if self._pending(stream_id))
+
+    def discard(self, stream_id):
+        with self.lock:
+            self.segments.pop(stream_id, None)
+            self.cursors.pop(stream_id, None)
+            self.taken.pop(stream_id, None)
+            self.acked.pop(stream_id, None)
+            shutil.rmtree(self._path(stream_id), ignore_errors=True)
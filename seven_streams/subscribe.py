@@ -0,0 +1,220 @@
+# stream subscriptions
+
+"""push stream updates to server-sent event subscribers
+
+GET /stream/{id}/subscribe streams the stream's ContractEventUpdate payloads
+as server-sent events, an alternative to webhook delivery that needs no
+server on the consumer side and no request per update.
+
+The pipeline runs on the leader worker while subscribers may connect to any
+worker, so updates pass through the database.  A subscriber holds a lease on
+its stream, renewed while connected; the leader's Publisher writes the
+updates of leased streams to the PublishedUpdate table, in one insert per
+block, and the other streams cost nothing.  Each subscription pages the rows
+after its cursor; subscribers in the leader worker are woken when a block is
+published, the others poll every SUBSCRIBE_POLL seconds.
+
+The row id is the event id, so a client reconnecting with the Last-Event-ID
+header (or the cursor query parameter) resumes after the last update it
+received.  Leases and published updates are kept for SUBSCRIBE_RETENTION
+seconds, which bounds how long a client may be away and still resume
+without a gap.
+
+A subscription reads at most SUBSCRIBE_BUFFER updates at a time and awaits
+the transport before reading more, so a slow subscriber falls behind in the
+table rather than buffering in server memory.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from . import db, settings
+from .dispatch import Update
+from .schema import EventStream, PublishedUpdate, SubscriberLease
+
+logger = logging.getLogger(__name__)
+
+# milliseconds a disconnected EventSource client waits before reconnecting
+RECONNECT_MS = 1000
+
+
+class Notifier:
+    """wake the subscriptions of this worker when the pipeline publishes"""
+
+    def __init__(self):
+        self.event = None
+
+    def waiter(self):
+        """return the event set by the next notify; take it before checking for updates"""
+        if self.event is None:
+            self.event = asyncio.Event()
+        return self.event
+
+    def notify(self):
+        if self.event is not None:
+            self.event.set()
+            self.event = None
+
+    async def wait(self, waiter, timeout):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(waiter.wait(), timeout)
+
+
+notifier = Notifier()
+
+
+class PublishStore:
+    """published updates and subscriber leases"""
+
+    def publish(self, updates, now):
+        """write the updates of streams with an unexpired subscriber lease; return the number written"""
+        with Session(db.engine) as session:
+            statement = select(SubscriberLease.stream_id).where(SubscriberLease.expires >= now)
+            leased = set(session.exec(statement).all())
+            rows = [
+                dict(
+                    stream_id=update.route.id,
+                    block_number=update.block_number,
+                    confirmed=update.confirmed,
+                    retries=update.retries,
+                    shared=update.shared,
+                    created=now,
+                )
+                for update in updates
+                if update.route.id in leased
+            ]
+            if rows:
+                session.execute(insert(PublishedUpdate), rows)
+                session.commit()
+        return len(rows)
+
+    def prune(self, now, before):
+        """delete expired leases and the updates published before a time"""
+        with Session(db.engine) as session:
+            session.execute(delete(SubscriberLease).where(SubscriberLease.expires < now))
+            session.execute(delete(PublishedUpdate).where(PublishedUpdate.created < before))
+            session.commit()
+
+    def renew(self, stream_id, expires):
+        """extend the subscriber lease of a stream, returning False if the stream no longer exists"""
+        with Session(db.engine) as session:
+            if session.get(EventStream, stream_id) is None:
+                return False
+            result = session.execute(
+                update(SubscriberLease).where(SubscriberLease.stream_id == stream_id).values(expires=expires)
+            )
+            session.commit()
+            if result.rowcount == 0:
+                try:
+                    session.add(SubscriberLease(stream_id=stream_id, expires=expires))
+                    session.commit()
+                except IntegrityError:
+                    # renewed by a subscriber in another worker
+                    session.rollback()
+        return True
+
+    def tail(self, stream_id):
+        """return the cursor of the last published update of a stream"""
+        with Session(db.engine) as session:
+            statement = select(func.max(PublishedUpdate.id)).where(PublishedUpdate.stream_id == stream_id)
+            return session.exec(statement).one() or 0
+
+    def read(self, stream_id, cursor, limit):
+        """return up to limit published updates of a stream after cursor, oldest first"""
+        with Session(db.engine) as session:
+            statement = (
+                select(PublishedUpdate)
+                .where(PublishedUpdate.stream_id == stream_id, PublishedUpdate.id > cursor)
+                .order_by(PublishedUpdate.id)
+                .limit(limit)
+            )
+            return session.exec(statement).all()
+
+
+class Publisher:
+    """dispatcher consumer publishing the updates of subscribed streams"""
+
+    def __init__(self, store=None, retention=None):
+        self.store = store or PublishStore()
+        self.retention = retention or settings.SUBSCRIBE_RETENTION
+        self.prune_at = 0.0
+        self.published = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} published={self.published}>"
+
+    async def publish(self, updates):
+        # paused streams retain their updates in the spool until they are active again
+        updates = [update for update in updates if not update.route.paused]
+        now = time.time()
+        count = await asyncio.to_thread(self.store.publish, updates, now)
+        if count:
+            self.published += count
+            notifier.notify()
+        if now >= self.prune_at:
+            self.prune_at = now + self.retention / 4
+            await asyncio.to_thread(self.store.prune, now, now - self.retention)
+
+
+class Subscription:
+    """one subscriber's server-sent event stream of a stream's published updates"""
+
+    def __init__(self, route, cursor=None, store=None, buffer=None, poll=None, keepalive=None, retention=None):
+        self.route = route
+        self.cursor = cursor
+        self.store = store or PublishStore()
+        self.buffer = buffer or settings.SUBSCRIBE_BUFFER
+        self.poll = poll or settings.SUBSCRIBE_POLL
+        self.keepalive = keepalive or settings.SUBSCRIBE_KEEPALIVE
+        self.retention = retention or settings.SUBSCRIBE_RETENTION
+        self.renewed = 0.0
+        self.sent = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.route.stream_id} cursor={self.cursor} sent={self.sent}>"
+
+    async def open(self):
+        """take the subscriber lease; without a cursor, start after the updates already published"""
+        await self.renew()
+        if self.cursor is None:
+            self.cursor = await asyncio.to_thread(self.store.tail, self.route.id)
+
+    async def renew(self):
+        """renew the lease when a third of it has run, returning False if the stream was deleted"""
+        now = time.time()
+        if now - self.renewed < self.retention / 3:
+            return True
+        self.renewed = now
+        return await asyncio.to_thread(self.store.renew, self.route.id, now + self.retention)
+
+    def message(self, row):
+        update = Update(self.route, row.shared, row.block_number, row.confirmed, row.retries)
+        return b"id: %d\nevent: update\ndata: " % row.id + update.encode() + b"\n\n"
+
+    async def events(self):
+        """yield server-sent event messages until the stream is deleted or the consumer stops iterating"""
+        yield b"retry: %d\n\n" % RECONNECT_MS
+        idle = time.monotonic()
+        while await self.renew():
+            waiter = notifier.waiter()
+            rows = await asyncio.to_thread(self.store.read, self.route.id, self.cursor, self.buffer)
+            for row in rows:
+                self.cursor = row.id
+                self.sent += 1
+                yield self.message(row)
+            if len(rows) == self.buffer:
+                continue
+            now = time.monotonic()
+            if rows:
+                idle = now
+            elif now - idle >= self.keepalive:
+                idle = now
+                yield b": keepalive\n\n"
+            await notifier.wait(waiter, self.poll)
+        logger.info(f"{self.route} was deleted, ending {self}")
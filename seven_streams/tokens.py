@@ -0,0 +1,222 @@
+# token transfer and approval classifier
+
+"""fill the ERC20 and NFT transfer and approval payload fields
+
+Logs with the standard Transfer, Approval, ApprovalForAll, TransferSingle
+and TransferBatch topic hashes are classified by their topic count and
+decoded directly from topics and data.  Token name, symbol and decimals are
+read with eth_call, batched per block and cached per contract.
+"""
+
+import logging
+from collections import OrderedDict
+from decimal import Decimal
+
+from eth_abi import decode
+from eth_utils import event_signature_to_log_topic, to_bytes, to_hex
+
+from . import settings
+from .poller import to_int
+
+logger = logging.getLogger(__name__)
+
+TRANSFER = to_hex(event_signature_to_log_topic("Transfer(address,address,uint256)"))
+APPROVAL = to_hex(event_signature_to_log_topic("Approval(address,address,uint256)"))
+APPROVAL_FOR_ALL = to_hex(event_signature_to_log_topic("ApprovalForAll(address,address,bool)"))
+TRANSFER_SINGLE = to_hex(event_signature_to_log_topic("TransferSingle(address,address,address,uint256,uint256)"))
+TRANSFER_BATCH = to_hex(event_signature_to_log_topic("TransferBatch(address,address,address,uint256[],uint256[])"))
+
+TOPICS = frozenset([TRANSFER, APPROVAL, APPROVAL_FOR_ALL, TRANSFER_SINGLE, TRANSFER_BATCH])
+
+# function selectors of the token metadata getters
+NAME = "0x06fdde03"
+SYMBOL = "0x95d89b41"
+DECIMALS = "0x313ce567"
+
+# the Payload attributes holding each kind of record
+ERC20_TRANSFER = "erc20_transfers"
+ERC20_APPROVAL = "erc20_approvals"
+NFT_TRANSFER = "nft_transfers"
+NFT_APPROVAL = "nft_approvals"
+
+
+def _address(topic):
+    return "0x" + topic[-40:].lower()
+
+
+def _uint(value):
+    return str(int(value, 16)) if isinstance(value, str) else str(value)
+
+
+def _words(data):
+    data = (data or "0x")[2:]
+    return [data[i : i + 64] for i in range(0, len(data), 64)]
+
+
+def _string(result):
+    """decode a string or bytes32 eth_call result"""
+    data = to_bytes(hexstr=result or "0x")
+    if len(data) == 32:
+        return data.rstrip(b"\0").decode(errors="replace")
+    return decode(["string"], data)[0]
+
+
+def classify(log, erc1155=()):
+    """return a list of (field, record, contract type) for a token log, or an empty list
+
+    ApprovalForAll is shared by ERC721 and ERC1155; it is classified as ERC1155
+    when its contract is in erc1155.
+    """
+    topics = log["topics"]
+    topic0 = topics[0].lower() if topics else None
+    if topic0 not in TOPICS:
+        return []
+    contract = log["address"].lower()
+    base = dict(transactionHash=log["transactionHash"], logIndex=str(to_int(log["logIndex"])), contract=contract)
+    words = _words(log["data"])
+    if topic0 == TRANSFER and len(topics) == 3 and len(words) == 1:
+        record = dict(base, **{"from": _address(topics[1]), "to": _address(topics[2]), "value": _uint("0x" + words[0])})
+        return [(ERC20_TRANSFER, record, "ERC20")]
+    if topic0 == TRANSFER and len(topics) == 4:
+        record = dict(base, operator=None, tokenId=_uint(topics[3]), amount="1")
+        record.update({"from": _address(topics[1]), "to": _address(topics[2])})
+        return [(NFT_TRANSFER, record, "ERC721")]
+    if topic0 == APPROVAL and len(topics) == 3 and len(words) == 1:
+        record = dict(base, owner=_address(topics[1]), spender=_address(topics[2]), value=_uint("0x" + words[0]))
+        return [(ERC20_APPROVAL, record, "ERC20")]
+    if topic0 == APPROVAL and len(topics) == 4:
+        record = dict(base, account=_address(topics[1]), operator=_address(topics[2]), approvedAll=False)
+        return [(NFT_APPROVAL, dict(record, tokenId=_uint(topics[3])), "ERC721")]
+    if topic0 == APPROVAL_FOR_ALL and len(topics) == 3 and len(words) == 1:
+        record = dict(base, account=_address(topics[1]), operator=_address(topics[2]), tokenId=None)
+        record["approvedAll"] = int(words[0], 16) != 0
+        return [(NFT_APPROVAL, record, "ERC1155" if contract in erc1155 else "ERC721")]
+    if topic0 == TRANSFER_SINGLE and len(topics) == 4 and len(words) == 2:
+        record = dict(base, operator=_address(topics[1]), tokenId=_uint("0x" + words[0]), amount=_uint("0x" + words[1]))
+        record.update({"from": _address(topics[2]), "to": _address(topics[3])})
+        return [(NFT_TRANSFER, record, "ERC1155")]
+    if topic0 == TRANSFER_BATCH and len(topics) == 4:
+        try:
+            ids, values = decode(["uint256[]", "uint256[]"], to_bytes(hexstr=log["data"]))
+        except Exception as exc:
+            logger.debug(f"invalid TransferBatch data in log {log['logIndex']}: {exc}")
+            return []
+        base.update({"operator": _address(topics[1]), "from": _address(topics[2]), "to": _address(topics[3])})
+        return [
+            (NFT_TRANSFER, dict(base, tokenId=str(id), amount=str(value)), "ERC1155") for id, value in zip(ids, values)
+        ]
+    return []
+
+
+class TokenMetadata:
+    """token name, symbol and decimals by contract address, read with batched eth_call and LRU cached"""
+
+    def __init__(self, rpc, size=None):
+        self.rpc = rpc
+        self.size = size or settings.TOKEN_CACHE_SIZE
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} size={len(self.cache)} hits={self.hits} misses={self.misses}>"
+
+    def _put(self, contract, metadata):
+        self.cache[contract] = metadata
+        self.cache.move_to_end(contract)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def get(self, contracts):
+        """return a dict of contract address to dict(name, symbol, decimals)"""
+        result = {}
+        missing = []
+        for contract in contracts:
+            if contract in self.cache:
+                self.cache.move_to_end(contract)
+                result[contract] = self.cache[contract]
+                self.hits += 1
+            else:
+                missing.append(contract)
+        if missing:
+            self.misses += len(missing)
+            calls = [
+                ("eth_call", [dict(to=contract, data=selector), "latest"])
+                for contract in missing
+                for selector in (NAME, SYMBOL, DECIMALS)
+            ]
+            responses = await self.rpc.batch(calls, return_exceptions=True)
+            for i, contract in enumerate(missing):
+                name, symbol, decimals = responses[i * 3 : i * 3 + 3]
+                metadata = dict(
+                    name=self._decode(_string, name),
+                    symbol=self._decode(_string, symbol),
+                    decimals=self._decode(lambda r: int(r, 16), decimals),
+                )
+                # failed calls are cached too, so contracts without metadata are not queried every block
+                self._put(contract, metadata)
+                result[contract] = metadata
+        return result
+
+    def _decode(self, decoder, response):
+        if response is None or isinstance(response, Exception) or response == "0x":
+            return None
+        try:
+            return decoder(response)
+        except Exception:
+            return None
+
+
+def _value_with_decimals(value, decimals):
+    if decimals is None:
+        return None
+    return str(Decimal(value).scaleb(-decimals).normalize())
+
+
+class TokenStage:
+    """dispatcher stage filling the token transfer and approval fields of each payload"""
+
+    def __init__(self, rpc, metadata=None):
+        self.metadata = metadata or TokenMetadata(rpc)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.metadata}>"
+
+    async def __call__(self, block, groups, payloads):
+        logs = {}
+        for log_list, routes in groups.values():
+            for log in log_list:
+                logs[log["logIndex"]] = log
+        erc1155 = set(
+            log["address"].lower()
+            for log in logs.values()
+            if log["topics"] and log["topics"][0].lower() in (TRANSFER_SINGLE, TRANSFER_BATCH)
+        )
+        classified = {}
+        for index, log in logs.items():
+            records = classify(log, erc1155)
+            if records:
+                classified[index] = records
+        if not classified:
+            return
+        contracts = set(record["contract"] for records in classified.values() for _, record, _ in records)
+        metadata = await self.metadata.get(sorted(contracts))
+        for records in classified.values():
+            for field, record, contract_type in records:
+                token = metadata.get(record["contract"], {})
+                record.update(tokenName=token.get("name"), tokenSymbol=token.get("symbol"))
+                if field in (ERC20_TRANSFER, ERC20_APPROVAL):
+                    record.update(
+                        tokenDecimals=token.get("decimals"),
+                        valueWithDecimals=_value_with_decimals(record["value"], token.get("decimals")),
+                    )
+                else:
+                    record["tokenContractType"] = contract_type
+        for key, (log_list, routes) in groups.items():
+            payload = payloads[key]
+            for log in log_list:
+                for field, record, contract_type in classified.get(log["logIndex"], ()):
+                    if field == NFT_APPROVAL:
+                        payload.nft_approvals[contract_type].append(record)
+                    else:
+                        getattr(payload, field).append(record)
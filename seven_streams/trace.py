@@ -0,0 +1,191 @@
+# internal transaction tracer
+
+"""fill the txsInternal payload field from debug_traceTransaction
+
+Only the transactions of logs matched by a stream with includeInternalTxs
+are traced.  Traces run with bounded concurrency, their parsed results are
+cached by transaction hash so replays and other streams do not trace again,
+and parsing runs in a worker thread off the event loop.
+
+Nodes with the callTracer return a call frame tree; otherwise (TRACE_TRACER
+set empty, as for hardhat's default tracer) the internal calls are
+recovered from the CALL opcodes of the struct logs.
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+CALL_OPS = ("CALL", "CALLCODE", "DELEGATECALL", "STATICCALL")
+
+
+def _int(value):
+    if isinstance(value, str):
+        return int(value, 16) if value else 0
+    return int(value or 0)
+
+
+def _internal(tx_hash, type, from_address, to_address, value, gas):
+    return {
+        "transactionHash": tx_hash,
+        "type": type,
+        "from": from_address.lower(),
+        "to": to_address.lower(),
+        "value": str(value),
+        "gas": str(gas),
+    }
+
+
+def parse_call_trace(tx_hash, frame):
+    """return the internal transactions of a callTracer frame tree, in call order"""
+    internal = []
+    pending = list(reversed(frame.get("calls") or []))
+    while pending:
+        call = pending.pop()
+        if call.get("to"):
+            internal.append(
+                _internal(
+                    tx_hash,
+                    call.get("type", "CALL"),
+                    call["from"],
+                    call["to"],
+                    _int(call.get("value")),
+                    _int(call.get("gas")),
+                )
+            )
+        pending.extend(reversed(call.get("calls") or []))
+    return internal
+
+
+def parse_struct_logs(tx_hash, to_address, struct_logs):
+    """return the internal transactions recovered from the CALL opcodes of a struct log trace"""
+    internal = []
+    # the address whose context executes at each call depth
+    contexts = [to_address]
+    for log in struct_logs:
+        op = log.get("op")
+        if op not in CALL_OPS:
+            continue
+        depth = log["depth"]
+        del contexts[depth:]
+        stack = log["stack"]
+        current = contexts[-1]
+        target = "0x" + stack[-2][-40:]
+        value = _int(stack[-3]) if op in ("CALL", "CALLCODE") else 0
+        internal.append(_internal(tx_hash, op, current, target, value, _int(stack[-1])))
+        contexts.append(target if op in ("CALL", "STATICCALL") else current)
+    return internal
+
+
+class TraceCache:
+    """LRU cache of parsed internal transactions by transaction hash"""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} size={len(self.entries)} hits={self.hits} misses={self.misses}>"
+
+    def get(self, tx_hash):
+        if tx_hash in self.entries:
+            self.entries.move_to_end(tx_hash)
+            self.hits += 1
+            return self.entries[tx_hash]
+        self.misses += 1
+        return None
+
+    def put(self, tx_hash, internal):
+        self.entries[tx_hash] = internal
+        self.entries.move_to_end(tx_hash)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Tracer:
+    """trace transactions with bounded concurrency, caching the parsed results"""
+
+    def __init__(self, rpc, concurrency=None, cache_size=None, tracer=None):
+        self.rpc = rpc
+        self.semaphore = asyncio.Semaphore(concurrency or settings.TRACE_CONCURRENCY)
+        self.cache = TraceCache(cache_size or settings.TRACE_CACHE_SIZE)
+        self.tracer = settings.TRACE_TRACER if tracer is None else tracer
+        self.inflight = {}
+        self.traced = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} tracer={self.tracer or 'default'} traced={self.traced} {self.cache}>"
+
+    async def _trace(self, tx_hash):
+        async with self.semaphore:
+            if self.tracer:
+                result = await self.rpc.call("debug_traceTransaction", tx_hash, dict(tracer=self.tracer))
+                to_address = None
+            else:
+                tx, result = await self.rpc.batch(
+                    [
+                        ("eth_getTransactionByHash", [tx_hash]),
+                        ("debug_traceTransaction", [tx_hash, dict(disableStorage=True, disableMemory=True)]),
+                    ]
+                )
+                to_address = (tx or {}).get("to")
+        self.traced += 1
+        if self.tracer:
+            return await asyncio.to_thread(parse_call_trace, tx_hash, result or {})
+        if not to_address:
+            # contract creation: the created address is not known to the struct log trace
+            return []
+        return await asyncio.to_thread(parse_struct_logs, tx_hash, to_address, (result or {}).get("structLogs", []))
+
+    async def trace(self, tx_hash):
+        """return the list of internal transactions of tx_hash"""
+        internal = self.cache.get(tx_hash)
+        if internal is not None:
+            return internal
+        if tx_hash not in self.inflight:
+            self.inflight[tx_hash] = asyncio.ensure_future(self._trace(tx_hash))
+        try:
+            internal = await self.inflight[tx_hash]
+        finally:
+            self.inflight.pop(tx_hash, None)
+        self.cache.put(tx_hash, internal)
+        return internal
+
+    async def trace_all(self, tx_hashes):
+        """return a dict of transaction hash to internal transactions, omitting failed traces"""
+        results = await asyncio.gather(*[self.trace(tx_hash) for tx_hash in tx_hashes], return_exceptions=True)
+        traces = {}
+        for tx_hash, result in zip(tx_hashes, results):
+            if isinstance(result, Exception):
+                logger.warning(f"trace of {tx_hash} failed: {result.__class__.__name__}: {result}")
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                traces[tx_hash] = result
+        return traces
+
+
+class TraceStage:
+    """dispatcher stage filling the txsInternal field for streams with includeInternalTxs"""
+
+    def __init__(self, rpc, tracer=None):
+        self.tracer = tracer or Tracer(rpc)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.tracer}>"
+
+    async def __call__(self, block, groups, payloads):
+        wanted = [key for key, (logs, routes) in groups.items() if routes[0].include_internal_txs]
+        if not wanted:
+            return
+        hashes = list(dict.fromkeys(log["transactionHash"] for key in wanted for log in groups[key][0]))
+        traces = await self.tracer.trace_all(hashes)
+        for key in wanted:
+            tx_hashes = dict.fromkeys(log["transactionHash"] for log in groups[key][0])
+            payloads[key].txs_internal = [internal for h in tx_hashes for internal in traces.get(h, [])]
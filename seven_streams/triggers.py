@@ -0,0 +1,176 @@
+# stream trigger evaluation
+
+"""evaluate stream triggers with block-pinned eth_call
+
+A trigger entry names a record type, a contract, a view function ABI and
+its inputs, as in
+
+    {"type": "erc20transfer", "contractAddress": "$contract",
+     "functionAbi": {"name": "balanceOf", "type": "function", ...},
+     "inputs": ["$to"]}
+
+where "$name" values are taken from each record of the type and other values
+are literals.  Log triggers may set topic0 to apply to those logs only.
+Triggers are parsed once per stream when the routing table is loaded.  The
+calls of every stream matching a block are deduplicated by (contract,
+calldata, from) and sent as one JSON-RPC batch pinned to the block number;
+each record gets a "triggers" list of dict(name, value) results.
+"""
+
+import logging
+
+from eth_abi import decode, encode
+from eth_utils import function_abi_to_4byte_selector, to_bytes, to_hex
+
+from . import json
+from .decode import canonical_type, payload_value, topic_hash
+
+logger = logging.getLogger(__name__)
+
+
+def _select(record, value):
+    if isinstance(value, str) and value.startswith("$"):
+        return record.get(value[1:])
+    return value
+
+
+def _argument(abi_type, value):
+    """convert a payload or literal value to the python type eth_abi encodes as abi_type"""
+    if value is None:
+        raise ValueError(f"missing {abi_type} input")
+    if abi_type.startswith(("uint", "int")):
+        return int(value, 0) if isinstance(value, str) else int(value)
+    if abi_type == "bool":
+        return value if isinstance(value, bool) else str(value).lower() == "true"
+    if abi_type.startswith("bytes"):
+        return to_bytes(hexstr=value) if isinstance(value, str) else bytes(value)
+    return value
+
+
+class Trigger:
+    """a parsed trigger entry"""
+
+    def __init__(self, entry):
+        function = entry["functionAbi"]
+        self.type = str(entry.get("type", "tx")).lower()
+        self.name = entry.get("name") or function["name"]
+        self.contract = entry["contractAddress"]
+        self.inputs = list(entry.get("inputs", []))
+        self.call_from = entry.get("callFrom")
+        self.topic0 = topic_hash(entry["topic0"]) if entry.get("topic0") else None
+        self.selector = function_abi_to_4byte_selector(function)
+        self.input_types = [canonical_type(input) for input in function.get("inputs", [])]
+        self.output_types = [canonical_type(output) for output in function.get("outputs", [])]
+        if len(self.inputs) != len(self.input_types):
+            raise ValueError(f"{self.name} takes {len(self.input_types)} inputs, {len(self.inputs)} given")
+        self.key = json.dumps(entry, sort_keys=True)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.type} {self.name}>"
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Trigger) and other.key == self.key
+
+    def call(self, record):
+        """return the (to, data, from) eth_call key for record, or None if it cannot be built"""
+        contract = _select(record, self.contract)
+        if not isinstance(contract, str) or not contract.startswith("0x"):
+            return None
+        try:
+            arguments = [_argument(t, _select(record, v)) for t, v in zip(self.input_types, self.inputs)]
+            data = to_hex(self.selector + encode(self.input_types, arguments))
+        except Exception as exc:
+            logger.debug(f"{self} cannot encode call for {record}: {exc}")
+            return None
+        return (contract.lower(), data, _select(record, self.call_from) if self.call_from else None)
+
+    def result(self, output):
+        """return the payload value of an eth_call result"""
+        values = decode(self.output_types, to_bytes(hexstr=output))
+        values = [payload_value(t, v) for t, v in zip(self.output_types, values)]
+        return values[0] if len(values) == 1 else values
+
+
+def parse(entries):
+    """return the tuple of Triggers of a stream's triggers list, skipping invalid entries"""
+    if isinstance(entries, str):
+        entries = json.loads(entries)
+    triggers = []
+    for entry in entries or []:
+        try:
+            triggers.append(Trigger(entry))
+        except (KeyError, TypeError, ValueError) as exc:
+            logger.warning(f"invalid trigger {entry}: {exc}")
+    return tuple(triggers)
+
+
+class TriggerStage:
+    """dispatcher stage evaluating stream triggers; runs after the stages that fill the trigger records"""
+
+    def __init__(self, rpc):
+        self.rpc = rpc
+        self.calls = 0
+        self.deduplicated = 0
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} calls={self.calls} deduplicated={self.deduplicated}>"
+
+    def _plan(self, payload, triggers):
+        """return a list of (type, record index, trigger, call key) for a payload"""
+        plan = []
+        for trigger in triggers:
+            for index, record in enumerate(payload.records(trigger.type)):
+                if trigger.topic0 and trigger.type == "log":
+                    topics = payload.logs[index]["topics"]
+                    if not topics or topics[0].lower() != trigger.topic0:
+                        continue
+                key = trigger.call(record)
+                if key is not None:
+                    plan.append((trigger.type, index, trigger, key))
+        return plan
+
+    async def _call(self, block, keys):
+        tag = hex(block.number)
+        calls = []
+        for to, data, call_from in keys:
+            call = dict(to=to, data=data)
+            if call_from:
+                call["from"] = call_from
+            calls.append(("eth_call", [call, tag]))
+        self.calls += len(calls)
+        return dict(zip(keys, await self.rpc.batch(calls, return_exceptions=True)))
+
+    def _attach(self, payload, plan, outputs):
+        results = {}
+        for type, index, trigger, key in plan:
+            output = outputs.get(key)
+            value = None
+            if output is not None and not isinstance(output, Exception):
+                try:
+                    value = trigger.result(output)
+                except Exception as exc:
+                    logger.debug(f"{trigger} cannot decode {output}: {exc}")
+            results.setdefault((type, index), []).append(dict(name=trigger.name, value=value))
+        for (type, index), triggers in results.items():
+            if type == "log":
+                payload.log_triggers[payload.logs[index]["logIndex"]] = triggers
+            else:
+                # records may be shared with payloads of other streams, so the result goes on a copy
+                records = getattr(payload, payload.RECORDS[type])
+                records[index] = dict(records[index], triggers=triggers)
+
+    async def __call__(self, block, groups, payloads):
+        plans = {}
+        for key, (logs, routes) in groups.items():
+            if routes[0].triggers:
+                plans[key] = self._plan(payloads[key], routes[0].triggers)
+        keys = list(dict.fromkeys(entry[3] for plan in plans.values() for entry in plan))
+        if not keys:
+            return
+        self.deduplicated += sum(len(plan) for plan in plans.values()) - len(keys)
+        outputs = await self._call(block, keys)
+        for key, plan in plans.items():
+            self._attach(payloads[key], plan, outputs)
@@ -1,11 +1,21 @@
+import asyncio
 import logging
 import os
+from collections import Counter
+from uuid import uuid4
 
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from hardhat_event_streams.app import app
-from hardhat_event_streams.client import HardhatEventStreams
+from hardhat_event_streams.client import AsyncHardhatEventStreams, HardhatEventStreams
 from hardhat_event_streams.db import CRUD, get_db
+from hardhat_event_streams.dispatch import Dispatcher, Update
+from hardhat_event_streams.loadgen import BlockGenerator, FakeRPC
+from hardhat_event_streams.poller import Block
+from hardhat_event_streams.router import StreamRoute, StreamRouter
+from hardhat_event_streams.rpc import RPCError
+from hardhat_event_streams.schema import EventStream
 from seven_common.schema import Contract
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.pool import StaticPool
@@ -61,3 +71,212 @@ def streams(crud):
         streams = server.streams
         yield streams
     app.dependency_overrides.clear()
+
+
+@pytest.fixture()
+async def async_streams(crud):
+    def get_test_db():
+        return crud
+
+    app.dependency_overrides[get_db] = get_test_db
+    async with httpx.AsyncClient(app=app, base_url="http://testserver") as client:
+        server = AsyncHardhatEventStreams(requests=client, url=str(client.base_url))
+        yield server.streams
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def generator():
+    return BlockGenerator(logs_per_block=8, txs_per_block=4, topic0=["Transfer(address,address,uint256)"])
+
+
+@pytest.fixture
+def blocks(generator):
+    """return a function returning the generator blocks of block numbers as poller Blocks"""
+
+    def _blocks(*numbers):
+        return [Block(generator.chain_id, rpc_block, rpc_block["logs"]) for rpc_block in map(generator.block, numbers)]
+
+    return _blocks
+
+
+@pytest.fixture
+def block(blocks):
+    return blocks(1)[0]
+
+
+@pytest.fixture
+def route():
+    def _route(id, tag, addresses, status="active", **kwargs):
+        kwargs.setdefault("abi", [{"name": "Transfer", "type": "event"}])
+        stream = EventStream(
+            id=id,
+            streamId=uuid4(),
+            tag=tag,
+            webhookUrl=f"http://localhost:8081/{tag}",
+            topic0=["Transfer(address,address,uint256)"],
+            chainIds=["0x7a69"],
+            status=status,
+            version=1,
+            **kwargs,
+        )
+        return StreamRoute(stream, addresses)
+
+    return _route
+
+
+@pytest.fixture
+def dispatcher(generator, route):
+    """return a function building a Dispatcher and its router for streams given by tag
+
+    Each keyword argument names a stream tag and gives its EventStream fields,
+    with the generator addresses unless they include addresses.  Streams are
+    numbered from 1 in argument order.
+    """
+
+    def _dispatcher(delivery=None, stages=None, publisher=None, checkpoints=None, **streams):
+        routes = []
+        for id, (tag, fields) in enumerate(streams.items(), 1):
+            fields = dict(fields)
+            routes.append(route(id, tag, fields.pop("addresses", generator.addresses), **fields))
+        router = StreamRouter()
+        router.load(routes)
+        return Dispatcher(router, delivery, stages=stages, publisher=publisher, checkpoints=checkpoints)
+
+    return _dispatcher
+
+
+@pytest.fixture
+def transfer_abi():
+    return [
+        {
+            "anonymous": False,
+            "inputs": [
+                {"indexed": True, "name": "from", "type": "address"},
+                {"indexed": True, "name": "to", "type": "address"},
+                {"indexed": False, "name": "value", "type": "uint256"},
+            ],
+            "name": "Transfer",
+            "type": "event",
+        }
+    ]
+
+
+class GeneratorRPC:
+    """rpc client answering from a FakeRPC, counting the requests of each method and the batches in flight"""
+
+    def __init__(self, generator, delay=0):
+        self.rpc = FakeRPC(generator)
+        self.delay = delay
+        self.calls = 0
+        self.batches = 0
+        self.methods = Counter()
+        # the (method, params) calls of each batch
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def call(self, method, *params):
+        return (await self.batch([(method, params)]))[0]
+
+    async def batch(self, calls, return_exceptions=False):
+        self.calls += len(calls)
+        self.batches += 1
+        self.methods.update(method for method, params in calls)
+        self.requests.append(list(calls))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        results = []
+        for method, params in calls:
+            response = self.rpc.handle(dict(method=method, params=params))
+            if "error" in response:
+                if not return_exceptions:
+                    raise RPCError(**response["error"])
+                results.append(RPCError(**response["error"]))
+            else:
+                results.append(response["result"])
+        return results
+
+
+@pytest.fixture
+def rpc(generator):
+    return GeneratorRPC(generator)
+
+
+class RecordingSender:
+    """webhook sender recording delivered batches and refusing those with a refused (stream id, block number)"""
+
+    def __init__(self, refused=()):
+        self.batches = []
+        self.refused = set(refused)
+        self.errors = {}
+
+    async def send(self, route, updates):
+        if any((route.id, update.block_number) in self.refused for update in updates):
+            self.errors[route.id] = "refused"
+            return False
+        self.batches.append((route, list(updates)))
+        return True
+
+    async def aclose(self):
+        pass
+
+    def delivered(self):
+        """return the delivered block numbers by stream id"""
+        delivered = {}
+        for route, updates in self.batches:
+            delivered.setdefault(route.id, []).extend(update.block_number for update in updates)
+        return delivered
+
+
+@pytest.fixture
+def sender():
+    return RecordingSender()
+
+
+class MemoryStore:
+    """in-memory UpdateStore"""
+
+    def __init__(self):
+        self.updates = []
+        self.taken = []
+        self.errors = {}
+        self.dead = []
+
+    def write(self, updates):
+        self.updates.extend(Update(u.route, u.shared, u.block_number, u.confirmed, u.retries) for u in updates)
+
+    def _pending(self):
+        return [update for update in self.updates if update not in self.taken]
+
+    def read(self, route, limit):
+        updates = [update for update in self._pending() if update.route.id == route.id][:limit]
+        self.taken.extend(updates)
+        return [Update(u.route, u.shared, u.block_number, u.confirmed, u.retries, stored=(self, u)) for u in updates]
+
+    def acknowledge(self, updates):
+        stored = [update.stored[1] for update in updates]
+        self.updates = [update for update in self.updates if update not in stored]
+        self.taken = [update for update in self.taken if update not in stored]
+
+    def streams(self):
+        return set(update.route.id for update in self._pending())
+
+    def discard(self, stream_id):
+        self.updates = [update for update in self.updates if update.route.id != stream_id]
+        self.taken = [update for update in self.taken if update.route.id != stream_id]
+
+    def set_error(self, stream_id, message):
+        self.errors[stream_id] = message
+
+    def dead_letter(self, updates, error):
+        self.dead.extend((update, error) for update in updates)
+
+
+@pytest.fixture
+def store():
+    return MemoryStore()
@@ -0,0 +1,34 @@
+from logging import info
+
+from seven_common.streams import EventStream
+
+
+def _body(contract, tag, webhook_url):
+    event_stream = EventStream.from_contract(contract, webhook_url, tag=tag)
+    return event_stream.dict(exclude={"id", "status", "statusMessage"})
+
+
+async def test_async_create_streams(async_streams, api_key, ethersieve, webhook_url):
+    tags = [f"async-{i}" for i in range(20)]
+    bodies = [_body(ethersieve, tag, webhook_url) for tag in tags]
+    created = await async_streams.evm_streams.create_streams(api_key, bodies, concurrency=4)
+    assert set(stream["tag"] for stream in created) == set(tags)
+
+    ret = await async_streams.evm_streams.get_streams(api_key, params=dict(limit=100, cursor=""))
+    assert ret["total"] == len(tags)
+
+    addresses = await async_streams.evm_streams.get_all_addresses(api_key)
+    assert set(addresses.keys()) == set(stream["id"] for stream in created)
+    assert all(address == [] for address in addresses.values())
+    info(addresses)
+
+    deleted = await async_streams.evm_streams.delete_streams(api_key, addresses.keys())
+    assert len(deleted) == len(tags)
+    ret = await async_streams.evm_streams.get_streams(api_key, params=dict(limit=100, cursor=""))
+    assert ret["result"] == []
+
+
+async def test_async_settings(async_streams, api_key):
+    setting = {"region": "us-east-1"}
+    assert await async_streams.project.set_settings(api_key, setting) == setting
+    assert await async_streams.project.get_settings(api_key) == setting
@@ -0,0 +1,57 @@
+from eth_utils import to_hex
+from hardhat_event_streams.balances import BalanceCache, BalanceStage
+from hardhat_event_streams.fetch import TransactionStage
+from hardhat_event_streams.schema import ContractEventUpdate
+
+
+def _balance(address, block_number):
+    # the balance FakeRPC answers for address at block_number
+    return str(int(address[-8:], 16) * 10**9 + block_number)
+
+
+async def test_balance_stage(generator, blocks, dispatcher, rpc):
+    selectors = [dict(type="tx", selectors=["$fromAddress", "$toAddress"])]
+    literal = generator.addresses[-1]
+    stage = BalanceStage(rpc)
+    dispatcher = dispatcher(
+        one=dict(getNativeBalances=selectors),
+        two=dict(getNativeBalances=selectors, abi=[]),
+        senders=dict(getNativeBalances=[dict(type="tx", selectors=["$fromAddress", literal])]),
+        none={},
+        stages=[TransactionStage(rpc), stage],
+    )
+    first, second = blocks(1, 2)
+    updates = {update.route.tag: update for update in await dispatcher.dispatch(first)}
+    update = ContractEventUpdate.parse_raw(updates["one"].encode())
+    senders = list(dict.fromkeys(to_hex(tx.fromAddress) for tx in update.txs))
+    expected = list(dict.fromkeys(senders + [to_hex(tx.toAddress) for tx in update.txs]))
+    assert update.nativeBalances == [dict(address=a, balance=_balance(a, first.number)) for a in expected]
+    assert ContractEventUpdate.parse_raw(updates["two"].encode()).nativeBalances == update.nativeBalances
+    selected = ContractEventUpdate.parse_raw(updates["senders"].encode()).nativeBalances
+    assert [balance["address"] for balance in selected] == list(dict.fromkeys(senders + [literal]))
+    assert ContractEventUpdate.parse_raw(updates["none"].encode()).nativeBalances is None
+
+    # the addresses of every stream are looked up in one batch per block
+    assert rpc.methods["eth_getBalance"] == len(set(expected + [literal]))
+    assert stage.cache.misses == rpc.methods["eth_getBalance"]
+    calls = rpc.calls
+    await dispatcher.dispatch(first)
+    assert rpc.calls == calls
+
+    # balances are cached by block, so the next block is looked up again
+    update = ContractEventUpdate.parse_raw((await dispatcher.dispatch(second))[0].encode())
+    assert all(balance["balance"] == _balance(balance["address"], second.number) for balance in update.nativeBalances)
+
+
+async def test_balance_cache_size(generator, rpc):
+    cache = BalanceCache(rpc, size=3)
+    addresses = generator.addresses[:4]
+    balances = await cache.get(1, addresses)
+    assert balances == {address: _balance(address, 1) for address in addresses}
+    assert rpc.batches == 1
+    # the least recently used entries are evicted
+    assert list(cache.entries) == [(1, address) for address in addresses[1:]]
+    await cache.get(1, addresses[1:])
+    assert (rpc.batches, cache.hits) == (1, 3)
+    await cache.get(1, addresses[:1])
+    assert rpc.batches == 2
@@ -0,0 +1,17 @@
+from hardhat_event_streams import bench, eventstore, settings
+
+
+def test_bench_segment_event_store(api_key, tmp_path, monkeypatch):
+    directory = tmp_path / "events"
+    directory.mkdir()
+    (directory / "000000000000.seg").write_bytes(b"stored events")
+    monkeypatch.setattr(settings, "EVENT_STORE", "segment")
+    monkeypatch.setattr(settings, "EVENT_STORE_DIRECTORY", str(directory))
+    monkeypatch.setattr(eventstore, "_segment_store", None)
+
+    results = bench.run(suites=["events_list"], count=2, api_key=api_key)
+    assert results["results"]["events_list"]["events"] == 20
+    # the benchmark posts and deletes events in a temporary store, leaving the configured one alone
+    assert [path.name for path in directory.iterdir()] == ["000000000000.seg"]
+    assert (directory / "000000000000.seg").read_bytes() == b"stored events"
+    assert eventstore._segment_store is None
@@ -0,0 +1,34 @@
+from hardhat_event_streams.bloom import StreamBloom
+from hardhat_event_streams.loadgen import BlockGenerator
+from hardhat_event_streams.poller import ChainPoller
+
+
+async def test_bloom_prefilter(block, route, rpc, dispatcher):
+    other = BlockGenerator(seed=7).addresses
+    routes = {1: route(1, "other", other)}
+    bloom = StreamBloom()
+    bloom.reload(routes)
+    assert not bloom.may_match(block.header)
+    hashed, skipped = bloom.hashed, bloom.skipped
+
+    # the poller fetches the header and logs in one batch whatever the bloom, so every log is ingested
+    poller = ChainPoller(rpc)
+    poller.chain_id = block.chain_id
+    assert len((await poller.fetch_block(1)).logs) == len(block.logs)
+    assert rpc.batches == 1
+
+    # the dispatcher routes nothing for a block no stream can match
+    dispatcher = dispatcher(other=dict(addresses=other))
+    dispatcher.bloom = bloom
+    assert await dispatcher.dispatch(block) == []
+    assert bloom.skipped == skipped + 1
+
+    # adding an address hashes only the new value
+    routes = {1: route(1, "other", other + [block.logs[0]["address"]])}
+    bloom.reload(routes)
+    assert bloom.hashed == hashed + 1
+    assert bloom.may_match(block.header)
+
+    # allAddresses streams match on topic0 alone
+    bloom.reload({2: route(2, "all", [], allAddresses=True)})
+    assert bloom.may_match(block.header)
@@ -0,0 +1,63 @@
+from hardhat_event_streams.checkpoint import Checkpointer
+from hardhat_event_streams.delivery import DeliveryQueue
+
+
+class MemoryCheckpointStore:
+    def __init__(self):
+        self.checkpoints = {}
+        self.writes = 0
+
+    def load(self, chain):
+        return {stream_id: checkpoint for (stream_id, c), checkpoint in self.checkpoints.items() if c == chain}
+
+    def save(self, chain, checkpoints, deleted, now):
+        self.writes += 1
+        self.checkpoints = {key: value for key, value in self.checkpoints.items() if key[0] not in deleted}
+        self.checkpoints.update(((stream_id, chain), checkpoint) for stream_id, checkpoint in checkpoints.items())
+
+
+async def _checkpointed(dispatcher, checkpoint_store, sender, store):
+    queue = DeliveryQueue(sender, linger=0, breaker_failures=100, store=store)
+    checkpoints = Checkpointer(queue, store=checkpoint_store)
+    dispatcher = dispatcher(fast={}, slow={}, delivery=queue, checkpoints=checkpoints)
+    dispatcher.router.refresh = lambda: False
+    await dispatcher.reload(dispatcher.router.routes)
+    return queue, checkpoints, dispatcher
+
+
+async def test_checkpoint_resume(generator, blocks, route, dispatcher, sender, store):
+    blocks = blocks(*range(1, 7))
+    chain = int(generator.chain_id, 16)
+    checkpoint_store = MemoryCheckpointStore()
+
+    # the update of block 2 for the slow stream awaits a retry
+    sender.refused = {(2, 2)}
+    queue, checkpoints, dispatch = await _checkpointed(dispatcher, checkpoint_store, sender, store)
+    assert await checkpoints.resume(generator.chain_id, 6, 1) == 1
+    for block in blocks[:4]:
+        await dispatch(block)
+    await queue.drain()
+    assert len(queue.retries) == 1
+    assert await checkpoints.save() == 2
+    assert checkpoint_store.checkpoints == {(1, chain): 4, (2, chain): 1}
+    assert await checkpoints.save() == 0
+    assert checkpoint_store.writes == 1
+
+    # after a restart each stream resumes after its own checkpoint
+    sender.refused.clear()
+    sender.batches.clear()
+    queue, checkpoints, dispatch = await _checkpointed(dispatcher, checkpoint_store, sender, store)
+    assert await checkpoints.resume(generator.chain_id, 6, 6) == 2
+    for block in blocks[1:]:
+        await dispatch(block)
+    await queue.drain()
+    assert sender.delivered() == {1: [5, 6], 2: [2, 3, 4, 5, 6]}
+    assert await checkpoints.save() == 2
+    assert checkpoint_store.checkpoints == {(1, chain): 6, (2, chain): 6}
+
+    # checkpoints of deleted streams are removed, and those beyond the head of a reset chain are ignored
+    dispatch.router.load([route(2, "slow", generator.addresses)])
+    await dispatch.reload(dispatch.router.routes)
+    await checkpoints.save()
+    assert list(checkpoint_store.checkpoints) == [(2, chain)]
+    assert await Checkpointer(queue, store=checkpoint_store).resume(generator.chain_id, 3, 3) == 3
@@ -19,3 +19,18 @@ def runner():
 
 def test_cli_help(runner):
     runner("--help")
+
+
+def test_cli_bench_list(runner):
+    result = runner(["bench", "list"])
+    assert result.exit_code == 0
+    assert "stream_crud" in result.output.split()
+
+
+def test_cli_run_segment_store_workers(runner, monkeypatch):
+    from hardhat_event_streams import settings
+
+    monkeypatch.setattr(settings, "EVENT_STORE", "segment")
+    result = runner(["--workers", "2", "run"])
+    assert result.exit_code == 2
+    assert "single worker" in result.output
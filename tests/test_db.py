@@ -0,0 +1,69 @@
+from hardhat_event_streams import schema  # noqa: F401
+from hardhat_event_streams.db import migrate
+from sqlalchemy import inspect
+from sqlmodel import SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+
+def test_migrate_adds_columns():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    # an eventstream table from before version and the webhook rate columns were added
+    table = SQLModel.metadata.tables["eventstream"]
+    old = [c for c in table.columns if c.name not in ("version", "webhookRateLimit", "webhookRateBurst")]
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE eventstream (%s)" % ", ".join(f'"{c.name}" {c.type.compile(engine.dialect)}' for c in old)
+        )
+        connection.exec_driver_sql("INSERT INTO eventstream (id, \"webhookUrl\") VALUES (1, 'http://localhost')")
+    SQLModel.metadata.create_all(engine)
+    migrate(engine)
+    migrate(engine)
+    columns = {c["name"]: c for c in inspect(engine).get_columns("eventstream")}
+    assert set(columns) == set(table.columns.keys())
+    assert columns["webhookRateLimit"]["nullable"]
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('SELECT version, "webhookRateBurst" FROM eventstream').all() == [(0, None)]
+
+
+def test_migrate_adds_event_key():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE contractevent (id INTEGER PRIMARY KEY, contract_address BLOB, event_hash BLOB,"
+            " txn_hash BLOB, data JSON)"
+        )
+    SQLModel.metadata.create_all(engine)
+    migrate(engine)
+    indexes = {index["name"]: index for index in inspect(engine).get_indexes("contractevent")}
+    assert indexes["uq_contractevent_key"]["unique"]
+    assert indexes["uq_contractevent_key"]["column_names"] == ["chain_id", "txn_hash", "log_index"]
+    assert "ix_contractevent_block_number" in indexes
+
+
+def test_migrate_adds_autoincrement():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    # a publishedupdate table from before its ids were made AUTOINCREMENT
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TABLE publishedupdate (id INTEGER PRIMARY KEY, stream_id INTEGER, block_number INTEGER,"
+            " confirmed BOOLEAN, retries INTEGER, shared BLOB, created FLOAT)"
+        )
+        connection.exec_driver_sql("INSERT INTO publishedupdate VALUES (7, 1, 10, 1, 0, x'7b7d', 1.0)")
+    SQLModel.metadata.create_all(engine)
+    migrate(engine)
+    migrate(engine)
+    with engine.begin() as connection:
+        sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'publishedupdate'").scalar()
+        assert "AUTOINCREMENT" in sql
+        assert connection.exec_driver_sql("SELECT id, block_number, shared FROM publishedupdate").all() == [
+            (7, 10, b"{}")
+        ]
+        # pruning every row does not let the ids start over
+        connection.exec_driver_sql("DELETE FROM publishedupdate")
+        connection.exec_driver_sql(
+            "INSERT INTO publishedupdate (stream_id, block_number, confirmed, retries, shared, created)"
+            " VALUES (1, 11, 1, 0, x'7b7d', 2.0)"
+        )
+        assert connection.exec_driver_sql("SELECT id FROM publishedupdate").scalar() == 8
+    indexes = {index["name"] for index in inspect(engine).get_indexes("publishedupdate")}
+    assert {"ix_publishedupdate_stream_id", "ix_publishedupdate_created"} <= indexes
@@ -0,0 +1,26 @@
+from hardhat_event_streams.decode import DecodeStage
+from hardhat_event_streams.schema import ContractEventUpdate
+
+
+async def test_decode_stage(block, dispatcher, transfer_abi):
+    stage = DecodeStage()
+    dispatcher = dispatcher(one=dict(abi=transfer_abi), two=dict(abi=transfer_abi), raw={}, stages=[stage])
+    for route in dispatcher.router.routes.values():
+        stage.registry.register(route)
+    assert len(stage.registry.decoders) == 2
+    updates = {update.route.tag: update for update in await dispatcher.dispatch(block)}
+    assert updates["one"].shared is updates["two"].shared
+    assert updates["one"].shared is not updates["raw"].shared
+
+    update = ContractEventUpdate.parse_raw(updates["one"].encode())
+    for log, rpc_log in zip(update.logs, block.logs):
+        assert log.decoded["name"] == "Transfer"
+        assert log.decoded["args"]["value"] == str(int(rpc_log["data"], 16))
+        assert log.decoded["args"]["to"].lower() == "0x" + rpc_log["topics"][2][-40:]
+    assert all(log.decoded is None for log in ContractEventUpdate.parse_raw(updates["raw"].encode()).logs)
+
+    # decoders are dropped with the last stream using their abi
+    stage.registry.evict(1)
+    assert len(stage.registry.decoders) == 2
+    await stage.reload({3: dispatcher.router.routes[3]})
+    assert list(stage.registry.decoders.values())[0].topic0 != block.logs[0]["topics"][0]
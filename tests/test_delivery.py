@@ -0,0 +1,160 @@
+import asyncio
+
+import httpx
+import pytest
+from hardhat_event_streams import db
+from hardhat_event_streams.delivery import DeliveryQueue, UpdateStore
+from hardhat_event_streams.schema import SpilledUpdate
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+
+async def test_delivery_batches_blocks(blocks, dispatcher, sender):
+    dispatcher = dispatcher(tag1={}, tag2={})
+    queue = DeliveryQueue(sender, linger=60, max_bytes=10_000_000, batch_blocks=True)
+    for block in blocks(*range(1, 11)):
+        await queue.submit(await dispatcher.dispatch(block))
+    assert sender.batches == []
+    await queue.drain()
+    assert len(sender.batches) == 2
+    assert sender.delivered() == {1: list(range(1, 11)), 2: list(range(1, 11))}
+
+
+async def test_delivery_batch_size_limit(blocks, dispatcher, sender):
+    dispatcher = dispatcher(tag={})
+    updates = []
+    for block in blocks(*range(1, 11)):
+        updates.extend(await dispatcher.dispatch(block))
+    queue = DeliveryQueue(sender, linger=60, max_bytes=updates[0].size * 3, batch_blocks=True)
+    await queue.submit(updates)
+    await queue.drain()
+    assert sum(len(batch) for route, batch in sender.batches) == 10
+    assert all(len(batch) <= 3 for route, batch in sender.batches)
+
+
+class FailingSender:
+    def __init__(self):
+        self.errors = {}
+
+    async def send(self, route, updates):
+        self.errors[route.id] = "refused"
+        return False
+
+
+class RaisingSender:
+    def __init__(self, exc):
+        self.exc = exc
+        self.errors = {}
+
+    async def send(self, route, updates):
+        raise self.exc
+
+
+class HangingSender:
+    errors = {}
+
+    async def send(self, route, updates):
+        await asyncio.Event().wait()
+
+
+async def test_delivery_circuit_breaker(block, dispatcher, store):
+    dispatcher = dispatcher(tag={})
+    updates = await dispatcher.dispatch(block)
+    queue = DeliveryQueue(FailingSender(), linger=0, breaker_failures=3, store=store)
+    await queue.submit(updates)
+    outbox = queue.outboxes[1]
+    for _ in range(3):
+        outbox.deadline = 0
+        await queue._flush(outbox)
+    assert outbox.breaker.open
+    assert outbox.spilled
+    assert len(store.updates) == len(updates)
+    assert "refused" in store.errors[1]
+
+    # further updates spill while the stream is in error
+    await queue.submit(updates)
+    assert len(store.updates) == 2 * len(updates)
+
+    # setting the stream active again closes the breaker and pages spilled updates back in
+    await queue.reload(dispatcher.router.routes)
+    assert not outbox.breaker.open
+    await queue._unspill(outbox)
+    assert len(outbox.updates) == 2 * len(updates)
+    assert not outbox.spilled
+
+
+async def test_delivery_unspill_crash(blocks, dispatcher, sender, monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    dispatcher = dispatcher(tag={})
+    updates = []
+    for block in blocks(*range(1, 6)):
+        updates.extend(await dispatcher.dispatch(block))
+    queue = DeliveryQueue(sender, linger=0, store=UpdateStore())
+    outbox = queue.outbox(updates[0].route)
+    await queue.spill(outbox, updates)
+    await queue._unspill(outbox)
+    assert len(outbox.updates) == len(updates)
+    # the paged-back updates are in durable storage, so they do not hold the checkpoint
+    assert queue.settled(1, 5) == 5
+
+    # a crash before delivery loses nothing: after a restart the updates are paged back again
+    queue = DeliveryQueue(sender, linger=0, store=UpdateStore())
+    await queue.reload(dispatcher.router.routes)
+    outbox = queue.outboxes[1]
+    assert outbox.spilled
+    await queue._unspill(outbox)
+    assert len(outbox.updates) == len(updates)
+    await queue.drain()
+    assert sender.delivered() == {1: list(range(1, 6))}
+    # and deleted once delivered
+    with Session(engine) as session:
+        assert session.exec(select(SpilledUpdate)).all() == []
+
+
+async def test_delivery_retry_dead_letter(block, dispatcher, store):
+    updates = await dispatcher(tag={}).dispatch(block)
+    queue = DeliveryQueue(FailingSender(), linger=0, breaker_failures=100, store=store)
+    queue.retries.max_retries = 2
+    queue.retries.base = queue.retries.cap = 0.01
+    await queue.submit(updates)
+    task = asyncio.create_task(queue.run())
+    try:
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(store.dead) == len(updates):
+                break
+    finally:
+        task.cancel()
+    assert len(store.dead) == len(updates)
+    assert all(update.retries == 3 and error == "refused" for update, error in store.dead)
+    assert queue.requests == 3
+    assert not queue.retries.heap
+
+
+async def test_delivery_send_exception(block, dispatcher, store):
+    updates = await dispatcher(tag={}).dispatch(block)
+    queue = DeliveryQueue(RaisingSender(httpx.InvalidURL("bad url")), linger=0, breaker_failures=1, store=store)
+    await queue.submit(updates)
+    outbox = queue.outboxes[1]
+    await queue._flush(outbox)
+    # the exception fails the request and trips the breaker instead of losing the batch
+    assert outbox.breaker.open
+    assert len(store.updates) == len(updates)
+    assert "InvalidURL: bad url" in store.errors[1]
+    assert queue.settled(1, 10) == 10
+
+
+async def test_delivery_cancelled_send(block, dispatcher, store):
+    updates = await dispatcher(tag={}).dispatch(block)
+    queue = DeliveryQueue(HangingSender(), linger=0, store=store)
+    await queue.submit(updates)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(queue.drain(), 0.05)
+    # the in-flight batch is back in the outbox and still holds the checkpoint
+    assert len(queue.outboxes[1].updates) == len(updates)
+    assert queue.settled(1, 10) == block.number - 1
+    await queue.spill_all()
+    assert len(store.updates) == len(updates)
+    assert queue.settled(1, 10) == 10
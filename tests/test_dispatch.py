@@ -0,0 +1,28 @@
+from hardhat_event_streams.schema import ContractEventUpdate
+
+
+async def test_dispatch_shared_payload(block, dispatcher):
+    updates = await dispatcher(tag1={}, tag2={}, tag3={}).dispatch(block)
+    assert len(updates) == 3
+    assert len(set(id(update.shared) for update in updates)) == 1
+    for update in updates:
+        event = ContractEventUpdate.parse_raw(update.encode())
+        assert str(event.streamId) == update.route.stream_id
+        assert event.tag == update.route.tag
+        assert event.confirmed
+        assert event.retries == 0
+        assert len(event.logs) == len(block.logs)
+
+
+async def test_dispatch_matches_addresses(generator, block, dispatcher):
+    first, second = generator.addresses[:2]
+    updates = await dispatcher(
+        first=dict(addresses=[first]),
+        second=dict(addresses=[second]),
+        terminated=dict(addresses=[first], status="terminated"),
+    ).dispatch(block)
+    for update in updates:
+        event = ContractEventUpdate.parse_raw(update.encode())
+        assert update.route.tag in ("first", "second")
+        expected = first if update.route.tag == "first" else second
+        assert all(log.address.hex() == expected[2:] for log in event.logs)
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+from eth_utils import to_bytes
+from hardhat_event_streams.eventstore import DatabaseEventStore, SegmentEventStore
+from hardhat_event_streams.loadgen import BlockGenerator
+from hardhat_event_streams.schema import ContractEvent
+from sqlalchemy.exc import NoResultFound
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+
+def _events(generator, number):
+    return [
+        ContractEvent(
+            contract_address=to_bytes(hexstr=log["address"]),
+            event_hash=to_bytes(hexstr=log["topics"][0]),
+            txn_hash=to_bytes(hexstr=log["transactionHash"]),
+            data=dict(log, chainId=generator.chain_id),
+        )
+        for log in generator.block(number)["logs"]
+    ]
+
+
+@pytest.fixture(params=["database", "segment"])
+def store(request, tmp_path):
+    if request.param == "segment":
+        yield SegmentEventStore(str(tmp_path / "events"), segment_bytes=4096, interval=4)
+        return
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield DatabaseEventStore(session)
+
+
+def _rows(events):
+    return [(e.id, e.block_number, e.log_index, bytes(e.txn_hash), e.data["logIndex"]) for e in events]
+
+
+def test_event_store(store):
+    generator = BlockGenerator(logs_per_block=8)
+    first = generator.start_block
+    for number in range(first, first + 10):
+        assert store.ingest(_events(generator, number)) == 8
+    # a replayed block is not stored again
+    assert store.ingest(_events(generator, first + 3)) == 0
+
+    events = store.read()
+    assert [e.id for e in events] == list(range(1, 81))
+    assert events[8].block_number == first + 1
+    assert store.read(since=40, limit=5) == events[40:45]
+
+    scan = store.read(first_block=first + 2, last_block=first + 4)
+    assert _rows(scan) == _rows(e for e in events if first + 2 <= e.block_number <= first + 4)
+    assert len(scan) == 24
+    assert _rows(store.read(since=20, limit=3, first_block=first + 2)) == _rows(events[20:23])
+
+    assert _rows([store.read_one(17)]) == _rows([events[16]])
+    assert store.delete(17) == 1
+    assert store.delete(17) == 0
+    with pytest.raises(NoResultFound):
+        store.read_one(17)
+    assert 17 not in [e.id for e in store.read(first_block=first + 2, last_block=first + 2)]
+    assert store.delete() == 79
+    assert store.read() == []
+
+
+def test_segment_event_store_recovery(tmp_path):
+    directory = str(tmp_path / "events")
+    generator = BlockGenerator(logs_per_block=8)
+    first = generator.start_block
+    store = SegmentEventStore(directory, segment_bytes=4096, interval=4)
+    for number in range(first, first + 10):
+        store.ingest(_events(generator, number))
+    store.delete(5)
+    assert len(store.segments) > 1
+    segment = store.segments[-1]
+    # append a torn record after the last one
+    with open(segment.path + ".seg", "ab") as file:
+        file.write(b"\x01" * 40)
+
+    reopened = SegmentEventStore(directory, segment_bytes=4096, interval=4)
+    assert os.path.getsize(segment.path + ".seg") == segment.size
+    assert _rows(reopened.read()) == _rows(store.read())
+    assert [e.id for e in reopened.read(first_block=first + 9)] == list(range(73, 81))
+    assert reopened.ingest(_events(generator, first + 9) + _events(generator, first + 10)) == 8
+    assert reopened.read(since=80)[0].id == 81
+
+
+def test_segment_event_store_delete_all(tmp_path):
+    directory = str(tmp_path / "events")
+    generator = BlockGenerator(logs_per_block=8)
+    first = generator.start_block
+    store = SegmentEventStore(directory, segment_bytes=4096, interval=4)
+    store.ingest(_events(generator, first))
+    assert store.delete() == 8
+    assert store.segments == []
+    # ids are not reused after deleting every event, also after a restart, so a since cursor sees new events
+    store.ingest(_events(generator, first + 1))
+    assert [e.id for e in store.read(since=8)] == list(range(9, 17))
+    reopened = SegmentEventStore(directory, segment_bytes=4096, interval=4)
+    assert reopened.delete() == 8
+    reopened = SegmentEventStore(directory, segment_bytes=4096, interval=4)
+    reopened.ingest(_events(generator, first + 2))
+    assert [e.id for e in reopened.read(since=16)] == list(range(17, 25))
@@ -0,0 +1,46 @@
+import asyncio
+
+from hardhat_event_streams.feed import EventFeed
+
+
+def _reader(events):
+    def read(since):
+        return [event for event in events if event > since]
+
+    return read
+
+
+async def test_feed_returns_new_events():
+    feed = EventFeed(poll=10)
+    read = _reader([1, 2, 3])
+    assert await feed.read(read, 1, 0) == [2, 3]
+    assert await feed.read(read, 3, 0) == []
+
+
+async def test_feed_wait_wakes_on_notify():
+    feed = EventFeed(poll=10)
+    events = [1]
+
+    async def store():
+        await asyncio.sleep(0.05)
+        events.append(2)
+        await feed.notify()
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    result, _ = await asyncio.gather(feed.read(_reader(events), 1, 5), store())
+    assert result == [2]
+    assert loop.time() - start < 1
+    assert feed.waiting == 0
+
+
+async def test_feed_wait_polls_and_times_out():
+    feed = EventFeed(poll=0.02)
+    events = [1]
+    loop = asyncio.get_running_loop()
+    # stored without a notify, as by another worker
+    loop.call_later(0.05, events.append, 2)
+    assert await feed.read(_reader(events), 1, 5) == [2]
+    start = loop.time()
+    assert await feed.read(_reader(events), 2, 0.1) == []
+    assert loop.time() - start >= 0.1
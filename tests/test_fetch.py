@@ -0,0 +1,54 @@
+import pytest
+from eth_utils import to_hex
+from hardhat_event_streams.fetch import TransactionFetcher, TransactionStage
+from hardhat_event_streams.schema import ContractEventUpdate
+
+
+def _hashes(block):
+    return list(dict.fromkeys(log["transactionHash"] for log in block.logs))
+
+
+@pytest.mark.parametrize("block_receipts", [True, False])
+async def test_transaction_stage(generator, block, dispatcher, rpc, block_receipts):
+    fetcher = TransactionFetcher(rpc, block_receipts=block_receipts)
+    dispatcher = dispatcher(
+        one={}, two=dict(abi=[]), none=dict(includeNativeTxs=False), stages=[TransactionStage(rpc, fetcher)]
+    )
+    updates = {update.route.tag: update for update in await dispatcher.dispatch(block)}
+    hashes = _hashes(block)
+    for tag in "one", "two":
+        update = ContractEventUpdate.parse_raw(updates[tag].encode())
+        assert [to_hex(tx.hash) for tx in update.txs] == hashes
+        for tx in update.txs:
+            receipt = generator.receipts[to_hex(tx.hash)]
+            assert tx.receiptGasUsed == int(receipt["gasUsed"], 16)
+            assert tx.receiptCumulativeGasUsed == int(receipt["cumulativeGasUsed"], 16)
+            assert tx.receiptStatus == 1
+    assert ContractEventUpdate.parse_raw(updates["none"].encode()).txs == []
+
+    # one batch serves every stream: the block with its receipts, or each transaction with its receipt
+    if block_receipts:
+        assert rpc.methods == {"eth_getBlockByNumber": 1, "eth_getBlockReceipts": 1}
+    else:
+        assert rpc.methods == {"eth_getTransactionByHash": len(hashes), "eth_getTransactionReceipt": len(hashes)}
+    assert rpc.batches == 1
+    # and is reused if the block is dispatched again
+    await dispatcher.dispatch(block)
+    assert rpc.batches == 1
+
+
+async def test_transaction_fetcher_fallback(block, rpc):
+    # a node without eth_getBlockReceipts
+    rpc.rpc.eth_getBlockReceipts = None
+    fetcher = TransactionFetcher(rpc)
+    hashes = _hashes(block)
+    assert list(await fetcher.get(block, hashes)) == hashes
+    assert not fetcher.block_receipts
+    assert rpc.methods["eth_getTransactionReceipt"] == len(hashes)
+
+    # later blocks go straight to fetching by hash
+    batches = rpc.batches
+    fetcher.block_hash = None
+    await fetcher.get(block, hashes)
+    assert rpc.batches == batches + 1
+    assert rpc.methods["eth_getBlockReceipts"] == 1
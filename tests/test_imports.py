@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+PACKAGE = "hardhat_event_streams"
+
+# server, database and schema dependencies that the cli and client must not load at import
+HEAVY = ["uvicorn", "fastapi", "starlette", "sqlmodel", "sqlalchemy", "pydantic", "eth_utils", "hexbytes"]
+
+IMPORT_BUDGET = 1.0
+
+
+def _import(statement):
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps(dict(elapsed=elapsed, loaded=[m for m in {HEAVY!r} if m in sys.modules])))\n"
+    )
+    env = {k: v for k, v in os.environ.items() if k != "API_KEY"}
+    output = subprocess.check_output([sys.executable, "-c", script], env=env, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        f"import {PACKAGE}",
+        f"from {PACKAGE} import streams",
+        f"from {PACKAGE}.cli import cli",
+    ],
+)
+def test_import_is_light(statement):
+    result = _import(statement)
+    assert result["loaded"] == []
+    assert result["elapsed"] < IMPORT_BUDGET
+
+
+def test_cli_help_is_light():
+    result = _import(
+        f"from {PACKAGE}.cli import cli\n" "try:\n" "    cli(['--help'])\n" "except SystemExit:\n" "    pass"
+    )
+    assert result["loaded"] == []
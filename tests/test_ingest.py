@@ -0,0 +1,51 @@
+import pytest
+from eth_utils import to_bytes
+from hardhat_event_streams.ingest import EventIngester
+from hardhat_event_streams.loadgen import BlockGenerator
+from hardhat_event_streams.schema import ContractEvent
+from sqlmodel import Session, SQLModel, create_engine, select
+from sqlmodel.pool import StaticPool
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+def _events(generator, number):
+    return [
+        ContractEvent(
+            contract_address=to_bytes(hexstr=log["address"]),
+            event_hash=to_bytes(hexstr=log["topics"][0]),
+            txn_hash=to_bytes(hexstr=log["transactionHash"]),
+            data=dict(log, chainId=generator.chain_id),
+        )
+        for log in generator.block(number)["logs"]
+    ]
+
+
+def _count(engine):
+    with Session(engine) as session:
+        return len(session.exec(select(ContractEvent.id)).all())
+
+
+def test_ingest_suppresses_duplicates(engine):
+    generator = BlockGenerator(logs_per_block=8)
+    ingester = EventIngester()
+    with Session(engine) as session:
+        assert ingester.ingest(session, _events(generator, 1)) == 8
+        # a replayed block is dropped by the recent keys without a database write
+        assert ingester.ingest(session, _events(generator, 1)) == 0
+        assert ingester.recent.hits == 8
+        # duplicates within a batch are inserted once
+        assert ingester.ingest(session, _events(generator, 2) * 2) == 8
+    assert _count(engine) == 16
+
+    # a restarted worker has no recent keys; the unique index ignores the duplicates
+    restarted = EventIngester()
+    with Session(engine) as session:
+        assert restarted.ingest(session, _events(generator, 1) + _events(generator, 3)) == 8
+    assert restarted.recent.hits == 0
+    assert _count(engine) == 24
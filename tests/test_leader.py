@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import pytest
+from hardhat_event_streams import db
+from hardhat_event_streams.leader import Leader
+from sqlmodel import SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    return engine
+
+
+def test_leader_single_holder(engine):
+    first = Leader(ttl=10, identity="first")
+    second = Leader(ttl=10, identity="second")
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.acquire()
+    assert first.holder() == "first"
+    first.release()
+    assert second.acquire()
+    assert not first.acquire()
+    assert second.holder() == "second"
+
+
+def test_leader_failover(engine):
+    first = Leader(ttl=0.1, identity="first")
+    second = Leader(ttl=0.1, identity="second")
+    assert first.acquire()
+    assert not second.acquire()
+    time.sleep(0.2)
+    assert first.holder() is None
+    assert second.acquire()
+    assert not first.acquire()
+
+
+async def test_leader_start_failure(engine):
+    leader = Leader(ttl=0.03, identity="leader")
+    calls = []
+
+    async def start():
+        calls.append("start")
+        if calls.count("start") == 1:
+            raise RuntimeError("pipeline failed")
+
+    async def stop():
+        calls.append("stop")
+
+    task = asyncio.create_task(leader.run(start, stop))
+    await asyncio.sleep(0.05)
+    # a failed start is stopped and the lease released, then contended for again
+    assert calls[:3] == ["start", "stop", "start"]
+    assert leader.is_leader
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert calls[-1] == "stop" and leader.holder() is None
@@ -0,0 +1,44 @@
+from eth_utils import is_hex, is_hex_address
+from hardhat_event_streams.bloom import bloom_bits, logs_bloom
+from hardhat_event_streams.loadgen import BlockGenerator, FakeRPC
+
+
+def _without_timestamps(block):
+    return dict(block, timestamp=None)
+
+
+def test_loadgen_blocks(generator):
+    block = generator.block(3)
+    assert int(block["number"], 16) == 3
+    assert block["parentHash"] == generator.block(2)["hash"]
+    assert len(block["transactions"]) == 4 and len(block["logs"]) == 8
+    hashes = set(tx["hash"] for tx in block["transactions"])
+    for index, log in enumerate(block["logs"]):
+        assert int(log["logIndex"], 16) == index
+        assert log["blockHash"] == block["hash"] and log["transactionHash"] in hashes
+        assert is_hex_address(log["address"]) and log["address"] in generator.addresses
+        assert log["topics"][0] in generator.topic0
+        assert all(is_hex(topic) and len(topic) == 66 for topic in log["topics"])
+
+    # the header and receipt blooms have the bits of every log address and topic
+    bloom = int(block["logsBloom"], 16)
+    assert block["logsBloom"] == "0x" + logs_bloom(block["logs"]).hex()
+    assert all(bloom_bits(log["address"]) & bloom == bloom_bits(log["address"]) for log in block["logs"])
+    for tx in block["transactions"]:
+        receipt = generator.receipts[tx["hash"]]
+        assert receipt["logs"] == [log for log in block["logs"] if log["transactionHash"] == tx["hash"]]
+        assert receipt["logsBloom"] == "0x" + logs_bloom(receipt["logs"]).hex()
+
+    # the fake rpc serves the logs of the head block without them in the header
+    rpc = FakeRPC(generator)
+    assert "logs" not in rpc.handle(dict(method="eth_getBlockByNumber", params=["latest", False]))["result"]
+    logs = rpc.handle(dict(method="eth_getLogs", params=[dict(fromBlock="0x1", toBlock="0x1")]))["result"]
+    assert logs == generator.block(1)["logs"]
+
+
+def test_loadgen_seed():
+    blocks = [BlockGenerator(seed=seed).blocks_range(1, 3) for seed in (1, 1, 2)]
+    first, same, other = ([_without_timestamps(block) for block in seed_blocks] for seed_blocks in blocks)
+    assert first == same
+    assert first != other
+    assert BlockGenerator(seed=1).addresses != BlockGenerator(seed=2).addresses
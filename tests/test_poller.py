@@ -0,0 +1,25 @@
+from hardhat_event_streams.poller import ChainPoller
+
+
+async def test_poller_prefetch(generator, rpc):
+    # a fixed head well ahead of the poller
+    generator.block_time = 0
+    start = generator.start_block
+    list(generator.blocks_range(start, 12))
+    head = generator.head()
+    handled = []
+
+    async def handler(block):
+        handled.append((block.number, rpc.batches))
+
+    rpc.delay = 0.01
+    poller = ChainPoller(rpc, handlers=[handler], start_block=start, prefetch=4)
+    poller.chain_id = generator.chain_id
+    assert await poller.poll() == head - start + 1
+    # the blocks are handled in order, the first after the fetches of the next three started
+    count = head - start + 1
+    assert [number for number, _ in handled] == list(range(start, head + 1))
+    assert handled[0] == (start, 5)
+    # and the fetches run concurrently, each block fetched once after the head
+    assert rpc.max_active == 4
+    assert rpc.batches == 1 + count
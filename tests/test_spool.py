@@ -0,0 +1,83 @@
+from hardhat_event_streams.delivery import DeliveryQueue
+from hardhat_event_streams.dispatch import Update
+from hardhat_event_streams.spool import SegmentSpool
+
+
+def test_spool_segments(generator, route, tmp_path):
+    stream = route(1, "paused", generator.addresses, "paused")
+    updates = [Update(stream, b'{"n":%d}' % n, n, n % 2 == 0, n % 3) for n in range(50)]
+    spool = SegmentSpool(str(tmp_path), segment_bytes=200)
+    spool.write(updates[:30])
+    spool.write(updates[30:])
+    assert spool.streams() == {1}
+    segments = len(spool.segments[1])
+    assert segments > 1
+
+    read = spool.read(stream, 20)
+    assert [u.block_number for u in read] == list(range(20))
+    assert [u.block_number for u in spool.read(stream, 5)] == list(range(20, 25))
+    # reading deletes nothing; acknowledging the delivered updates moves the cursor and deletes their segments
+    assert len(spool.segments[1]) == segments
+    spool.acknowledge(read[:10])
+    assert len(spool.segments[1]) < segments
+
+    # a restarted spool resumes from the saved cursor, so updates taken but not acknowledged are read again
+    restarted = SegmentSpool(str(tmp_path), segment_bytes=200)
+    assert restarted.streams() == {1}
+    read = read[:10] + restarted.read(stream, 100)
+    assert [(u.shared, u.block_number, u.confirmed, u.retries) for u in read] == [
+        (u.shared, u.block_number, u.confirmed, u.retries) for u in updates
+    ]
+    assert restarted.streams() == set()
+    # acknowledgements out of order move the cursor once the updates before them are acknowledged
+    restarted.acknowledge(read[30:])
+    assert restarted.cursors[1] is not None
+    restarted.acknowledge(read[10:30])
+    # delivered segments are deleted
+    assert restarted.cursors[1] is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_spool_torn_index(generator, route, tmp_path):
+    stream = route(1, "paused", generator.addresses, "paused")
+    updates = [Update(stream, b'{"n":%d}' % n, n) for n in range(6)]
+    spool = SegmentSpool(str(tmp_path))
+    spool.write(updates[:3])
+    # a crash tore the next record and its index entry
+    (path,) = tmp_path.glob("1/*.seg")
+    with open(path, "ab") as file:
+        file.write(b"torn record")
+    with open(path.with_suffix(".idx"), "ab") as file:
+        file.write(b"\x01\x02\x03")
+
+    restarted = SegmentSpool(str(tmp_path))
+    restarted.write(updates[3:])
+    assert [u.shared for u in restarted.read(stream, 10)] == [u.shared for u in updates]
+    # and the updates appended after the torn entry are still read after another restart
+    assert [u.shared for u in SegmentSpool(str(tmp_path)).read(stream, 10)] == [u.shared for u in updates]
+
+
+async def test_delivery_paused_spool(generator, block, route, dispatcher, sender, store, tmp_path):
+    dispatcher = dispatcher(tag=dict(status="paused"))
+    updates = await dispatcher.dispatch(block)
+    assert updates
+    spool = SegmentSpool(str(tmp_path))
+    queue = DeliveryQueue(sender, linger=0, store=store, spool=spool)
+    await queue.reload(dispatcher.router.routes)
+    for _ in range(3):
+        await queue.submit(updates)
+    outbox = queue.outboxes[1]
+    assert outbox.spooled and not store.updates
+    assert spool.streams() == {1}
+
+    # setting the stream active drains the spool in order
+    await queue.reload({1: route(1, "tag", generator.addresses)})
+    await queue._unspill(outbox)
+    assert len(outbox.updates) == 3 * len(updates)
+    assert not outbox.spilled
+    assert spool.streams() == set()
+    # the spool keeps the updates until they are delivered
+    assert list(tmp_path.iterdir())
+    await queue.drain()
+    assert sender.delivered() == {1: [block.number] * 3 * len(updates)}
+    assert not list(tmp_path.iterdir())
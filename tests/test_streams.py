@@ -2,9 +2,11 @@ from logging import info
 from pprint import pformat
 from uuid import uuid4
 
+import httpx
 import pytest
 from eth_utils import is_same_address
 from hardhat_event_streams import HardhatStreamsError
+from hardhat_event_streams.client import HardhatEventsStreams
 from hardhat_event_streams.schema import AddressResponse
 from seven_common.streams import EventStream
 
@@ -196,3 +198,62 @@ def test_streams_addresses(streams, api_key, contracts, create_stream, webhook_u
     result = stream_result(ret)
     assert isinstance(result, list)
     assert result == []
+
+
+def test_streams_etag(streams, api_key, contracts, create_stream, webhook_url):
+    evm_streams = streams.evm_streams
+    stream = create_stream(contracts["Character"], "etag", webhook_url)
+    params = dict(id=stream.id)
+
+    first = evm_streams.get_addresses(api_key, params=params)
+    hits = evm_streams.cache.hits
+    second = evm_streams.get_addresses(api_key, params=params)
+    assert second == first
+    assert evm_streams.cache.hits == hits + 1
+
+    # adding an address changes the stream version, so the cached response is replaced
+    body = dict(address=[contracts["Character"].address])
+    evm_streams.add_address_to_stream(api_key, params=params, body=body)
+    third = AddressResponse(**evm_streams.get_addresses(api_key, params=params))
+    assert evm_streams.cache.hits == hits + 1
+    assert len(third.address) == 1
+
+    before = evm_streams.get_streams(api_key, params=dict(limit=100, cursor=""))
+    after = evm_streams.get_streams(api_key, params=dict(limit=100, cursor=""))
+    assert before == after
+    assert evm_streams.cache.hits == hits + 2
+
+
+def test_streams_etag_evicted(api_key):
+    def handler(request):
+        if request.headers.get("if-none-match") == f'"{request.url.path}"':
+            # another request evicts the revalidated entry before the 304 arrives
+            evm_streams.get(api_key, "/other")
+            return httpx.Response(304)
+        return httpx.Response(200, json=dict(path=request.url.path), headers=dict(etag=f'"{request.url.path}"'))
+
+    requests = httpx.Client(transport=httpx.MockTransport(handler))
+    evm_streams = HardhatEventsStreams(url="http://streams", requests=requests, cache_size=1)
+    assert evm_streams.get(api_key, "/streams") == dict(path="/streams")
+    # the 304 is answered from the entry sent for revalidation
+    assert evm_streams.get(api_key, "/streams") == dict(path="/streams")
+    assert evm_streams.cache.hits == 1
+    requests.close()
+
+
+def test_streams_profiles(streams, api_key):
+    admin = streams.admin
+    admin.clear_profiles(api_key)
+    headers = {"x-api-key": api_key, "x-profile": api_key}
+    response = admin.requests.get(admin.url + "/streams", params=dict(limit=10, cursor=""), headers=headers)
+    assert response.status_code == 200
+    profiles = admin.get_profiles(api_key)
+    assert [(p["method"], p["path"], p["status"]) for p in profiles] == [("GET", "/streams", 200)]
+    assert "cumulative" in profiles[0]["stats"]
+
+    # a wrong profile key is not profiled
+    headers["x-profile"] = "wrong"
+    admin.requests.get(admin.url + "/streams", params=dict(limit=10, cursor=""), headers=headers)
+    assert len(admin.get_profiles(api_key)) == 1
+    assert admin.clear_profiles(api_key) == dict(status="deleted", count=1)
+    assert admin.get_profiles(api_key) == []
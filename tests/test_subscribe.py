@@ -0,0 +1,110 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from hardhat_event_streams import db
+from hardhat_event_streams.schema import EventStream
+from hardhat_event_streams.subscribe import Publisher, PublishStore, Subscription
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+
+class MemoryPublishStore:
+    def __init__(self):
+        self.rows = []
+        self.leases = {}
+
+    def publish(self, updates, now):
+        published = [update for update in updates if self.leases.get(update.route.id, 0) >= now]
+        for update in published:
+            row = SimpleNamespace(
+                id=len(self.rows) + 1,
+                stream_id=update.route.id,
+                block_number=update.block_number,
+                confirmed=update.confirmed,
+                retries=update.retries,
+                shared=update.shared,
+            )
+            self.rows.append(row)
+        return len(published)
+
+    def prune(self, now, before):
+        pass
+
+    def renew(self, stream_id, expires):
+        self.leases[stream_id] = expires
+        return True
+
+    def tail(self, stream_id):
+        return max([row.id for row in self.rows if row.stream_id == stream_id], default=0)
+
+    def read(self, stream_id, cursor, limit):
+        return [row for row in self.rows if row.stream_id == stream_id and row.id > cursor][:limit]
+
+
+def _messages(data):
+    events = []
+    for message in data.split(b"\n\n"):
+        fields = dict(line.split(b": ", 1) for line in message.split(b"\n") if b": " in line)
+        if b"data" in fields:
+            events.append((int(fields[b"id"]), json.loads(fields[b"data"])))
+    return events
+
+
+async def _read(subscription, count):
+    data = b""
+    events = subscription.events()
+    while len(_messages(data)) < count:
+        data += await asyncio.wait_for(events.__anext__(), 1)
+    await events.aclose()
+    return _messages(data)
+
+
+async def test_subscription_resume(blocks, dispatcher):
+    store = MemoryPublishStore()
+    dispatcher = dispatcher(subscribed={}, webhook={}, publisher=Publisher(store))
+    routes = dispatcher.router.routes
+    subscription = Subscription(routes[1], store=store, buffer=2, poll=0.01)
+    await subscription.open()
+    assert subscription.cursor == 0
+
+    for block in blocks(1, 2, 3):
+        await dispatcher.publisher.publish(await dispatcher.dispatch(block))
+    # only the stream with a subscriber is published
+    assert [row.stream_id for row in store.rows] == [1, 1, 1]
+
+    events = await _read(subscription, 3)
+    assert [cursor for cursor, update in events] == [1, 2, 3]
+    assert [update["block"]["number"] for cursor, update in events] == ["1", "2", "3"]
+    assert all(update["streamId"] == routes[1].stream_id for cursor, update in events)
+
+    # a reconnecting subscriber resumes after its cursor
+    resumed = Subscription(routes[1], cursor=1, store=store, poll=0.01)
+    await resumed.open()
+    assert [cursor for cursor, update in await _read(resumed, 2)] == [2, 3]
+
+
+async def test_subscription_resume_after_prune(blocks, dispatcher, monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(db, "engine", engine)
+    store = PublishStore()
+    dispatcher = dispatcher(subscribed={}, publisher=Publisher(store, retention=60))
+    route = dispatcher.router.routes[1]
+    with Session(engine) as session:
+        session.add(EventStream(id=1, streamId=route.stream_id, webhookUrl=route.webhook_url))
+        session.commit()
+    subscription = Subscription(route, store=store, poll=0.01)
+    await subscription.open()
+    for block in blocks(1, 2):
+        await dispatcher.publisher.publish(await dispatcher.dispatch(block))
+    assert [cursor for cursor, update in await _read(subscription, 2)] == [1, 2]
+
+    # once every published update is pruned, new updates still get ids after the subscriber's cursor
+    store.prune(0, float("inf"))
+    for block in blocks(3):
+        await dispatcher.publisher.publish(await dispatcher.dispatch(block))
+    resumed = Subscription(route, cursor=2, store=store, poll=0.01)
+    await resumed.open()
+    events = await _read(resumed, 1)
+    assert [(cursor, update["block"]["number"]) for cursor, update in events] == [(3, "3")]
@@ -0,0 +1,32 @@
+from hardhat_event_streams.schema import ContractEventUpdate
+from hardhat_event_streams.tokens import TRANSFER, TRANSFER_SINGLE, TokenStage, classify
+
+
+def test_classify_token_logs():
+    word = "0x" + "00" * 12 + "11" * 20
+    log = dict(logIndex="0x1", transactionHash="0x" + "22" * 32, address="0x" + "AB" * 20)
+    erc20 = classify(dict(log, topics=[TRANSFER, word, word], data="0x" + "%064x" % 10**18))
+    assert erc20 == [("erc20_transfers", erc20[0][1], "ERC20")]
+    assert erc20[0][1]["value"] == str(10**18) and erc20[0][1]["contract"] == "0x" + "ab" * 20
+    erc1155 = classify(dict(log, topics=[TRANSFER_SINGLE, word, word, word], data="0x" + "%064x%064x" % (7, 3)))
+    assert erc1155[0][0] == "nft_transfers" and erc1155[0][2] == "ERC1155"
+    assert (erc1155[0][1]["tokenId"], erc1155[0][1]["amount"]) == ("7", "3")
+    assert classify(dict(log, topics=[TRANSFER], data="0x")) == []
+
+
+async def test_token_stage(block, dispatcher, rpc):
+    dispatcher = dispatcher(tag={}, stages=[TokenStage(rpc)])
+    updates = await dispatcher.dispatch(block)
+    update = ContractEventUpdate.parse_raw(updates[0].encode())
+    assert len(update.erc20Transfers) == len(block.logs)
+    transfer = update.erc20Transfers[0]
+    assert transfer["tokenSymbol"].startswith("T")
+    assert transfer["value"] == str(int(block.logs[0]["data"], 16))
+    assert int(transfer["tokenDecimals"]) == 18
+
+    # name, symbol and decimals of every contract are read in one batch, and cached
+    contracts = set(log["address"] for log in block.logs)
+    assert rpc.methods == {"eth_call": 3 * len(contracts)}
+    assert rpc.batches == 1
+    await dispatcher.dispatch(block)
+    assert rpc.batches == 1
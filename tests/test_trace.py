@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from eth_utils import to_hex
+from hardhat_event_streams.schema import ContractEventUpdate
+from hardhat_event_streams.trace import Tracer, TraceStage
+
+
+def _hashes(block):
+    return list(dict.fromkeys(log["transactionHash"] for log in block.logs))
+
+
+@pytest.mark.parametrize("tracer", ["callTracer", ""])
+async def test_trace_stage(block, dispatcher, rpc, tracer):
+    stage = TraceStage(rpc, Tracer(rpc, concurrency=2, tracer=tracer))
+    dispatcher = dispatcher(
+        one=dict(includeInternalTxs=True),
+        two=dict(includeInternalTxs=True, abi=[]),
+        none=dict(includeInternalTxs=False),
+        stages=[stage],
+    )
+    updates = {update.route.tag: update for update in await dispatcher.dispatch(block)}
+    hashes = _hashes(block)
+    for tag in "one", "two":
+        update = ContractEventUpdate.parse_raw(updates[tag].encode())
+        assert [to_hex(tx.transactionHash) for tx in update.txsInternal] == hashes
+        assert all(tx.value == 1000 and tx.gas == 2300 for tx in update.txsInternal)
+        assert [to_hex(tx.to_address) for tx in update.txsInternal] == ["0x" + h[-40:] for h in hashes]
+    assert ContractEventUpdate.parse_raw(updates["none"].encode()).txsInternal == []
+
+    # callTracer frames carry the call addresses; struct logs need the transaction for its recipient
+    if tracer:
+        assert rpc.methods == {"debug_traceTransaction": len(hashes)}
+    else:
+        assert rpc.methods == {"debug_traceTransaction": len(hashes), "eth_getTransactionByHash": len(hashes)}
+
+    # each transaction is traced once, for every stream and on replay
+    assert stage.tracer.traced == len(hashes)
+    await dispatcher.dispatch(block)
+    assert stage.tracer.traced == len(hashes)
+    assert stage.tracer.cache.hits == len(hashes)
+
+
+async def test_tracer_concurrency(block, rpc):
+    rpc.delay = 0.01
+    tracer = Tracer(rpc, concurrency=2, tracer="callTracer")
+    hashes = _hashes(block)
+    assert len(hashes) > 2
+    traces = await tracer.trace_all(hashes)
+    assert list(traces) == hashes
+    # no more traces are in flight than the concurrency limit allows
+    assert rpc.max_active == 2
+
+    # concurrent requests for a transaction share one trace
+    tracer = Tracer(rpc, concurrency=2, tracer="callTracer")
+    calls = rpc.calls
+    first, second = await asyncio.gather(tracer.trace(hashes[0]), tracer.trace(hashes[0]))
+    assert first == second
+    assert rpc.calls == calls + 1
+    assert tracer.traced == 1
@@ -0,0 +1,62 @@
+from hardhat_event_streams.decode import DecodeStage
+from hardhat_event_streams.schema import ContractEventUpdate
+from hardhat_event_streams.tokens import TokenStage
+from hardhat_event_streams.triggers import TriggerStage
+
+BALANCE_OF = {
+    "name": "balanceOf",
+    "type": "function",
+    "stateMutability": "view",
+    "inputs": [{"name": "owner", "type": "address"}],
+    "outputs": [{"name": "", "type": "uint256"}],
+}
+
+
+def _trigger_batches(rpc):
+    """return the batches of balanceOf eth_call requests"""
+    return [
+        batch
+        for batch in rpc.requests
+        if any(method == "eth_call" and params[0]["data"].startswith("0x70a08231") for method, params in batch)
+    ]
+
+
+async def test_trigger_stage(blocks, dispatcher, rpc, transfer_abi):
+    triggers = [
+        dict(type="erc20transfer", contractAddress="$contract", functionAbi=BALANCE_OF, inputs=["$to"], name="to"),
+        dict(type="log", contractAddress="$address", functionAbi=BALANCE_OF, inputs=["$to"], name="log"),
+    ]
+    stage = TriggerStage(rpc)
+    dispatcher = dispatcher(
+        one=dict(triggers=triggers, abi=transfer_abi),
+        two=dict(triggers=triggers[:1], abi=transfer_abi),
+        none=dict(abi=transfer_abi),
+        stages=[DecodeStage(), TokenStage(rpc), stage],
+    )
+    for route in dispatcher.router.routes.values():
+        dispatcher.stages[0].registry.register(route)
+    first, second = blocks(1, 2)
+    updates = {update.route.tag: update for update in await dispatcher.dispatch(first)}
+    one = ContractEventUpdate.parse_raw(updates["one"].encode())
+    for transfer, log in zip(one.erc20Transfers, one.logs):
+        expected = str(int(transfer["to"][-8:], 16) + first.number)
+        assert transfer["triggers"] == [dict(name="to", value=expected)]
+        assert log.triggers == [dict(name="log", value=expected)]
+    two = ContractEventUpdate.parse_raw(updates["two"].encode())
+    assert [t["triggers"] for t in two.erc20Transfers] == [t["triggers"] for t in one.erc20Transfers]
+    assert all(log.triggers is None for log in two.logs)
+    none = ContractEventUpdate.parse_raw(updates["none"].encode())
+    assert all("triggers" not in transfer for transfer in none.erc20Transfers)
+
+    # the calls of every stream and trigger are deduplicated into one eth_call batch at the block
+    unique = set((t["contract"], t["to"]) for t in one.erc20Transfers)
+    planned = 3 * len(one.erc20Transfers)
+    assert (stage.calls, stage.deduplicated) == (len(unique), planned - len(unique))
+    (batch,) = _trigger_batches(rpc)
+    assert len(batch) == len(unique)
+    assert all(params[1] == hex(first.number) for method, params in batch)
+
+    # results depend on the block, so each block gets its own batch
+    await dispatcher.dispatch(second)
+    assert len(_trigger_batches(rpc)) == 2
+    assert all(params[1] == hex(second.number) for method, params in _trigger_batches(rpc)[1])